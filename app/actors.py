@@ -0,0 +1,362 @@
+"""
+Actor mode of the live games (GAME_ACTORS=True). Every active game is
+owned by an actor of a single worker: an asyncio task with a queue of
+moves that keeps the authoritative game in memory and applies the moves
+one at a time, so the moves of a game never race and never read the game
+back from mongo. Changes are persisted write-behind, at most ACTOR_FLUSH
+seconds after the move and right away when the game ends. Actors idle
+for ACTOR_IDLE seconds are flushed and evicted, the next move loads the
+game again.
+
+With several workers a game is owned by the worker of its id hash (see
+owner). Every worker also listens on ACTOR_PORT + its position in the
+pool, the requests of a game reaching another worker are forwarded
+there. Readers of mongo, such as the move lists, may lag behind the
+actor by the flush delay.
+"""
+import asyncio
+import logging
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+from tornado.web import HTTPError
+
+from app.archive import find_game
+from app.context import current
+from app.engine import GameEngine
+from app.leaderboard import leaderboard
+from app.metrics import metrics
+from app.models import Game, GameMove
+from app.stats import record_game
+
+
+logger = logging.getLogger(__name__)
+
+engine = GameEngine()
+
+
+def owner(pk: str, workers: int) -> int:
+    """
+    Position of the worker owning a game
+    :param str pk: game id
+    :param int workers: amount of workers of the pool
+    :return int:
+    """
+    return int(pk, 16) % max(workers, 1)
+
+
+class GameActor:
+    """
+    Owner of a live game
+    """
+
+    def __init__(self, pk: str, registry):
+        self.pk = pk
+        self.registry = registry
+        self.queue = asyncio.Queue()
+        self.game = None
+        # Player and symbol of the last move
+        self.last = None
+        self.pending = []
+        self.snapshots = []
+        self.dirty = False
+        self.flushing = asyncio.Lock()
+        self.timer = None
+        self.task = None
+
+    async def load(self, previous: asyncio.Task = None):
+        """
+        Read the game and its last move, once the previous actor of the
+        game is done writing it
+        :param previous: task of the evicted actor of the game
+        :return:
+        """
+        if previous is not None:
+            await asyncio.wait([previous])
+        self.game = await Game.find_by_id(self.pk)
+        move = await GameMove.find_one({'game': self.game.pk}, sort=[('_id', -1)])
+        if move is not None:
+            self.last = (move.player.pk, move.symbol)
+
+    async def run(self, previous: asyncio.Task = None):
+        """
+        Apply the queued moves until the actor stays idle
+        :param previous: see load
+        :return:
+        """
+        try:
+            try:
+                await self.load(previous)
+            except Exception as error:
+                self.registry.discard(self)
+                self.fail_pending(error)
+                return
+            while True:
+                try:
+                    data, background, future = await asyncio.wait_for(
+                        self.queue.get(), self.registry.idle,
+                    )
+                except asyncio.TimeoutError:
+                    # No move reaches this actor once it is discarded
+                    self.registry.discard(self)
+                    if self.queue.empty():
+                        break
+                    continue
+                await self.handle(data, background, future)
+        finally:
+            if self.timer is not None:
+                self.timer.cancel()
+            await self.flush()
+            metrics.inc('actors.evicted')
+
+    def fail_pending(self, error: Exception):
+        while not self.queue.empty():
+            _, _, future = self.queue.get_nowait()
+            if not future.done():
+                future.set_exception(error)
+
+    async def handle(self, data: dict, background: bool, future: asyncio.Future):
+        """
+        Play a move of the player and the reply of the bot of single
+        player games. The future gets the game after the move, or after
+        the reply unless it is computed in the background.
+        :return:
+        """
+        game = self.game
+        try:
+            if game.status in [Game.STATUS_TIE, Game.STATUS_FINISHED]:
+                raise HTTPError(400, 'Game was already finished')
+            move = GameMove(**data)
+            await self.check_player(move)
+            await self.apply(move)
+            if background or game.multiplayer or game.status != Game.STATUS_IN_PROGRESS:
+                future.set_result(game.dump())
+            if not game.multiplayer and game.status == Game.STATUS_IN_PROGRESS:
+                await self.apply(await current().bots.get(game.bot).move(game, move))
+                if not future.done():
+                    future.set_result(game.dump())
+        except Exception as error:
+            if not future.done():
+                future.set_exception(error)
+            else:
+                logger.exception('Reply to game %s failed', self.pk)
+
+    async def check_player(self, move: GameMove):
+        """
+        The player of a move must exist, as in GameEngine.execute_move.
+        Users are read through the player cache, not once per move.
+        :param GameMove move:
+        :return:
+        """
+        pk = str(move.player.pk)
+        if pk not in await current().players.resolve([pk]):
+            raise HTTPError(404, 'Object not found Not Found')
+
+    def validate(self, move: GameMove):
+        """
+        Rules of GameEngine.execute_move, checked on the state in memory
+        :param GameMove move:
+        :return:
+        """
+        row = move.cell.get('row')
+        column = move.cell.get('column')
+        if not isinstance(row, int) or not isinstance(column, int) \
+                or not 0 <= row < self.game.size or not 0 <= column < self.game.size \
+                or self.game.get_cell(row, column) != '':
+            raise HTTPError(412, 'Invalid move')
+        if self.last is not None:
+            if self.last[0] == move.player.pk:
+                raise HTTPError(412, 'User already played its turn')
+            if self.last[1] == move.symbol:
+                raise HTTPError(412, 'Player is not allowed to use that symbol')
+
+    async def apply(self, move: GameMove):
+        """
+        Play a move on the game in memory and schedule its persistence
+        :param GameMove move:
+        :return:
+        """
+        game = self.game
+        self.validate(move)
+        move.game = game.pk
+        game.set_cell(move.cell.get('row'), move.cell.get('column'), move.symbol)
+        game.status = await engine.evaluate(game, move)
+        if game.status == Game.STATUS_FINISHED:
+            game.winner = move.player
+        game.version = (game.version or 0) + 1
+        self.last = (move.player.pk, move.symbol)
+        # The id is set once, a retried write never duplicates the move
+        document = move.to_mongo()
+        document['_id'] = ObjectId()
+        self.pending.append(document)
+        snapshot = current().replays.board_snapshot(game, document['_id'])
+        if snapshot is not None:
+            self.snapshots.append(snapshot)
+        self.dirty = True
+        metrics.inc('actors.moves')
+        if game.status in [Game.STATUS_FINISHED, Game.STATUS_TIE]:
+            await self.flush()
+            await self.record(move)
+        elif self.timer is None:
+            self.timer = asyncio.get_event_loop().call_later(
+                self.registry.flush_delay, self.schedule_flush,
+            )
+        current().replies.notify(self.pk)
+
+    def schedule_flush(self):
+        self.timer = None
+        asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        """
+        Write the pending moves and the game. Failed writes are kept and
+        retried with the next flush.
+        :return:
+        """
+        async with self.flushing:
+            if not self.dirty:
+                return
+            # Moves may be played while writing, the snapshot is consistent
+            moves, self.pending = self.pending, []
+            snapshots, self.snapshots = self.snapshots, []
+            document = self.game.to_mongo()
+            self.dirty = False
+            try:
+                await self.write(moves, document)
+                await current().replays.write(snapshots)
+            except Exception:
+                self.pending = moves + self.pending
+                self.snapshots = snapshots + self.snapshots
+                self.dirty = True
+                metrics.inc('actors.flush.errors')
+                logger.exception('Flush of game %s failed', self.pk)
+                if self.timer is None:
+                    self.timer = asyncio.get_event_loop().call_later(
+                        self.registry.flush_delay, self.schedule_flush,
+                    )
+                return
+            metrics.inc('actors.flushes')
+
+    async def write(self, moves: list, document: dict):
+        """
+        :param list moves: raw moves, their ids are set
+        :param dict document: raw game
+        :return:
+        """
+        if moves:
+            try:
+                await GameMove.collection.insert_many(moves, ordered=False)
+            except BulkWriteError as error:
+                # Moves already written by a failed attempt
+                if any(failure['code'] != 11000 for failure in error.details['writeErrors']):
+                    raise
+        await Game.collection.replace_one({'_id': self.game.pk}, document)
+
+    async def record(self, move: GameMove):
+        """
+        Statistics and leaderboard of a game that ended
+        :param GameMove move: last move
+        :return:
+        """
+        winner = await record_game(self.game, str(move.player.pk))
+        if winner is not None:
+            leaderboard.update(str(winner['_id']), winner['victories'], winner['username'])
+
+
+class Actors:
+    """
+    Actors of the games owned by the worker
+    """
+    actor_class = GameActor
+
+    def __init__(self, enabled: bool = False, idle: float = 60, flush_delay: float = 1):
+        """
+        :param bool enabled: whether live games are played through actors
+        :param float idle: seconds without moves before an actor is evicted
+        :param float flush_delay: seconds a change may stay unwritten
+        """
+        self.enabled = enabled
+        self.idle = idle
+        self.flush_delay = flush_delay
+        # game id -> actor
+        self.actors = {}
+        # game id -> task of the evicted actor still writing the game
+        self.evicting = {}
+
+    def configure(self, enabled: bool, idle: float, flush_delay: float):
+        self.enabled = enabled
+        self.idle = idle
+        self.flush_delay = flush_delay
+
+    def discard(self, actor: GameActor):
+        if self.actors.get(actor.pk) is actor:
+            del self.actors[actor.pk]
+            self.evicting[actor.pk] = actor.task
+            actor.task.add_done_callback(lambda task: self.done(actor.pk, task))
+        metrics.set('actors.live', len(self.actors))
+
+    def done(self, pk: str, task: asyncio.Task):
+        if self.evicting.get(pk) is task:
+            del self.evicting[pk]
+
+    def actor(self, pk: str) -> GameActor:
+        actor = self.actors.get(pk)
+        if actor is None:
+            actor = self.actor_class(pk, self)
+            actor.task = asyncio.ensure_future(actor.run(self.evicting.get(pk)))
+            self.actors[pk] = actor
+            metrics.set('actors.live', len(self.actors))
+        return actor
+
+    async def submit(self, pk: str, data: dict, background: bool = False) -> dict:
+        """
+        Queue a move for the actor of the game
+        :param str pk: game id
+        :param dict data: body of the move
+        :param bool background: answer before the reply of the bot
+        :return dict: dumped game after the move
+        """
+        future = asyncio.get_event_loop().create_future()
+        self.actor(pk).queue.put_nowait((data, background, future))
+        return await future
+
+    def game(self, pk: str):
+        """
+        Authoritative game of a live actor
+        :param str pk:
+        :return Game: None when no actor of this worker owns the game
+        """
+        actor = self.actors.get(pk)
+        return actor.game if actor is not None else None
+
+    async def flush(self, pk: str):
+        """
+        Write a game of a live actor, so that mongo is up to date
+        :param str pk: game id
+        :return:
+        """
+        actor = self.actors.get(pk)
+        if actor is not None:
+            await actor.flush()
+
+    async def drain(self):
+        """
+        Write every live game, used when the worker stops
+        :return:
+        """
+        await asyncio.gather(*(actor.flush() for actor in list(self.actors.values())))
+
+
+actors = Actors()
+
+
+async def current_game(pk: str) -> Game:
+    """
+    Game of a live actor of the application, mongo or the archive otherwise
+    :param str pk:
+    :return Game:
+    """
+    game = current().actors.game(pk)
+    if game is None:
+        game = await find_game(pk)
+    return game
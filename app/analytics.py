@@ -0,0 +1,250 @@
+"""
+Opening analytics: how often every cell is played first and how the
+games it opens end, per board. The counters are computed by an
+aggregation over the games that ended since the last refresh and kept in
+a single document of the analytics collection along with the watermark,
+the newest move id already counted. Workers add their increments with a
+conditional update on the watermark, so a window is only counted once,
+and serve the report from an in-memory snapshot of the document.
+
+A game is counted in the window of its last move. Moves of the last
+GRACE seconds are left for the next refresh, the status of their game
+may not be written yet.
+
+Archived games (see app.archive) left mongo before the aggregation could
+see them: the first window, from the empty watermark, also counts the
+records of the archive. Games archived later were counted while in mongo.
+"""
+import asyncio
+import datetime
+import logging
+
+from bson import ObjectId
+
+from app.context import current
+from app.models import CELL_BASE, Game, GameMove, decode_cell, instance
+
+
+logger = logging.getLogger(__name__)
+
+DOCUMENT_ID = 'openings'
+GRACE = 5
+COUNTERS = ['games', 'wins', 'ties']
+
+
+def board_key(mode: str, size: int) -> str:
+    return '%s:%s' % (mode, size)
+
+
+def pipeline(watermark: ObjectId, upper: ObjectId) -> list:
+    """
+    Aggregation of the games whose last move is in the (watermark, upper)
+    range of move ids, grouped by board and opening cell. Wins are the
+    games won by the player who opened.
+    :param ObjectId watermark: newest move already counted
+    :param ObjectId upper: first move id left for the next refresh
+    :return list:
+    """
+    def edge_move(direction: int) -> dict:
+        return {'$lookup': {
+            'from': GameMove.collection.name,
+            'let': {'game': '$_id'},
+            'pipeline': [
+                {'$match': {'$expr': {'$eq': ['$g', '$$game']}}},
+                {'$sort': {'_id': direction}},
+                {'$limit': 1},
+                {'$project': {'c': 1, 's': 1}},
+            ],
+            'as': 'first' if direction == 1 else 'final',
+        }}
+
+    return [
+        {'$match': {'_id': {'$gt': watermark, '$lt': upper}}},
+        {'$group': {'_id': '$g', 'last': {'$max': '$_id'}}},
+        {'$lookup': {
+            'from': Game.collection.name,
+            'localField': '_id',
+            'foreignField': '_id',
+            'as': 'game',
+        }},
+        {'$unwind': '$game'},
+        {'$match': {
+            'game.status': {'$in': [Game.STATUS_FINISHED, Game.STATUS_TIE]},
+            'game.simulated': {'$ne': True},
+        }},
+        edge_move(-1),
+        {'$unwind': '$final'},
+        # Moves of the game after the window are counted with it later
+        {'$match': {'$expr': {'$eq': ['$final._id', '$last']}}},
+        edge_move(1),
+        {'$unwind': '$first'},
+        {'$group': {
+            '_id': {
+                'mode': {'$ifNull': ['$game.mode', Game.MODE_CLASSIC]},
+                'size': {'$ifNull': ['$game.size', 3]},
+                'row': {'$floor': {'$divide': ['$first.c', CELL_BASE]}},
+                'column': {'$mod': ['$first.c', CELL_BASE]},
+            },
+            'games': {'$sum': 1},
+            'wins': {'$sum': {'$cond': [
+                {'$and': [
+                    {'$eq': ['$game.status', Game.STATUS_FINISHED]},
+                    {'$eq': ['$final.s', '$first.s']},
+                ]}, 1, 0,
+            ]}},
+            'ties': {'$sum': {'$cond': [
+                {'$eq': ['$game.status', Game.STATUS_TIE]}, 1, 0,
+            ]}},
+        }},
+    ]
+
+
+def archived_rows(records) -> list:
+    """
+    Rows of the pipeline computed from archived records
+    :param records: {"game": raw game, "moves": raw moves in the order they were played}
+    :return list: same format as the result of the pipeline
+    """
+    rows = {}
+    for record in records:
+        game, moves = record['game'], record['moves']
+        status = game.get('status')
+        if game.get('simulated') or status not in [Game.STATUS_FINISHED, Game.STATUS_TIE] or not moves:
+            continue
+        first, final = moves[0], moves[-1]
+        cell = decode_cell(first['c'])
+        key = {
+            'mode': game.get('mode') or Game.MODE_CLASSIC,
+            'size': game.get('size') or 3,
+            'row': cell['row'],
+            'column': cell['column'],
+        }
+        row = rows.setdefault(
+            tuple(key.values()), {'_id': key, 'games': 0, 'wins': 0, 'ties': 0},
+        )
+        row['games'] += 1
+        if status == Game.STATUS_FINISHED and final['s'] == first['s']:
+            row['wins'] += 1
+        elif status == Game.STATUS_TIE:
+            row['ties'] += 1
+    return list(rows.values())
+
+
+def increments(rows: list) -> dict:
+    """
+    Update of the analytics document adding the aggregated rows
+    :param list rows: result of the pipeline, a board and cell may repeat
+    :return dict: path -> amount, for $inc
+    """
+    result = {}
+    for row in rows:
+        key = row['_id']
+        path = 'boards.%s.%s,%s' % (
+            board_key(key['mode'], key['size']), key['row'], key['column'],
+        )
+        for counter in COUNTERS:
+            if row[counter]:
+                name = '%s.%s' % (path, counter)
+                result[name] = result.get(name, 0) + row[counter]
+    return result
+
+
+class Openings:
+    """
+    In-memory snapshot of the opening analytics
+    """
+
+    def __init__(self):
+        self.watermark = None
+        self.boards = {}
+
+    def load(self, document: dict):
+        """
+        Replace the snapshot by the content of the analytics document
+        :param dict document:
+        :return:
+        """
+        self.watermark = document.get('watermark')
+        self.boards = document.get('boards', {})
+
+    async def refresh(self) -> int:
+        """
+        Count the games that ended since the watermark and reload the
+        snapshot
+        :return int: amount of games counted by this worker
+        """
+        collection = instance.db['analytics']
+        await collection.update_one(
+            {'_id': DOCUMENT_ID},
+            {'$setOnInsert': {'watermark': ObjectId('0' * 24), 'boards': {}}},
+            upsert=True,
+        )
+        document = await collection.find_one({'_id': DOCUMENT_ID})
+        watermark = document['watermark']
+        upper = ObjectId.from_datetime(
+            datetime.datetime.utcnow() - datetime.timedelta(seconds=GRACE),
+        )
+        counted = 0
+        if upper > watermark:
+            rows = await GameMove.collection.aggregate(pipeline(watermark, upper)).to_list(None)
+            if watermark == ObjectId('0' * 24):
+                rows += await asyncio.get_event_loop().run_in_executor(
+                    None, archived_rows, current().archive.records(),
+                )
+            update = {'$set': {'watermark': upper}}
+            if rows:
+                update['$inc'] = increments(rows)
+            result = await collection.update_one(
+                {'_id': DOCUMENT_ID, 'watermark': watermark},
+                update,
+            )
+            # Otherwise another worker counted the window first
+            if result.modified_count:
+                counted = sum(row['games'] for row in rows)
+                logger.info('Counted %s games in the opening analytics', counted)
+            document = await collection.find_one({'_id': DOCUMENT_ID})
+        self.load(document)
+        return counted
+
+    def report(self, size: int = None) -> dict:
+        """
+        Frequency of every opening cell and the rates of the outcomes
+        of the games it opened, seen from the player who opened
+        :param int size: only the boards of this size
+        :return dict:
+        """
+        boards = []
+        for key, cells in sorted(self.boards.items()):
+            mode, board_size = key.split(':')
+            if size is not None and int(board_size) != size:
+                continue
+            total = sum(counters.get('games', 0) for counters in cells.values())
+            openings = []
+            for cell, counters in cells.items():
+                row, column = cell.split(',')
+                games = counters.get('games', 0)
+                wins = counters.get('wins', 0)
+                ties = counters.get('ties', 0)
+                openings.append({
+                    'row': int(row),
+                    'column': int(column),
+                    'games': games,
+                    'frequency': games / total if total else 0,
+                    'win_rate': wins / games if games else 0,
+                    'tie_rate': ties / games if games else 0,
+                    'loss_rate': (games - wins - ties) / games if games else 0,
+                })
+            openings.sort(key=lambda opening: -opening['games'])
+            boards.append({
+                'mode': mode,
+                'size': int(board_size),
+                'games': total,
+                'openings': openings,
+            })
+        return {
+            'watermark': str(self.watermark) if self.watermark else None,
+            'boards': boards,
+        }
+
+
+openings = Openings()
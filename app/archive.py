@@ -0,0 +1,289 @@
+"""
+Cold storage of finished games. Games that finished and were created
+more than ARCHIVE_AGE seconds ago are moved, along with their moves, from
+mongo to compressed segment files in ARCHIVE_DIR, so they leave the
+working set and the indexes of the active games.
+
+A segment starts with a header, then holds one zlib compressed BSON
+record per game ({"game": ..., "moves": [...]}) and ends with the index
+of its records: the game ids sorted, with the offset and length of their
+record. The index is memory-mapped and searched by bisection, so reading
+an archived game costs a single read. Finished games never change, so
+segments are written once and never touched again.
+
+Workers archiving at the same time may store a game twice, lookups
+return either copy.
+"""
+import os
+import bson
+import glob
+import zlib
+import heapq
+import struct
+import asyncio
+import datetime
+import logging
+from collections import defaultdict
+
+import numpy as np
+from bson import ObjectId
+from tornado.web import HTTPError
+
+from app.context import current
+from app.metrics import metrics
+from app.models import Game, GameMove, GameSnapshot, compact_move
+from app.settings import Settings
+
+
+logger = logging.getLogger(__name__)
+
+# Magic, format version, amount of records and offset of the index
+MAGIC = b'TTTA'
+HEADER = struct.Struct('<4sB3xQQ')
+# Ids are stored in hex, numpy byte strings lose trailing null bytes
+INDEX_DTYPE = np.dtype([('id', 'S24'), ('offset', '<u8'), ('length', '<u4')])
+COMPRESSION = 6
+
+
+def write_segment(directory: str, records: list) -> str:
+    """
+    Write a segment with the given records. The file is written aside
+    and renamed, readers never see a partial segment.
+    :param str directory:
+    :param list records: {"game": raw game, "moves": raw moves}
+    :return str: path of the segment
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, 'segment-%s.seg' % ObjectId())
+    tmp = path + '.tmp'
+    index = np.zeros(len(records), dtype=INDEX_DTYPE)
+    with open(tmp, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, 1, 0, 0))
+        for position, record in enumerate(records):
+            data = zlib.compress(bson.encode(record), COMPRESSION)
+            index[position] = (str(record['game']['_id']).encode(), file.tell(), len(data))
+            file.write(data)
+        index.sort(order='id')
+        index_offset = file.tell()
+        file.write(index.tobytes())
+        file.seek(0)
+        file.write(HEADER.pack(MAGIC, 1, len(records), index_offset))
+    os.replace(tmp, path)
+    return path
+
+
+class Segment:
+    """
+    Read access to the records of a segment file
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as file:
+            magic, version, count, index_offset = HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC or version != 1:
+            raise ValueError('Not an archive segment: %s' % path)
+        self.index = np.memmap(
+            path, dtype=INDEX_DTYPE, mode='r', offset=index_offset, shape=(count,),
+        ) if count else np.zeros(0, dtype=INDEX_DTYPE)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def load(self, offset: int, length: int) -> dict:
+        with open(self.path, 'rb') as file:
+            file.seek(offset)
+            record = bson.decode(zlib.decompress(file.read(length)))
+        # Segments written before the moves were compacted
+        record['moves'] = [compact_move(move) for move in record['moves']]
+        return record
+
+    def get(self, pk: str):
+        """
+        Record of a game
+        :param str pk: game id in lowercase hex
+        :return dict: None when the game is not in the segment
+        """
+        ids = self.index['id']
+        key = pk.encode()
+        position = int(np.searchsorted(ids, key))
+        if position == len(ids) or ids[position] != key:
+            return None
+        entry = self.index[position]
+        return self.load(int(entry['offset']), int(entry['length']))
+
+    def __iter__(self):
+        for entry in np.sort(self.index, order='offset'):
+            yield self.load(int(entry['offset']), int(entry['length']))
+
+    def between(self, low: str = None, high: str = None):
+        """
+        Entries of the index in a range of ids, in the order of the ids
+        :param str low: first id included, lowercase hex
+        :param str high: first id excluded, lowercase hex
+        :return: generator of (id, segment, offset, length)
+        """
+        ids = self.index['id']
+        start = int(np.searchsorted(ids, low.encode())) if low else 0
+        end = int(np.searchsorted(ids, high.encode())) if high else len(ids)
+        for position in range(start, end):
+            entry = self.index[position]
+            yield entry['id'], self, int(entry['offset']), int(entry['length'])
+
+
+class Archive:
+    """
+    The segments of the archive directory. Segments written by other
+    workers are picked up when a game is not found in the known ones.
+    """
+
+    def __init__(self, directory: str = None, age: float = 2592000, batch_size: int = 1000):
+        """
+        :param str directory: where the segments live, None disables the archive
+        :param float age: seconds after the creation of a game before it is archived
+        :param int batch_size: games per segment
+        """
+        self.directory = directory
+        self.age = age
+        self.batch_size = batch_size
+        self.segments = {}
+
+    def configure(self, directory: str, age: float, batch_size: int):
+        self.directory = directory
+        self.age = age
+        self.batch_size = batch_size
+        self.segments = {}
+
+    def refresh(self):
+        """
+        Open the segments added to the directory since the last call
+        :return:
+        """
+        for path in glob.glob(os.path.join(self.directory, 'segment-*.seg')):
+            if path not in self.segments:
+                self.segments[path] = Segment(path)
+
+    def get(self, pk: str):
+        """
+        Archived record of a game
+        :param str pk: game id
+        :return dict: {"game": raw game, "moves": raw moves}, None when not archived
+        """
+        if not self.directory or not ObjectId.is_valid(pk):
+            return None
+        pk = str(ObjectId(pk))
+        self.refresh()
+        for segment in self.segments.values():
+            record = segment.get(pk)
+            if record is not None:
+                metrics.inc('archive.reads')
+                return record
+        return None
+
+    def records(self):
+        """
+        Every archived record, used by the offline jobs
+        :return: generator of {"game": raw game, "moves": raw moves}
+        """
+        if not self.directory:
+            return
+        self.refresh()
+        for segment in list(self.segments.values()):
+            yield from segment
+
+    def ordered(self, low: str = None, high: str = None):
+        """
+        Archived records in a range of ids, in the order of the ids. The
+        indexes of the segments are merged, a record is only read when
+        its turn comes and games stored twice are returned once.
+        :param str low: first id included
+        :param str high: first id excluded
+        :return: generator of {"game": raw game, "moves": raw moves}
+        """
+        if not self.directory:
+            return
+        self.refresh()
+        low = str(ObjectId(low)) if low else None
+        high = str(ObjectId(high)) if high else None
+        previous = None
+        for pk, segment, offset, length in heapq.merge(
+                *[segment.between(low, high) for segment in list(self.segments.values())],
+                key=lambda entry: entry[0],
+        ):
+            if pk != previous:
+                previous = pk
+                yield segment.load(offset, length)
+
+    async def archive_games(self) -> int:
+        """
+        Move the finished games older than the configured age, and their
+        moves, into new segments. The documents are removed once their
+        segment is written.
+        :return int: amount of games archived
+        """
+        if not self.directory:
+            return 0
+        # Ids carry the creation time of the games
+        cutoff = ObjectId.from_datetime(
+            datetime.datetime.utcnow() - datetime.timedelta(seconds=self.age),
+        )
+        archived = 0
+        while True:
+            games = await Game.collection.find({
+                'status': {'$in': [Game.STATUS_FINISHED, Game.STATUS_TIE]},
+                '_id': {'$lt': cutoff},
+            }).limit(self.batch_size).to_list(None)
+            if not games:
+                break
+            ids = [game['_id'] for game in games]
+            moves = defaultdict(list)
+            cursor = GameMove.collection.find(
+                {'g': {'$in': ids}},
+                sort=[('g', 1), ('_id', 1)],
+            )
+            async for move in cursor:
+                moves[move['g']].append(move)
+            records = [{'game': game, 'moves': moves[game['_id']]} for game in games]
+            path = await asyncio.get_event_loop().run_in_executor(
+                None, write_segment, self.directory, records,
+            )
+            await GameMove.collection.delete_many({'g': {'$in': ids}})
+            await GameSnapshot.collection.delete_many({'g': {'$in': ids}})
+            await Game.collection.delete_many({'_id': {'$in': ids}})
+            archived += len(games)
+            metrics.inc('archive.games', len(games))
+            logger.info('Archived %s games into %s', len(games), path)
+            if len(games) < self.batch_size:
+                break
+        return archived
+
+
+settings = Settings()
+archive = Archive(settings.archive_dir, settings.archive_age, settings.archive_batch_size)
+
+
+async def find_game(pk: str) -> Game:
+    """
+    Game from mongo, or from the archive once it was moved there
+    :param str pk:
+    :return Game:
+    """
+    try:
+        return await Game.find_by_id(pk)
+    except HTTPError as error:
+        record = current().archive.get(pk) if error.status_code == 404 else None
+        if record is None:
+            raise
+        return Game.build_from_mongo(record['game'])
+
+
+def archived_moves(pk: str) -> list:
+    """
+    Moves of an archived game
+    :param str pk:
+    :return list: GameMove documents, empty when the game is not archived
+    """
+    record = current().archive.get(pk)
+    if record is None:
+        return []
+    return [GameMove.build_from_mongo(move) for move in record['moves']]
@@ -0,0 +1,98 @@
+"""
+Vectorized judge for many classic boards at once, meant for offline
+analysis and self-play. Boards are int8 arrays of shape (N, size, size)
+where 0 is an empty cell, 1 is X and -1 is O. It follows the same rules
+as GameEngine: a player wins by filling a whole row, column or diagonal
+and a full board without winner is a tie.
+"""
+import functools
+import numpy as np
+
+
+EMPTY = 0
+X = 1
+O = -1
+
+SYMBOLS = {
+    '': EMPTY,
+    'X': X,
+    'O': O,
+}
+
+OUTCOME_ONGOING = 0
+OUTCOME_X = 1
+OUTCOME_O = 2
+OUTCOME_TIE = 3
+
+OUTCOMES = {
+    OUTCOME_ONGOING: 'ongoing',
+    OUTCOME_X: 'X',
+    OUTCOME_O: 'O',
+    OUTCOME_TIE: 'tie',
+}
+
+CHUNK_SIZE = 65536
+
+
+@functools.lru_cache(maxsize=None)
+def line_indices(size: int) -> np.ndarray:
+    """
+    Flat cell indices of every winning line of a board: the rows, the
+    columns and both diagonals. Computed once per size.
+    :param int size:
+    :return np.ndarray: (2 * size + 2, size) array of indices
+    """
+    cells = np.arange(size * size).reshape(size, size)
+    lines = np.concatenate([
+        cells,
+        cells.T,
+        np.diagonal(cells)[np.newaxis],
+        np.diagonal(np.fliplr(cells))[np.newaxis],
+    ])
+    lines.flags.writeable = False
+    return lines
+
+
+def encode(board) -> np.ndarray:
+    """
+    Convert a board as stored on a Game ('', 'X' or 'O' cells) into
+    its int8 representation
+    :param board: list of rows
+    :return np.ndarray: (size, size) int8 array
+    """
+    return np.array(
+        [[SYMBOLS[cell] for cell in row] for row in board],
+        dtype=np.int8,
+    )
+
+
+def judge(boards: np.ndarray, chunk_size: int = CHUNK_SIZE) -> np.ndarray:
+    """
+    Outcome of every board. Each winning line is summed: a sum of size
+    means X filled it and a sum of -size means O did. The boards are
+    processed in chunks to bound the memory used by the line gathering.
+    Boards where both players completed a line cannot be reached in a
+    real game, they are reported as won by X.
+    :param np.ndarray boards: (N, size, size) int8 array
+    :param int chunk_size: amount of boards judged at once
+    :return np.ndarray: (N,) int8 array of OUTCOME_* values
+    """
+    boards = np.asarray(boards, dtype=np.int8)
+    if boards.ndim != 3 or boards.shape[1] != boards.shape[2]:
+        raise ValueError('Boards must be an (N, size, size) array')
+    count, size = boards.shape[0], boards.shape[1]
+    lines = line_indices(size)
+    flat = boards.reshape(count, size * size)
+    outcomes = np.empty(count, dtype=np.int8)
+    for start in range(0, count, chunk_size):
+        chunk = flat[start:start + chunk_size]
+        sums = chunk[:, lines].sum(axis=2, dtype=np.int16)
+        result = np.where(
+            (chunk != EMPTY).all(axis=1),
+            OUTCOME_TIE,
+            OUTCOME_ONGOING,
+        ).astype(np.int8)
+        result[(sums == -size).any(axis=1)] = OUTCOME_O
+        result[(sums == size).any(axis=1)] = OUTCOME_X
+        outcomes[start:start + chunk_size] = result
+    return outcomes
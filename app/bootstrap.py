@@ -0,0 +1,152 @@
+"""
+Startup tasks of the application. They run concurrently once the
+worker is already accepting connections, and the readiness endpoint
+reports whether they are done.
+"""
+import asyncio
+import logging
+from app.models import User, Game, GameMove, GameSnapshot, instance
+from app.leaderboard import leaderboard
+from app.analytics import openings
+from app.context import current
+
+
+logger = logging.getLogger(__name__)
+
+
+async def ensure_bot_users():
+    """
+    Create the users of the registered bots
+    :return:
+    """
+    await current().bots.ensure_users()
+
+
+async def ensure_indexes():
+    """
+    Create the indexes of every collection
+    :return:
+    """
+    await asyncio.gather(
+        User.ensure_indexes(),
+        Game.ensure_indexes(),
+        GameMove.ensure_indexes(),
+        GameSnapshot.ensure_indexes(),
+    )
+
+
+async def rebuild_leaderboard():
+    """
+    Load the leaderboard from the users collection
+    :return:
+    """
+    await leaderboard.rebuild()
+
+
+async def resume_bot_replies():
+    """
+    Reply to the games whose bot move was lost with its worker
+    :return:
+    """
+    await current().replies.resume()
+
+
+async def archive_games():
+    """
+    Move the old finished games to the archive
+    :return:
+    """
+    await current().archive.archive_games()
+
+
+async def refresh_openings():
+    """
+    Count the games that ended since the last refresh in the opening
+    analytics and reload their snapshot
+    :return:
+    """
+    await openings.refresh()
+
+
+async def expire_tickets():
+    """
+    Drop the matchmaking tickets of the players that went away
+    :return:
+    """
+    current().matchmaking.expire()
+
+
+TASKS = [
+    ensure_bot_users,
+    ensure_indexes,
+    rebuild_leaderboard,
+    refresh_openings,
+]
+
+# Tasks run periodically once the bootstrap is done, along with the
+# name of the setting holding their interval in seconds.
+PERIODIC = [
+    (rebuild_leaderboard, 'leaderboard_refresh'),
+    (resume_bot_replies, 'bot_reply_timeout'),
+    (archive_games, 'archive_interval'),
+    (refresh_openings, 'analytics_refresh'),
+    (expire_tickets, 'matchmaking_timeout'),
+]
+
+
+class Bootstrap:
+    """
+    Runs the startup tasks of a worker and keeps track of their state
+    """
+
+    def __init__(self, tasks=None, retry: float = 2, periodic=None):
+        """
+        :param tasks: list of coroutine functions, TASKS by default
+        :param float retry: seconds to wait before retrying failed tasks
+        :param periodic: list of (coroutine function, interval setting), PERIODIC
+        by default
+        """
+        self.tasks = list(TASKS if tasks is None else tasks)
+        self.periodic = list(PERIODIC if periodic is None else periodic)
+        self.retry = retry
+        self.ready = False
+        self.errors = {}
+
+    async def run(self):
+        """
+        Run all the tasks concurrently. The failed ones are retried
+        until they succeed, mongo might not be reachable yet when the
+        container starts.
+        :return:
+        """
+        pending = list(self.tasks)
+        while pending:
+            results = await asyncio.gather(
+                *(task() for task in pending),
+                return_exceptions=True,
+            )
+            failed = []
+            for task, result in zip(pending, results):
+                if isinstance(result, Exception):
+                    logger.warning('Bootstrap %s failed: %s', task.__name__, result)
+                    self.errors[task.__name__] = str(result)
+                    failed.append(task)
+                else:
+                    self.errors.pop(task.__name__, None)
+            pending = failed
+            if pending:
+                await asyncio.sleep(self.retry)
+        self.ready = True
+
+
+async def ping(timeout: float = 1) -> bool:
+    """
+    Check that the database answers
+    :param float timeout: seconds to wait for the answer
+    :return bool:
+    """
+    try:
+        await asyncio.wait_for(instance.db.command('ping'), timeout)
+    except Exception:
+        return False
+    return True
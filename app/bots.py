@@ -0,0 +1,268 @@
+"""
+Registry of the bots players can face. Every bot is a user of its own
+tied to a strategy, a compute budget and the pool where its moves are
+computed. The registry is loaded once per worker from BOTS_FILE, a JSON
+list of bot definitions, or from DEFAULT_BOTS.
+"""
+import json
+import asyncio
+import logging
+from concurrent.futures import BrokenExecutor, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Tuple
+from pymongo import UpdateOne
+
+from app.engine import GameBot, RandomStrategy
+from app.metrics import metrics
+from app.models import User, Game, SparseBoard
+from app.selfplay import drive
+from app.strategies import get_strategy
+
+
+logger = logging.getLogger(__name__)
+
+# Strategies running on the event loop must be cheap, their budget
+# cannot interrupt them. The pools run them aside from the loop.
+POOL_INLINE = 'inline'
+POOL_THREAD = 'thread'
+POOL_PROCESS = 'process'
+
+POOLS = [
+    POOL_INLINE,
+    POOL_THREAD,
+    POOL_PROCESS,
+]
+
+DEFAULT_BOTS = [
+    {
+        'name': 'easy',
+        'username': 'tictactoeai',
+        'email': 'ai@robot.de',
+        'strategy': 'random',
+        'description': 'Plays at random',
+    },
+    {
+        'name': 'medium',
+        'username': 'tictactoeai-medium',
+        'strategy': 'qlearning',
+        'budget': 1,
+        'pool': POOL_THREAD,
+        'description': 'Learnt through self-play',
+    },
+    {
+        'name': 'perfect',
+        'username': 'tictactoeai-perfect',
+        'strategy': 'minimax',
+        'budget': 2,
+        'pool': POOL_PROCESS,
+        'description': 'Never loses on 3x3 boards',
+    },
+]
+
+
+def compute(strategy: str, symbol: str, size: int, board) -> Tuple[int, int]:
+    """
+    Compute a move, executed by the thread and process pools
+    :param str strategy: name of the strategy
+    :param str symbol:
+    :param int size:
+    :param board:
+    :return tuple: cell
+    """
+    return drive(get_strategy(strategy)(symbol, size, board).move())
+
+
+class Bot(GameBot):
+    """
+    Bot of the registry. Its user id is kept once known and its moves
+    are computed on its own pool, within its budget. Moves running out
+    of budget are replaced by a random one, and so is the pool, so the
+    next moves do not queue behind the one still running.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            username: str,
+            strategy: str = 'random',
+            budget: float = None,
+            pool: str = POOL_INLINE,
+            workers: int = 1,
+            email: str = None,
+            description: str = '',
+    ):
+        """
+        :param str name: name used to pick the bot
+        :param str username: user of the bot
+        :param str strategy: name of the strategy in app.strategies
+        :param float budget: seconds to compute a move, unlimited by default
+        :param str pool: inline, thread or process
+        :param int workers: size of the pool
+        :param str email: email of the user
+        :param str description:
+        """
+        if pool not in POOLS:
+            raise ValueError('Unknown pool %s for bot %s' % (pool, name))
+        super().__init__(username, get_strategy(strategy))
+        self.name = name
+        self.strategy_name = strategy
+        self.budget = budget
+        self.pool = pool
+        self.workers = workers
+        self.email = email or '%s@robot.de' % username
+        self.description = description
+        self.pk = None
+        self.executor = None
+
+    def get_executor(self):
+        """
+        Pool of the bot, created on first use so it belongs to the
+        worker process that uses it
+        :return: concurrent.futures executor
+        """
+        if self.executor is None:
+            cls = ProcessPoolExecutor if self.pool == POOL_PROCESS else ThreadPoolExecutor
+            self.executor = cls(max_workers=self.workers)
+        return self.executor
+
+    async def user_id(self) -> str:
+        if self.pk is None:
+            self.pk = await super().user_id()
+        return self.pk
+
+    async def choose(self, symbol: str, game: Game) -> Tuple[int, int]:
+        board = game.board_view()
+        if self.pool == POOL_INLINE:
+            task = self.strategy(symbol, game.size, board).move()
+        else:
+            # The pools get a plain copy, the ODM containers do not pickle
+            if game.sparse:
+                board = SparseBoard(dict(game.cells))
+            else:
+                board = [list(row) for row in game.board]
+            task = asyncio.get_event_loop().run_in_executor(
+                self.get_executor(),
+                compute,
+                self.strategy_name,
+                symbol,
+                game.size,
+                board,
+            )
+        metrics.inc('bots.%s.moves' % self.name)
+        try:
+            return await asyncio.wait_for(task, self.budget)
+        except asyncio.TimeoutError:
+            metrics.inc('bots.%s.timeouts' % self.name)
+            logger.warning('Bot %s ran out of budget', self.name)
+            if self.pool != POOL_INLINE:
+                self.retire_executor()
+        except BrokenExecutor:
+            # Moves sharing a pool that was just retired
+            logger.warning('Pool of bot %s was replaced during a move', self.name)
+        return await RandomStrategy(symbol, game.size, board).move()
+
+    def retire_executor(self):
+        """
+        Drop the pool of the bot, the next move creates another one. The
+        processes of a process pool are stopped; threads cannot be, they
+        finish their move aside.
+        :return:
+        """
+        executor, self.executor = self.executor, None
+        if executor is None:
+            return
+        if isinstance(executor, ProcessPoolExecutor):
+            # The executor has no way to stop a running call. Once its
+            # processes are gone, shutting it down does not wait.
+            for process in list((executor._processes or {}).values()):
+                process.terminate()
+            executor.shutdown(wait=True)
+        else:
+            executor.shutdown(wait=False)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    def describe(self) -> dict:
+        return {
+            'name': self.name,
+            'username': self.botname,
+            'strategy': self.strategy_name,
+            'budget': self.budget,
+            'description': self.description,
+        }
+
+
+class BotRegistry:
+    """
+    Bots available by name, along with the one games get by default
+    """
+
+    def __init__(self):
+        self.bots = {}
+        self.default = None
+
+    def configure(self, settings):
+        """
+        Load the bot definitions
+        :param Settings settings:
+        :return:
+        """
+        definitions = DEFAULT_BOTS
+        if settings.bots_file:
+            with open(settings.bots_file) as file:
+                definitions = json.load(file)
+        bots = {}
+        for definition in definitions:
+            bot = Bot(**definition)
+            bots[bot.name] = bot
+        if settings.default_bot not in bots:
+            raise ValueError('Unknown default bot %s' % settings.default_bot)
+        self.shutdown()
+        self.bots = bots
+        self.default = settings.default_bot
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.bots
+
+    def __iter__(self):
+        return iter(self.bots.values())
+
+    def get(self, name: str = None) -> Bot:
+        """
+        Bot of a game. Games of a bot that was removed from the
+        registry get the default one.
+        :param str name:
+        :return Bot:
+        """
+        return self.bots.get(name) or self.bots[self.default]
+
+    async def ensure_users(self):
+        """
+        Create the users of the bots and keep their ids. It is an upsert
+        so several workers can run it at the same time.
+        :return:
+        """
+        await User.collection.bulk_write([
+            UpdateOne(
+                {'username': bot.botname},
+                {'$setOnInsert': User(username=bot.botname, email=bot.email).to_mongo()},
+                upsert=True,
+            )
+            for bot in self
+        ], ordered=False)
+        usernames = {bot.botname: bot for bot in self}
+        cursor = User.collection.find(
+            {'username': {'$in': list(usernames)}},
+            {'username': 1},
+        )
+        async for document in cursor:
+            usernames[document['username']].pk = str(document['_id'])
+
+    def shutdown(self):
+        for bot in self:
+            bot.shutdown()
+
+
+bots = BotRegistry()
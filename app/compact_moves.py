@@ -0,0 +1,167 @@
+"""
+Migration of the moves collection to the compact schema of GameMove:
+short field names, the cell as a single integer and no created_at, the
+time of the id. The documents are rewritten in batches, in the order of
+their ids; rewritten documents no longer match the query, so a stopped
+migration is resumed by running it again.
+
+    python -m app.compact_moves --batch-size 1000
+    python -m app.compact_moves --measure 100000
+
+Run it with the workers stopped: the new version only finds the moves
+of a game once they are migrated. The indexes of the legacy field names
+are replaced at the end. The report compares the collection statistics
+before and after, per million moves; --measure compares the size of the
+two schemas on generated moves, without a database.
+"""
+import sys
+import json
+import random
+import asyncio
+import argparse
+import datetime
+
+import bson
+from bson import ObjectId
+from pymongo import ReplaceOne
+from pymongo.errors import OperationFailure
+
+from app.models import GameMove, compact_move, instance
+
+
+LEGACY_QUERY = {'$or': [
+    {'game': {'$exists': True}},
+    {'cell': {'$exists': True}},
+    {'created_at': {'$exists': True}},
+    {'c': {'$type': 'object'}},
+]}
+LEGACY_INDEXES = ['game_1__id_1', 'game_1_idempotency_key_1']
+MILLION = 1000000
+
+
+async def statistics() -> dict:
+    """
+    Size of the moves collection and of its indexes
+    :return dict:
+    """
+    stats = await instance.db.command('collStats', GameMove.collection.name)
+    return {
+        'count': stats.get('count', 0),
+        'size': stats.get('size', 0),
+        'storage_size': stats.get('storageSize', 0),
+        'index_size': stats.get('totalIndexSize', 0),
+    }
+
+
+def per_million(before: dict, after: dict) -> dict:
+    """
+    Bytes saved for every million moves
+    :param dict before: statistics before the migration
+    :param dict after: statistics after it
+    :return dict:
+    """
+    count = after['count'] or before['count']
+    if not count:
+        return {}
+    return {
+        key: (before[key] - after[key]) * MILLION // count
+        for key in ('size', 'storage_size', 'index_size')
+    }
+
+
+async def migrate(batch_size: int = 1000, progress=None) -> int:
+    """
+    Rewrite the legacy moves and replace the legacy indexes
+    :param int batch_size: documents per bulk write
+    :param progress: optional callable receiving the amount of moves rewritten
+    :return int: amount of moves rewritten
+    """
+    collection = GameMove.collection
+    rewritten = 0
+    query = dict(LEGACY_QUERY)
+    while True:
+        documents = await collection.find(query, sort=[('_id', 1)]).limit(batch_size).to_list(None)
+        if not documents:
+            break
+        await collection.bulk_write([
+            ReplaceOne({'_id': document['_id']}, compact_move(document))
+            for document in documents
+        ], ordered=False)
+        rewritten += len(documents)
+        if progress:
+            progress(rewritten)
+        query = {'$and': [LEGACY_QUERY, {'_id': {'$gt': documents[-1]['_id']}}]}
+    await GameMove.ensure_indexes()
+    for name in LEGACY_INDEXES:
+        try:
+            await collection.drop_index(name)
+        except OperationFailure:
+            pass
+    return rewritten
+
+
+def measure(count: int = 100000, size: int = 3, seed: int = 0) -> dict:
+    """
+    Average BSON size of a move in each schema, on generated moves
+    :param int count: amount of moves
+    :param int size: size of the board
+    :param int seed:
+    :return dict: bytes per move and per million moves
+    """
+    generator = random.Random(seed)
+    games = [ObjectId() for _ in range(max(count // (size * size), 1))]
+    players = [ObjectId() for _ in range(2)]
+    legacy = compact = 0
+    for index in range(count):
+        document = {
+            '_id': ObjectId(),
+            'game': games[index % len(games)],
+            'cell': {'row': generator.randrange(size), 'column': generator.randrange(size)},
+            'symbol': 'XO'[index % 2],
+            'player': players[index % 2],
+            'created_at': datetime.datetime.now(),
+        }
+        legacy += len(bson.encode(document))
+        compact += len(bson.encode(compact_move(document)))
+    return {
+        'legacy_bytes': legacy / count,
+        'compact_bytes': compact / count,
+        'saved_per_million': (legacy - compact) * MILLION // count,
+    }
+
+
+async def run(batch_size: int) -> dict:
+    before = await statistics()
+
+    def progress(rewritten):
+        sys.stderr.write('\r%s moves' % rewritten)
+
+    rewritten = await migrate(batch_size, progress)
+    sys.stderr.write('\n')
+    after = await statistics()
+    return {
+        'rewritten': rewritten,
+        'before': before,
+        'after': after,
+        'saved_per_million': per_million(before, after),
+    }
+
+
+def main():
+    """
+    Command line entry point
+    :return:
+    """
+    parser = argparse.ArgumentParser(description='Rewrite the moves in the compact schema')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--measure', type=int, default=None, metavar='MOVES',
+                        help='compare both schemas on generated moves instead')
+    arguments = parser.parse_args()
+    if arguments.measure:
+        print(json.dumps(measure(arguments.measure)))
+        return
+    print(json.dumps(asyncio.run(run(arguments.batch_size))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Services of an application: the bots, the background replies, the
+player cache, the archive, the matchmaking queues, the game actors, the
+idempotency store and the replays. Every application built by
+app.urls.make_app gets its own, so two applications of a process do not
+see each other's queues, caches or bots.
+
+The handlers activate the context of their application for the request,
+the tasks they start inherit it; code shared with the command line tools
+reads the active one with current(). Outside of any application, it is
+the context of the module singletons (app.bots.bots, app.replies.replies,
+...), which app.urls.application serves.
+"""
+import contextvars
+
+from app.settings import Settings
+
+
+_active = contextvars.ContextVar('context', default=None)
+_process = None
+
+
+class Context:
+    """
+    Services of an application, along with its configuration
+    """
+
+    def __init__(self, settings, bots, replies, players, archive, matchmaking, actors,
+                 idempotency, replays):
+        self.settings = settings
+        self.bots = bots
+        self.replies = replies
+        self.players = players
+        self.archive = archive
+        self.matchmaking = matchmaking
+        self.actors = actors
+        self.idempotency = idempotency
+        self.replays = replays
+
+    @classmethod
+    def create(cls, settings: Settings = None) -> 'Context':
+        """
+        Context with services of its own
+        :param Settings settings: configuration, taken from the environment by default
+        :return Context:
+        """
+        from app.bots import BotRegistry
+        from app.replies import Replies
+        from app.players import PlayerCache
+        from app.archive import Archive
+        from app.matchmaking import Matchmaking
+        from app.actors import Actors
+        from app.idempotency import IdempotencyStore
+        from app.replay import Replays
+
+        context = cls(
+            settings or Settings(),
+            BotRegistry(),
+            Replies(),
+            PlayerCache(),
+            Archive(),
+            Matchmaking(),
+            Actors(),
+            IdempotencyStore(),
+            Replays(),
+        )
+        context.configure(context.settings)
+        return context
+
+    @classmethod
+    def process(cls, settings: Settings = None) -> 'Context':
+        """
+        Context of the module singletons
+        :param Settings settings: configuration applied to them, if any
+        :return Context:
+        """
+        global _process
+        if _process is None:
+            from app.bots import bots
+            from app.replies import replies
+            from app.players import players
+            from app.archive import archive
+            from app.matchmaking import matchmaking
+            from app.actors import actors
+            from app.idempotency import idempotency
+            from app.replay import replays
+
+            _process = cls(
+                Settings(), bots, replies, players, archive, matchmaking, actors,
+                idempotency, replays,
+            )
+        if settings is not None:
+            _process.configure(settings)
+        return _process
+
+    def configure(self, settings: Settings):
+        """
+        Apply a configuration to the services
+        :param Settings settings:
+        :return:
+        """
+        self.settings = settings
+        self.bots.configure(settings)
+        self.replies.configure(settings.bot_reply_timeout)
+        self.players.configure(settings.player_cache_size, settings.player_cache_ttl)
+        self.archive.configure(settings.archive_dir, settings.archive_age, settings.archive_batch_size)
+        self.matchmaking.configure(settings.matchmaking_timeout)
+        self.actors.configure(settings.game_actors, settings.actor_idle, settings.actor_flush)
+        self.idempotency.configure(settings.idempotency_size, settings.idempotency_ttl)
+        self.replays.configure(settings.snapshot_interval, settings.replay_cache_size)
+
+
+def activate(context: Context):
+    """
+    Make a context the active one of the running task and of the tasks it starts
+    :param Context context:
+    :return:
+    """
+    _active.set(context)
+
+
+def current() -> Context:
+    """
+    :return Context: active context, the one of the module singletons by default
+    """
+    return _active.get() or Context.process()
@@ -2,11 +2,49 @@
 The collection of classes and methods to actually play the game
 """
 import asyncio
+import datetime
 import random
 import abc
 from typing import Tuple
 from tornado.web import HTTPError
+from umongo.exceptions import UpdateError
 from app.models import Game, GameMove, User
+from app.leaderboard import leaderboard
+from app.context import current
+from app.stats import record_game
+
+
+DIRECTIONS = [(0, 1), (1, 0), (1, 1), (1, -1)]
+
+
+def winning_move(get_cell, size: int, row: int, column: int, length: int) -> bool:
+    """
+    Check whether the symbol placed on (row, column) completes a run of
+    the given length. Only the lines crossing the cell are walked, and
+    never further than length - 1 cells on each side, so it costs O(k).
+    :param get_cell: callable (row, column) -> symbol, empty when free
+    :param int size: size of the board
+    :param int row: row of the last move
+    :param int column: column of the last move
+    :param int length: symbols in a row needed to win
+    :return bool:
+    """
+    symbol = get_cell(row, column)
+    if symbol == '':
+        return False
+    for row_step, column_step in DIRECTIONS:
+        count = 1
+        for sign in (1, -1):
+            i = row + sign * row_step
+            j = column + sign * column_step
+            while 0 <= i < size and 0 <= j < size and count < length \
+                    and get_cell(i, j) == symbol:
+                count += 1
+                i += sign * row_step
+                j += sign * column_step
+        if count >= length:
+            return True
+    return False
 
 
 class GameEngine:
@@ -14,12 +52,22 @@ class GameEngine:
     This class handles how the winners are calculated and the rule
     enforcing of the game
     """
-    async def execute_move(self, game: Game, move: GameMove) -> Game:
+    async def execute_move(
+            self,
+            game: Game,
+            move: GameMove,
+            reply_pending: bool = False,
+            keep_claim: bool = False,
+    ) -> Game:
         """
         Execute a move specified by the user considering the restrictions
         and the game winning calculation.
         :param Game game:
         :param GameMove move:
+        :param bool reply_pending: the bot replies in the background, the
+        game is marked as waiting for it in the same write as the move
+        :param bool keep_claim: the turn claimed by the player stays locked
+        for the reply of the bot, while the game goes on
         :return Game:
         """
         user = await User.find_by_id(move.player.pk.__str__())
@@ -29,9 +77,9 @@ class GameEngine:
                 412,
                 'Invalid move'
             )
-        game.board[move.cell.get('row')][move.cell.get('column')] = move.symbol
+        game.set_cell(move.cell.get('row'), move.cell.get('column'), move.symbol)
         game.status = Game.STATUS_IN_PROGRESS
-        return await self.validate_board(game, move, user)
+        return await self.validate_board(game, move, user, reply_pending, keep_claim)
 
     async def __validate_player_move(self, game: Game, move: GameMove) -> bool:
         """
@@ -44,11 +92,14 @@ class GameEngine:
         :param GameMove move:
         :return bool:
         """
-        limit = game.size - 1
-        if move.cell.get('row') > limit or  move.cell.get('column') > limit:
+        row = move.cell.get('row')
+        column = move.cell.get('column')
+        if not isinstance(row, int) or not isinstance(column, int):
+            return False
+        if not 0 <= row < game.size or not 0 <= column < game.size:
             return False
 
-        if game.board[move.cell.get('row')][move.cell.get('column')] != '':
+        if game.get_cell(row, column) != '':
             return False
 
         prev_move = await GameMove.find_one(
@@ -151,6 +202,8 @@ class GameEngine:
         :param Game game:
         :return bool:
         """
+        if game.sparse:
+            return game.count_moves() == game.size * game.size
         tie = True
         for i in range(game.size):
             for j in range(game.size):
@@ -160,34 +213,89 @@ class GameEngine:
                     break
         return tie
 
-    async def validate_board(self, game: Game, move: GameMove, user: User) -> Game:
+    async def evaluate(self, game: Game, move: GameMove = None) -> str:
+        """
+        Status of the board after a move, without persisting anything.
+        The last move is required on sparse boards, where only the lines
+        crossing it are checked.
+        :param Game game:
+        :param GameMove move: last move played
+        :return str: finished, tie or in_progress
+        """
+        if game.sparse:
+            win_validations = [winning_move(
+                game.get_cell,
+                game.size,
+                move.cell.get('row'),
+                move.cell.get('column'),
+                game.win_length,
+            )]
+        else:
+            win_validations = await asyncio.gather(
+                self.__validate_right_diagonal(game),
+                self.__validate_left_diagonal(game),
+                self.__validate_columns(game),
+                self.__validate_rows(game),
+            )
+        if True in win_validations:
+            return Game.STATUS_FINISHED
+        if await self.__validate_tie(game):
+            return Game.STATUS_TIE
+        return Game.STATUS_IN_PROGRESS
+
+    async def validate_board(
+            self,
+            game: Game,
+            move: GameMove,
+            user: User,
+            reply_pending: bool = False,
+            keep_claim: bool = False,
+    ) -> Game:
         """
         Validate if the board to check if there are winners or if
-        there is a tie.
+        there is a tie. The game of a claimed turn (see Game.claim_turn)
+        is only written while the claim holds, before the move, and the
+        write releases it.
         :param Game game:
         :param GameMove move:
         :param User user:
+        :param bool reply_pending: see execute_move
+        :param bool keep_claim: see execute_move
         :return Game:
         """
-        win_validations = await asyncio.gather(
-            self.__validate_right_diagonal(game),
-            self.__validate_left_diagonal(game),
-            self.__validate_columns(game),
-            self.__validate_rows(game),
-        )
-        tasks = [asyncio.create_task(move.commit())]
-        if True in win_validations:
-            game.status = Game.STATUS_FINISHED
+        game.status = await self.evaluate(game, move)
+        if game.status == Game.STATUS_FINISHED:
             game.winner = move.player
-            user.victories += 1
+        game.version = (game.version or 0) + 1
+        if reply_pending and game.status == Game.STATUS_IN_PROGRESS:
+            game.bot_pending_since = datetime.datetime.utcnow()
+        elif game.bot_pending_since is not None:
+            del game.bot_pending_since
+
+        claim = game.move_pending_since
+        tasks = []
+        if claim is None:
+            tasks.append(asyncio.create_task(game.commit()))
+        else:
+            if not keep_claim or game.status != Game.STATUS_IN_PROGRESS:
+                del game.move_pending_since
+            try:
+                # Nothing is written once another move took the turn over
+                await game.commit(conditions={'move_pending_since': claim})
+            except UpdateError:
+                raise HTTPError(409, 'The turn was taken over by another move')
+        tasks.append(asyncio.create_task(move.commit()))
+        if game.status in [Game.STATUS_FINISHED, Game.STATUS_TIE]:
             tasks.append(asyncio.create_task(
-                user.commit()
+                record_game(game, str(move.player.pk))
             ))
-        elif await self.__validate_tie(game):
-            game.status = Game.STATUS_TIE
-
-        tasks.append(asyncio.create_task(game.commit()))
-        await asyncio.gather(*tasks)
+        results = await asyncio.gather(*tasks)
+        # The move has its id once written
+        await current().replays.take(game, move.pk)
+        # The document of the winner may be gone, the game is still over
+        if game.status == Game.STATUS_FINISHED and results[-1] is not None:
+            user.victories = results[-1]['victories']
+            leaderboard.update(str(user.pk), user.victories, user.username)
         return game
 
 
@@ -197,18 +305,24 @@ class AbstractBotStrategy(abc.ABC):
     must implement this class to allow us to ensure the consistency
     across different moving algorithms.
     """
+    # Whether the strategy only indexes the board, which is needed to
+    # play the sparse boards of gomoku games
+    sparse = False
 
-    def __init__(self, symbol: str, size: int, board):
+    def __init__(self, symbol: str, size: int, board, rng: random.Random = None):
         """
         Assigns the base elements necessary for the execution of a
         strategy or moving algorithm by the bots.
         :param str symbol: Symbol for the bot on the next move
         :param int size: Size of the board
         :param board: current state of the game board
+        :param random.Random rng: source of the random choices, the global
+        one of the random module by default
         """
         self.symbol = symbol
         self.size = size
         self.board = board
+        self.random = rng or random
 
     @abc.abstractmethod
     async def move(self) -> Tuple[int, int]:
@@ -223,14 +337,21 @@ class RandomStrategy(AbstractBotStrategy):
     Algorithm to decide which cell to fill based on a random pick
     between all the currently available cells.
     """
+    sparse = True
 
     async def move(self) -> Tuple[int, int]:
+        # Big sparse boards are mostly empty, a few random probes find a
+        # free cell without walking the whole board.
+        for _ in range(self.size):
+            cell = (self.random.randrange(self.size), self.random.randrange(self.size))
+            if self.board[cell[0]][cell[1]] == '':
+                return cell
         available_cells = []
         for i in range(self.size):
             for j in range(self.size):
                 if self.board[i][j] == '':
                     available_cells.append((i, j))
-        return random.choice(available_cells)
+        return self.random.choice(available_cells)
 
 
 class GameBot:
@@ -254,6 +375,27 @@ class GameBot:
         self.botname = botname
         self.strategy = strategy
 
+    async def user_id(self) -> str:
+        """
+        Id of the user of the bot
+        :return str:
+        """
+        user = await User.find_one({'username': self.botname})
+        return user.pk.__str__()
+
+    async def choose(self, symbol: str, game: Game) -> Tuple[int, int]:
+        """
+        Cell picked by the strategy
+        :param str symbol: symbol of the bot
+        :param Game game:
+        :return Tuple: cell
+        """
+        return await self.strategy(
+            symbol,
+            game.size,
+            game.board_view(),
+        ).move()
+
     async def move(self, game: Game, prev_move: GameMove) -> GameMove:
         """
         Return a move made by the AI. The move can be calculated based on different
@@ -263,19 +405,14 @@ class GameBot:
         :param GameMove prev_move: user move
         :return GameMove: bot move
         """
-        user = await User.find_one({'username': self.botname})
         symbol = list(filter(
             lambda x: x != prev_move.symbol,
             GameMove.SYMBOLS,
         ))[0]
-        cell = await self.strategy(
-            symbol,
-            game.size,
-            game.board,
-        ).move()
+        cell = await self.choose(symbol, game)
         data = {
             'symbol': symbol,
-            'player': user.pk.__str__(),
+            'player': await self.user_id(),
             'cell': {
                 'row': cell[0],
                 'column': cell[1],
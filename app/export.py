@@ -0,0 +1,408 @@
+"""
+Export of the game history for analytics: the games joined with their
+moves, read in batches in the order of their ids so the memory used does
+not depend on the size of the history.
+
+    python -m app.export --output games.ndjson --since 2026-01-01 --status finished tie
+    python -m app.export --format columns --output games/ --checkpoint games.checkpoint
+
+Every game is exported after the ones created before it, so an export is
+resumed from the id of the last game written. Archived games (see
+app.archive) are merged in the order of their ids with the ones of mongo. With --checkpoint the id
+is stored after every batch and the output is appended to on restart; a
+crash may repeat the last batch, never skip one.
+
+The columns format is a directory with a raw little-endian array per
+column (see GAME_COLUMNS and MOVE_COLUMNS), read with numpy.fromfile.
+The moves of a game are the rows moves_start to moves_start +
+moves_count of the move columns.
+"""
+import os
+import sys
+import json
+import asyncio
+import argparse
+import datetime
+from collections import defaultdict
+
+import numpy as np
+from bson import ObjectId
+
+from app.context import current
+from app.models import Game, GameMove, decode_cell
+
+
+FORMAT_NDJSON = 'ndjson'
+FORMAT_COLUMNS = 'columns'
+
+GAME_COLUMNS = [
+    ('id', 'S24'),
+    ('created', '<i8'),
+    ('status', 'S11'),
+    ('mode', 'S7'),
+    ('size', '<u2'),
+    ('win_length', '<u2'),
+    ('player_one', 'S24'),
+    ('player_two', 'S24'),
+    ('winner', 'S24'),
+    ('bot', 'S32'),
+    ('simulated', '?'),
+    ('moves_start', '<u8'),
+    ('moves_count', '<u4'),
+]
+MOVE_COLUMNS = [
+    ('game', 'S24'),
+    ('row', '<u2'),
+    ('column', '<u2'),
+    ('symbol', 'S1'),
+    ('player', 'S24'),
+]
+
+
+def make_query(since: datetime.datetime = None, until: datetime.datetime = None,
+               statuses: list = None, after: str = None) -> dict:
+    """
+    Filter of the exported games. The creation time of a game is the
+    one of its id, so the range is an id range on the primary index.
+    :param datetime since: first creation time included, UTC
+    :param datetime until: first creation time excluded, UTC
+    :param list statuses: statuses of the games, any by default
+    :param str after: id of the last game already exported
+    :return dict:
+    """
+    for status in statuses or []:
+        if status not in Game.STATUS:
+            raise ValueError('Unknown status %s' % status)
+    bounds = {}
+    if since is not None:
+        bounds['$gte'] = ObjectId.from_datetime(since)
+    if until is not None:
+        bounds['$lt'] = ObjectId.from_datetime(until)
+    if after is not None:
+        bounds['$gt'] = ObjectId(after)
+    query = {}
+    if bounds:
+        query['_id'] = bounds
+    if statuses:
+        query['status'] = {'$in': list(statuses)}
+    return query
+
+
+async def stored(query: dict, batch_size: int = 500):
+    """
+    Games of mongo matching the query along with their moves, in the
+    order of their ids. Every batch reads its moves with a single query.
+    :param dict query: see make_query
+    :param int batch_size: amount of games read at once
+    :return: async generator of (raw game, raw moves)
+    """
+    query = dict(query)
+    while True:
+        games = await Game.collection.find(
+            query,
+            sort=[('_id', 1)],
+        ).limit(batch_size).to_list(None)
+        if not games:
+            return
+        moves = defaultdict(list)
+        cursor = GameMove.collection.find(
+            {'g': {'$in': [game['_id'] for game in games]}},
+            sort=[('g', 1), ('_id', 1)],
+        )
+        async for move in cursor:
+            moves[move['g']].append(move)
+        for game in games:
+            yield game, moves[game['_id']]
+        if len(games) < batch_size:
+            return
+        bounds = dict(query.get('_id', {}))
+        bounds['$gt'] = games[-1]['_id']
+        query['_id'] = bounds
+
+
+def archived(query: dict):
+    """
+    Archived games matching the query along with their moves, in the
+    order of their ids
+    :param dict query: see make_query
+    :return: generator of (raw game, raw moves)
+    """
+    bounds = query.get('_id', {})
+    low = bounds.get('$gte')
+    if '$gt' in bounds:
+        following = ObjectId('%024x' % (int(str(bounds['$gt']), 16) + 1))
+        low = following if low is None else max(low, following)
+    statuses = query.get('status', {}).get('$in')
+    for record in current().archive.ordered(low, bounds.get('$lt')):
+        if statuses is None or record['game'].get('status') in statuses:
+            yield record['game'], record['moves']
+
+
+async def batches(query: dict, batch_size: int = 500):
+    """
+    Games matching the query along with their moves, in the order of
+    their ids, from mongo and from the archive. A game being archived
+    may be found in both, it is exported once.
+    :param dict query: see make_query
+    :param int batch_size: amount of games per batch
+    :return: async generator of lists of (raw game, raw moves)
+    """
+    cold = archived(query)
+    following = next(cold, None)
+    batch = []
+    async for game, moves in stored(query, batch_size):
+        while following is not None and following[0]['_id'] <= game['_id']:
+            if following[0]['_id'] != game['_id']:
+                batch.append(following)
+            following = next(cold, None)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        batch.append((game, moves))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    while following is not None:
+        batch.append(following)
+        following = next(cold, None)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def ndjson_lines(batch: list) -> str:
+    """
+    One line per game: the game as served by the API with its moves
+    :param list batch: (raw game, raw moves)
+    :return str:
+    """
+    lines = []
+    for game, moves in batch:
+        data = Game.build_from_mongo(game).dump()
+        data['moves'] = [GameMove.build_from_mongo(move).dump() for move in moves]
+        lines.append(json.dumps(data, separators=(',', ':')))
+        lines.append('\n')
+    return ''.join(lines)
+
+
+class ColumnsWriter:
+    """
+    Appends the batches to the column files of a directory
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, 'schema.json'), 'w') as file:
+            json.dump({'games': GAME_COLUMNS, 'moves': MOVE_COLUMNS}, file)
+        self.moves_written = self.repair()
+
+    def path(self, table: str, column: str) -> str:
+        return os.path.join(self.directory, '%s.%s' % (table, column))
+
+    def rows(self, table: str, columns: list) -> int:
+        """
+        Amount of rows written to every column of a table
+        :return int:
+        """
+        counts = []
+        for column, dtype in columns:
+            path = self.path(table, column)
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            counts.append(size // np.dtype(dtype).itemsize)
+        return min(counts)
+
+    def truncate(self, table: str, columns: list, rows: int):
+        for column, dtype in columns:
+            path = self.path(table, column)
+            if os.path.exists(path):
+                os.truncate(path, rows * np.dtype(dtype).itemsize)
+
+    def repair(self) -> int:
+        """
+        Drop the rows of a batch that was not completely written, so
+        every column of a resumed export stays aligned. The moves of a
+        batch are written before its games, games whose moves are not
+        all there are dropped as well.
+        :return int: amount of moves kept
+        """
+        games = self.rows('games', GAME_COLUMNS)
+        moves = 0
+        if games:
+            columns = dict(GAME_COLUMNS)
+            starts, counts = (
+                np.memmap(self.path('games', column), dtype=columns[column], mode='r', shape=(games,))
+                for column in ('moves_start', 'moves_count')
+            )
+            ends = starts.astype(np.int64) + counts
+            games = int(np.searchsorted(ends, self.rows('moves', MOVE_COLUMNS), side='right'))
+            moves = int(ends[games - 1]) if games else 0
+            del starts, counts
+        self.truncate('games', GAME_COLUMNS, games)
+        self.truncate('moves', MOVE_COLUMNS, moves)
+        return moves
+
+    def write(self, batch: list):
+        games = np.zeros(len(batch), dtype=GAME_COLUMNS)
+        moves = np.zeros(sum(len(game_moves) for _, game_moves in batch), dtype=MOVE_COLUMNS)
+        position = 0
+        for index, (game, game_moves) in enumerate(batch):
+            players = [str(player) for player in game.get('players', [])] + ['', '']
+            games[index] = (
+                str(game['_id']),
+                int(game['_id'].generation_time.timestamp()),
+                game.get('status', ''),
+                game.get('mode', Game.MODE_CLASSIC),
+                game.get('size', 3),
+                game.get('win_length') or game.get('size', 3),
+                players[0],
+                players[1],
+                str(game.get('winner') or ''),
+                game.get('bot') or '',
+                bool(game.get('simulated')),
+                self.moves_written + position,
+                len(game_moves),
+            )
+            for move in game_moves:
+                cell = decode_cell(move.get('c', {}))
+                moves[position] = (
+                    str(game['_id']),
+                    cell.get('row', 0),
+                    cell.get('column', 0),
+                    move.get('s', ''),
+                    str(move.get('p', '')),
+                )
+                position += 1
+        # The games refer to their moves, which are written first
+        for table, rows in (('moves', moves), ('games', games)):
+            for column in rows.dtype.names:
+                with open(self.path(table, column), 'ab') as file:
+                    rows[column].tofile(file)
+        self.moves_written += len(moves)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class NDJSONWriter:
+    """
+    Appends the batches to a NDJSON file
+    """
+
+    def __init__(self, path: str):
+        if os.path.exists(path):
+            self.repair(path)
+        self.file = open(path, 'a')
+
+    @staticmethod
+    def repair(path: str, block: int = 65536):
+        """
+        Drop a line cut by a crash, its game is exported again. The end
+        of the file is searched backwards for the last complete line.
+        :param str path:
+        :param int block: bytes read at once
+        :return:
+        """
+        with open(path, 'rb+') as file:
+            end = file.seek(0, os.SEEK_END)
+            while end > 0:
+                start = max(end - block, 0)
+                file.seek(start)
+                newline = file.read(end - start).rfind(b'\n')
+                if newline != -1:
+                    file.truncate(start + newline + 1)
+                    return
+                end = start
+            file.truncate(0)
+
+    def write(self, batch: list):
+        self.file.write(ndjson_lines(batch))
+
+    def flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+async def export(writer, query: dict, batch_size: int = 500, checkpoint: str = None, progress=None) -> int:
+    """
+    Write the games matching the query
+    :param writer: NDJSONWriter or ColumnsWriter
+    :param dict query: see make_query
+    :param int batch_size:
+    :param str checkpoint: file keeping the id of the last game written
+    :param progress: optional callable receiving the amount of games written
+    :return int: amount of games written
+    """
+    written = 0
+    async for batch in batches(query, batch_size):
+        writer.write(batch)
+        writer.flush()
+        written += len(batch)
+        if checkpoint:
+            tmp = checkpoint + '.tmp'
+            with open(tmp, 'w') as file:
+                file.write(str(batch[-1][0]['_id']))
+            os.replace(tmp, checkpoint)
+        if progress:
+            progress(written)
+    return written
+
+
+def parse_date(value: str) -> datetime.datetime:
+    """
+    ISO date or datetime, in UTC
+    :param str value:
+    :return datetime:
+    """
+    return datetime.datetime.fromisoformat(value)
+
+
+def main():
+    """
+    Command line entry point
+    :return:
+    """
+    parser = argparse.ArgumentParser(description='Export the games with their moves')
+    parser.add_argument('--output', required=True, help='file for ndjson, directory for columns')
+    parser.add_argument('--format', choices=[FORMAT_NDJSON, FORMAT_COLUMNS], default=FORMAT_NDJSON)
+    parser.add_argument('--since', type=parse_date, default=None, help='creation date, UTC')
+    parser.add_argument('--until', type=parse_date, default=None, help='creation date, UTC, excluded')
+    parser.add_argument('--status', nargs='+', default=None, choices=Game.STATUS)
+    parser.add_argument('--after', default=None, help='id of the last game already exported')
+    parser.add_argument('--checkpoint', default=None, help='file to resume the export from')
+    parser.add_argument('--batch-size', type=int, default=500)
+    arguments = parser.parse_args()
+
+    after = arguments.after
+    if arguments.checkpoint and os.path.exists(arguments.checkpoint):
+        with open(arguments.checkpoint) as file:
+            after = file.read().strip() or after
+    query = make_query(arguments.since, arguments.until, arguments.status, after)
+    if arguments.format == FORMAT_COLUMNS:
+        writer = ColumnsWriter(arguments.output)
+    else:
+        writer = NDJSONWriter(arguments.output)
+
+    def progress(written):
+        sys.stderr.write('\r%s games' % written)
+
+    try:
+        written = asyncio.run(export(
+            writer, query, arguments.batch_size, arguments.checkpoint, progress,
+        ))
+    finally:
+        writer.close()
+    sys.stderr.write('\n')
+    print(json.dumps({'games': written}))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,34 +2,128 @@
 Collection of project handlers
 """
 import json
+import time
+import bson
 from tornado.web import RequestHandler, HTTPError
-from tornado.escape import json_decode
+from tornado.escape import json_decode, json_encode
+from tornado.httpclient import AsyncHTTPClient
+from pymongo.errors import DuplicateKeyError, PyMongoError
 from umongo import fields
 
 from app.decorators import validate_mongo_id, validate_json_body
-from app.models import Game, GameMove
-from app.engine import GameEngine, GameBot
+from app.models import Game, GameMove, User
+from app.engine import GameEngine
+from app.archive import archived_moves, find_game
+from app import export
+from app.simulations import SimulationError, simulate
+from app.metrics import metrics, collect
+from app.bootstrap import ping
+from app.leaderboard import leaderboard
+from app.analytics import openings
+from app.context import activate
+from app.matchmaking import queue_owner
+from app.actors import current_game, owner
+from app.singleflight import SingleFlight
+from app.stats import COUNTERS, summary
 
 
 engine = GameEngine()
+game_reads = SingleFlight('games.reads')
 
-class MainHandler(RequestHandler):
+
+async def read_game(pk: str) -> tuple:
     """
-    Main handler to return the default responses
+    Version of a game and its serialized payload, shared by the
+    concurrent reads of the game
+    :param str pk:
+    :return tuple:
     """
-    async def get(self):
-        """
-        Base handler, hello world
-        :return:
-        """
-        self.set_header("Content-Type", 'application/json')
-        self.write({"Hello": "World"})
+    game = await current_game(pk)
+    return game.version or 0, json_encode(game.dump())
 
 
 class ErrorHandler(RequestHandler):
     """
     This class allows us to handle the HTTPErrors and exceptions
     """
+    # Headers of the requests handed to another worker, and of its responses
+    FORWARDED_HEADERS = ('Prefer', 'Idempotency-Key')
+    RELAYED_HEADERS = ('Content-Type', 'Preference-Applied', 'Idempotent-Replayed')
+    # Long polls wait 30 seconds at most
+    FORWARD_TIMEOUT = 40
+    def prepare(self):
+        """
+        Keep track of the requests in flight, the workers wait for them
+        to finish before shutting down. The services of the application
+        are the ones of the request and of the tasks it starts.
+        :return:
+        """
+        activate(self.context)
+        metrics.inc('http.requests')
+        metrics.add('http.in_flight')
+        self.in_flight = True
+
+    @property
+    def context(self):
+        """
+        :return app.context.Context: services of the application
+        """
+        return self.application.context
+
+    def on_finish(self):
+        """
+        Account the finished request
+        :return:
+        """
+        if getattr(self, 'in_flight', False):
+            metrics.add('http.in_flight', -1)
+        metrics.inc('http.responses.%sxx' % (self.get_status() // 100))
+
+    def expand_players(self) -> bool:
+        """
+        Whether the client asked for the data of the players of the
+        games instead of their ids, through "?expand=players"
+        :return bool:
+        """
+        expand = self.get_argument('expand', None)
+        if expand is None:
+            return False
+        if expand != 'players':
+            raise HTTPError(400, 'Unknown expansion %s' % expand)
+        return True
+
+    async def forward_to(self, worker: int, feature: str) -> bool:
+        """
+        Hand the request to another worker of the pool, through its
+        internal port, and relay its response
+        :param int worker: position of the worker
+        :param str feature: prefix of the forwarding metric
+        :return bool: always True, the response is written
+        """
+        config = self.application.config
+        headers = {
+            name: self.request.headers[name]
+            for name in self.FORWARDED_HEADERS if name in self.request.headers
+        }
+        response = await AsyncHTTPClient().fetch(
+            'http://127.0.0.1:%s%s' % (config.actor_port + worker, self.request.uri),
+            method=self.request.method,
+            body=self.request.body if self.request.method == 'POST' else None,
+            headers=headers,
+            request_timeout=self.FORWARD_TIMEOUT,
+            raise_error=False,
+        )
+        if response.code == 599:
+            raise HTTPError(503, 'Worker %s is not available' % worker)
+        metrics.inc('%s.forwarded' % feature)
+        self.set_status(response.code)
+        for name in self.RELAYED_HEADERS:
+            if name in response.headers:
+                self.set_header(name, response.headers[name])
+        if response.body:
+            self.write(response.body)
+        return True
+
     def write_error(self, status_code, **kwargs):
         """
         This method takes the HTTPError and renders a json
@@ -52,6 +146,19 @@ class ErrorHandler(RequestHandler):
         }))
 
 
+class MainHandler(ErrorHandler):
+    """
+    Main handler to return the default responses
+    """
+    async def get(self):
+        """
+        Base handler, hello world
+        :return:
+        """
+        self.set_header("Content-Type", 'application/json')
+        self.write({"Hello": "World"})
+
+
 class AbstractGeneralHandler(ErrorHandler):
     """
     General operations that require no objectId,
@@ -83,10 +190,13 @@ class AbstractGeneralHandler(ErrorHandler):
         Retrieve a list of objects
         :return:
         """
+        expand = self.cls is Game and self.expand_players()
         cursor = self.cls.find()
         data = []
         async for obj in cursor:
             data.append(obj.dump())
+        if expand:
+            await self.context.players.expand(data)
         self.set_header("Content-Type", 'application/json')
         self.write({'data': data})
 
@@ -127,6 +237,8 @@ class AbstractObjHandler(ErrorHandler):
         data = json_decode(self.request.body)
         obj.update(data)
         await obj.commit()
+        if self.cls is User:
+            self.context.players.discard(pk)
         self.set_header("Content-Type", 'application/json')
         self.write(obj.dump())
 
@@ -139,6 +251,9 @@ class AbstractObjHandler(ErrorHandler):
         """
         obj = await self.cls.find_by_id(pk)
         await obj.delete()
+        if self.cls is User:
+            leaderboard.discard(pk)
+            self.context.players.discard(pk)
         self.set_header("Content-Type", 'application/json')
         self.write({'success': True})
 
@@ -148,6 +263,9 @@ class GameMoveHandler(ErrorHandler):
     This class allows us to trigger execute board move
     operations
     """
+    MAX_WAIT = 30
+    POLL_INTERVAL = 1
+    MAX_KEY_LENGTH = 255
 
     @validate_mongo_id
     @validate_json_body
@@ -158,35 +276,459 @@ class GameMoveHandler(ErrorHandler):
         improved by the use of the strategy pattern to distinguish
         single player and multiplayer games. Right now in order to not
         increase complexity, and as the game rules are no different on both
-        modes we are going by a simple decision.
+        modes we are going by a simple decision. Retries sent with the
+        Idempotency-Key header of a submission get its response back.
         :param str pk:
         :return:
         """
-        game: Game = await Game.find_by_id(pk)
+        if await self.forward(pk):
+            return
+        key = self.request.headers.get('Idempotency-Key')
+        if key is None:
+            status, data = await self.play(pk)
+        else:
+            if not key or len(key) > self.MAX_KEY_LENGTH:
+                raise HTTPError(400, 'Invalid Idempotency-Key')
+            (status, data), replayed = await self.context.idempotency.respond(
+                pk, key, lambda: self.play_once(pk, key),
+            )
+            if replayed:
+                self.set_header('Idempotent-Replayed', 'true')
+        self.set_status(status)
+        if status == 202:
+            self.set_header('Preference-Applied', 'respond-async')
+        self.set_header("Content-Type", 'application/json')
+        self.write(data)
+
+    async def play(self, pk: str, key: str = None) -> tuple:
+        """
+        Play the move of the body and the reply of the bot
+        :param str pk:
+        :param str key: idempotency key saved with the move
+        :return tuple: status and dumped game
+        """
+        data = json_decode(self.request.body)
+        if self.context.actors.enabled:
+            background = self.respond_async()
+            if key is not None:
+                data['idempotency_key'] = key
+            game = await self.context.actors.submit(pk, data, background)
+            if background and not game['multiplayer'] and game['status'] == Game.STATUS_IN_PROGRESS:
+                return 202, game
+            return 200, game
+        # Archived games are finished as well
+        game: Game = await find_game(pk)
         if game.status in [Game.STATUS_TIE, Game.STATUS_FINISHED]:
             raise HTTPError(
                 400,
                 'Game was already finished'
             )
-        data = json_decode(self.request.body)
         move = GameMove(**data)
-        await engine.execute_move(game, move)
-        if not game.multiplayer and game.status == Game.STATUS_IN_PROGRESS:
-            aimove = await GameBot().move(game, move)
-            await engine.execute_move(game, aimove)
+        if key is not None:
+            move.idempotency_key = key
+        claim_timeout = self.application.config.move_claim_timeout
+        if game.bot_pending_since is not None or not await game.claim_turn(claim_timeout):
+            raise HTTPError(
+                409,
+                'Waiting for the bot move or another move of the game'
+            )
+        claim = game.move_pending_since
+        background = not game.multiplayer and self.respond_async()
+        status = 200
+        try:
+            # The turn stays claimed until the reply of the bot is written
+            await engine.execute_move(
+                game,
+                move,
+                reply_pending=background,
+                keep_claim=not game.multiplayer and not background,
+            )
+            if not game.multiplayer and game.status == Game.STATUS_IN_PROGRESS:
+                if background:
+                    self.context.replies.schedule(game, move)
+                    status = 202
+                else:
+                    aimove = await self.context.bots.get(game.bot).move(game, move)
+                    await engine.execute_move(game, aimove)
+        except Exception:
+            await game.release_turn(claim)
+            raise
+        return status, game.dump()
+
+    async def play_once(self, pk: str, key: str) -> tuple:
+        """
+        Play a move sent with an idempotency key. The response is kept
+        and replayed to the retries, unless it is worth retrying: turn
+        conflicts and database or server failures.
+        :param str pk:
+        :param str key:
+        :return tuple: status and response
+        """
+        try:
+            # Played before the response was lost, or by another worker
+            if await GameMove.find_one({'game': bson.ObjectId(pk), 'idempotency_key': key}) is None:
+                return await self.play(pk, key)
+        except DuplicateKeyError:
+            pass
+        except PyMongoError:
+            raise
+        except Exception as error:
+            status = getattr(error, 'status_code', 400)
+            if status == 409 or status >= 500:
+                raise
+            return status, {'error': {'code': status, 'message': str(error)}}
+        metrics.inc('moves.idempotency.found')
+        return 200, (await current_game(pk)).dump()
+
+    def respond_async(self) -> bool:
+        """
+        Whether the client asked for the bot to reply in the background,
+        through the "Prefer: respond-async" header
+        :return bool:
+        """
+        return 'respond-async' in self.request.headers.get('Prefer', '')
+
+    async def forward(self, pk: str) -> bool:
+        """
+        In actor mode, hand the request to the worker owning the game
+        when it is another one. The owner is always computed from the
+        id, no header lets a client pick the worker serving a game.
+        :param str pk:
+        :return bool: whether the request was forwarded
+        """
+        config = self.application.config
+        if not config.game_actors:
+            return False
+        worker = owner(pk, config.workers)
+        if worker == self.application.worker_id:
+            return False
+        return await self.forward_to(worker, 'actors')
+
+    @validate_mongo_id
+    async def get(self, pk: str):
+        """
+        Retrieve a single object from the database. With the version
+        argument the request waits, up to the wait argument in seconds,
+        until the game is past that version. Concurrent reads of the
+        game share a single read and its payload. With the at argument
+        the game is replayed as it was after that amount of moves.
+        :param str pk:
+        :return:
+        """
+        expand = self.expand_players()
+        if await self.forward(pk):
+            return
+        at = self.get_argument('at', None)
+        if at is not None:
+            await self.replay(pk, at, expand)
+            return
+        current, payload = await game_reads.do(pk, lambda: read_game(pk))
+        version = self.get_argument('version', None)
+        if version is not None:
+            try:
+                version = int(version)
+                wait = min(float(self.get_argument('wait', self.MAX_WAIT)), self.MAX_WAIT)
+            except ValueError:
+                raise HTTPError(400, 'Invalid version or wait')
+            deadline = time.monotonic() + wait
+            # Replies committed by other workers are only seen by reading
+            # the game again, so the wait is split in short polls.
+            while current <= version and time.monotonic() < deadline:
+                await self.context.replies.wait(pk, min(deadline - time.monotonic(), self.POLL_INTERVAL))
+                current, payload = await game_reads.do(pk, lambda: read_game(pk))
         self.set_header("Content-Type", 'application/json')
-        self.write(game.dump())
+        if expand:
+            data = json_decode(payload)
+            await self.context.players.expand([data])
+            self.write(data)
+        else:
+            self.write(payload)
 
+    async def replay(self, pk: str, at: str, expand: bool):
+        """
+        Write the game as it was after a move
+        :param str pk:
+        :param str at: move number, 0 for the empty board
+        :param bool expand: see expand_players
+        :return:
+        """
+        try:
+            number = int(at)
+        except ValueError:
+            raise HTTPError(400, 'Invalid move number')
+        await self.context.actors.flush(pk)
+        # Frames of finished games are cached and shared
+        data = dict(await self.context.replays.frame(await current_game(pk), number))
+        if expand:
+            await self.context.players.expand([data])
+        self.set_header("Content-Type", 'application/json')
+        self.write(data)
+
+
+class SimulationHandler(ErrorHandler):
+    """
+    Play whole games between bots on the server
+    """
+    @validate_json_body
+    async def post(self):
+        """
+        Play and store a batch of games. The body may set the bots of
+        both sides (x, o), the board (size, mode, win_length), the
+        amount of games, scripted opening moves and a seed.
+        :return:
+        """
+        data = json_decode(self.request.body)
+        try:
+            report = await simulate(
+                x_bot=data.get('x'),
+                o_bot=data.get('o'),
+                size=data.get('size', 3),
+                mode=data.get('mode', Game.MODE_CLASSIC),
+                win_length=data.get('win_length'),
+                games=data.get('games', 1),
+                opening=data.get('moves', []),
+                seed=data.get('seed'),
+            )
+        except SimulationError as error:
+            raise HTTPError(400, str(error))
+        self.set_header("Content-Type", 'application/json')
+        self.write(report)
+
+
+class MatchmakingHandler(ErrorHandler):
+    """
+    Join the matchmaking queue of a board
+    """
+    @validate_json_body
+    async def post(self):
+        """
+        Queue the player, or create the game with the oldest player
+        waiting for the same board. With several workers the queue of
+        the board is owned by one of them, the request is forwarded
+        there.
+        :return:
+        """
+        data = json_decode(self.request.body)
+        player = data.get('player')
+        size = data.get('size', 3)
+        mode = data.get('mode', Game.MODE_CLASSIC)
+        if not bson.objectid.ObjectId.is_valid(player):
+            raise HTTPError(400, 'Invalid Mongo Id')
+        if not isinstance(size, int):
+            raise HTTPError(400, 'Invalid size')
+        workers = self.application.config.workers
+        worker = queue_owner(str(mode), size, workers)
+        if worker != self.application.worker_id:
+            await self.forward_to(worker, 'matchmaking')
+            return
+        await User.find_by_id(player)
+        ticket = await self.context.matchmaking.join(
+            player,
+            size=size,
+            mode=mode,
+            worker=worker,
+            workers=workers,
+        )
+        self.set_header("Content-Type", 'application/json')
+        self.write(ticket.dump())
+
+
+class TicketHandler(ErrorHandler):
+    """
+    Follow or leave a matchmaking ticket
+    """
+    MAX_WAIT = 30
+
+    def find_ticket(self, pk: str):
+        ticket = self.context.matchmaking.get(pk)
+        if ticket is None:
+            raise HTTPError(404, 'Ticket not found or expired')
+        return ticket
+
+    async def forward(self, pk: str) -> bool:
+        """
+        Hand the request to the worker that issued the ticket when it
+        is another one
+        :param str pk:
+        :return bool: whether the request was forwarded
+        """
+        try:
+            worker = owner(pk, self.application.config.workers)
+        except ValueError:
+            # Not an id of a ticket, not found wherever it is served
+            return False
+        if worker == self.application.worker_id:
+            return False
+        return await self.forward_to(worker, 'matchmaking')
+
+    async def get(self, pk: str):
+        """
+        Retrieve the ticket. While the player is waiting, the request
+        waits up to the wait argument in seconds for the match.
+        :param str pk:
+        :return:
+        """
+        if await self.forward(pk):
+            return
+        ticket = self.find_ticket(pk)
+        try:
+            wait = min(float(self.get_argument('wait', self.MAX_WAIT)), self.MAX_WAIT)
+        except ValueError:
+            raise HTTPError(400, 'Invalid wait')
+        if ticket.game is None and wait > 0:
+            await self.context.matchmaking.wait(ticket, wait)
+        self.set_header("Content-Type", 'application/json')
+        self.write(ticket.dump())
+
+    async def delete(self, pk: str):
+        """
+        Leave the queue
+        :param str pk:
+        :return:
+        """
+        if await self.forward(pk):
+            return
+        self.context.matchmaking.leave(self.find_ticket(pk))
+        self.set_status(204)
+
+
+class BotsHandler(ErrorHandler):
+    """
+    List the bots single player games can choose
+    """
+    async def get(self):
+        """
+        Retrieve the registered bots
+        :return:
+        """
+        self.set_header("Content-Type", 'application/json')
+        self.write({
+            'default': self.context.bots.default,
+            'data': [bot.describe() for bot in self.context.bots],
+        })
+
+
+class MetricsHandler(ErrorHandler):
+    """
+    Expose the metrics of the current worker together with the
+    aggregation of every worker of the pool.
+    """
+    async def get(self):
+        """
+        Retrieve the metrics report
+        :return:
+        """
+        self.set_header("Content-Type", 'application/json')
+        self.write(collect(self.application.config.metrics_dir))
+
+
+class LivenessHandler(ErrorHandler):
+    """
+    Liveness probe, answers as long as the worker loop is running
+    """
+    async def get(self):
+        """
+        Report the worker as alive
+        :return:
+        """
+        self.set_header("Content-Type", 'application/json')
+        self.write({'alive': True})
+
+
+class ReadinessHandler(ErrorHandler):
+    """
+    Readiness probe, the worker is ready once the bootstrap tasks are
+    done and the database answers.
+    """
+    async def get(self):
+        """
+        Report whether the worker can take traffic
+        :return:
+        """
+        bootstrap = self.application.bootstrap
+        database = await ping()
+        ready = bootstrap.ready and database
+        self.set_status(200 if ready else 503)
+        self.set_header("Content-Type", 'application/json')
+        self.write({
+            'ready': ready,
+            'bootstrap': bootstrap.ready,
+            'database': database,
+            'errors': bootstrap.errors,
+        })
+
+
+class UserStatsHandler(ErrorHandler):
+    """
+    Statistics of a user, served from a single document read
+    """
     @validate_mongo_id
     async def get(self, pk: str):
         """
-        Retrieve a single object from the database
+        Retrieve the statistics of a user
         :param str pk:
         :return:
         """
-        obj = await Game.find_by_id(pk)
+        document = await User.collection.find_one(
+            {'_id': fields.ObjectId(pk)},
+            projection=['username'] + COUNTERS,
+        )
+        if document is None:
+            raise HTTPError(404, 'Object not found Not Found')
         self.set_header("Content-Type", 'application/json')
-        self.write(obj.dump())
+        self.write(summary(document))
+
+
+class LeaderboardHandler(ErrorHandler):
+    """
+    Users with more victories, served from the in-memory leaderboard
+    """
+    MAX_LIMIT = 100
+
+    async def get(self):
+        """
+        Retrieve the top of the leaderboard. The limit query argument
+        sets the amount of users and the user one adds the rank of the
+        given user to the response.
+        :return:
+        """
+        try:
+            limit = int(self.get_argument('limit', '10'))
+        except ValueError:
+            raise HTTPError(400, 'Invalid limit')
+        limit = min(max(limit, 1), self.MAX_LIMIT)
+        response = {'data': leaderboard.top(limit)}
+        user_id = self.get_argument('user', None)
+        if user_id is not None:
+            if not bson.objectid.ObjectId.is_valid(user_id):
+                raise HTTPError(400, 'Invalid Mongo Id')
+            if leaderboard.rank(user_id) is None:
+                user = await User.find_by_id(user_id)
+                leaderboard.update(user_id, user.victories, user.username)
+            response['user'] = leaderboard.entry(user_id)
+        self.set_header("Content-Type", 'application/json')
+        self.write(response)
+
+
+class OpeningsHandler(ErrorHandler):
+    """
+    Opening analytics, served from the in-memory snapshot
+    """
+
+    async def get(self):
+        """
+        Retrieve the frequency and the outcomes of every opening cell,
+        per board. The size query argument keeps the boards of a size.
+        :return:
+        """
+        size = self.get_argument('size', None)
+        if size is not None:
+            try:
+                size = int(size)
+            except ValueError:
+                raise HTTPError(400, 'Invalid size')
+        self.set_header("Content-Type", 'application/json')
+        self.write(openings.report(size))
 
 
 class GameMovesRetriever(ErrorHandler):
@@ -206,5 +748,119 @@ class GameMovesRetriever(ErrorHandler):
         data = []
         async for obj in cursor:
             data.append(obj.dump())
+        if not data:
+            data = [obj.dump() for obj in archived_moves(pk)]
         self.set_header("Content-Type", 'application/json')
         self.write({"data": data})
+
+
+class BatchMovesRetriever(ErrorHandler):
+    """
+    Moves of several games with a single query. The moves are read in
+    the order of the (game, _id) index, so each game comes as a group,
+    and every group is flushed as soon as it is complete.
+    """
+    MAX_IDS = 100
+    MAX_BYTES = 1024 * 1024
+
+    async def get(self):
+        """
+        Retrieve the moves of the games listed in the ids argument,
+        comma separated. Groups beyond MAX_BYTES are left out and their
+        games are listed in remaining, to be requested again.
+        :return:
+        """
+        ids = []
+        for pk in self.get_argument('ids', '').split(','):
+            if not bson.objectid.ObjectId.is_valid(pk):
+                raise HTTPError(400, 'Invalid Mongo Id')
+            if pk not in ids:
+                ids.append(pk)
+        if len(ids) > self.MAX_IDS:
+            raise HTTPError(400, 'At most %s games per request' % self.MAX_IDS)
+
+        cursor = GameMove.find(
+            {'game': {'$in': [fields.ObjectId(pk) for pk in ids]}},
+            sort=[('g', 1), ('_id', 1)],
+        )
+        pending = set(ids)
+        self.set_header("Content-Type", 'application/json')
+        self.write('{"data":[')
+        self.written = 0
+        current = None
+        moves = []
+        truncated = False
+        async for obj in cursor:
+            pk = str(obj.game.pk)
+            if pk != current:
+                if current is not None and not await self.write_group(current, moves, pending):
+                    truncated = True
+                    break
+                current = pk
+                moves = []
+            moves.append(obj.dump())
+        else:
+            if current is not None:
+                truncated = not await self.write_group(current, moves, pending)
+        if not truncated:
+            # Games without moves never show up in the cursor, neither
+            # do the archived ones
+            for pk in ids:
+                if pk in pending:
+                    moves = [obj.dump() for obj in archived_moves(pk)]
+                    if not await self.write_group(pk, moves, pending):
+                        break
+        self.write('],"remaining":%s}' % json.dumps([pk for pk in ids if pk in pending]))
+
+    async def write_group(self, pk: str, moves: list, pending: set) -> bool:
+        """
+        Send the moves of a game unless the response would outgrow
+        MAX_BYTES. The first group is always sent.
+        :param str pk:
+        :param list moves:
+        :param set pending: games not sent yet
+        :return bool: whether the group was sent
+        """
+        chunk = json.dumps({'game': pk, 'moves': moves})
+        if self.written and self.written + len(chunk) > self.MAX_BYTES:
+            return False
+        self.write(chunk if not self.written else ',' + chunk)
+        self.written += len(chunk) + 1
+        pending.discard(pk)
+        await self.flush()
+        return True
+
+
+class ExportHandler(ErrorHandler):
+    """
+    Stream the games with their moves as NDJSON, see app.export
+    """
+    MAX_BATCH_SIZE = 1000
+
+    async def get(self):
+        """
+        Export the games. The since and until arguments filter by
+        creation date (ISO format, UTC), status takes a comma separated
+        list and after resumes the export after the given game id.
+        :return:
+        """
+        after = self.get_argument('after', None)
+        if after is not None and not bson.objectid.ObjectId.is_valid(after):
+            raise HTTPError(400, 'Invalid Mongo Id')
+        statuses = self.get_argument('status', None)
+        try:
+            since = self.get_argument('since', None)
+            until = self.get_argument('until', None)
+            batch_size = min(int(self.get_argument('batch_size', 500)), self.MAX_BATCH_SIZE)
+            query = export.make_query(
+                since=export.parse_date(since) if since else None,
+                until=export.parse_date(until) if until else None,
+                statuses=statuses.split(',') if statuses else None,
+                after=after,
+            )
+        except ValueError as error:
+            raise HTTPError(400, str(error))
+        self.set_header("Content-Type", 'application/x-ndjson')
+        async for batch in export.batches(query, max(batch_size, 1)):
+            self.write(export.ndjson_lines(batch))
+            await self.flush()
@@ -0,0 +1,79 @@
+"""
+Idempotent move submissions. Clients send an Idempotency-Key header with
+a move and reuse it when they retry, the retries get the response of the
+first submission without the move being played again.
+
+The responses are kept in a bounded LRU store of the worker for a while.
+Retries reaching another worker, or arriving after the response left the
+store, are recognized by the key saved with the move, unique per game:
+they get the current state of the game.
+"""
+import time
+from collections import OrderedDict
+
+from app.metrics import metrics
+from app.singleflight import SingleFlight
+
+
+class IdempotencyStore:
+    """
+    LRU store of (game id, key) -> response of the move submission
+    """
+
+    def __init__(self, size: int = 10000, ttl: float = 86400):
+        """
+        :param int size: maximum amount of responses kept
+        :param float ttl: seconds a response is replayed
+        """
+        self.size = size
+        self.ttl = ttl
+        # (game id, key) -> (expiry, response), least recently used first
+        self.entries = OrderedDict()
+        # Retries sent while the first submission is running wait for it
+        self.flights = SingleFlight('moves.idempotency')
+
+    def configure(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def get(self, pk: str, key: str):
+        """
+        :param str pk: game id
+        :param str key: idempotency key
+        :return tuple: stored response, None when unknown or expired
+        """
+        entry = self.entries.get((pk, key))
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self.entries[(pk, key)]
+            return None
+        self.entries.move_to_end((pk, key))
+        return entry[1]
+
+    def store(self, pk: str, key: str, response: tuple):
+        self.entries[(pk, key)] = (time.monotonic() + self.ttl, response)
+        self.entries.move_to_end((pk, key))
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    async def respond(self, pk: str, key: str, function) -> tuple:
+        """
+        Response of the submission of a move with its key
+        :param str pk: game id
+        :param str key: idempotency key
+        :param function: coroutine function submitting the move, returns
+        the response to keep; exceptions are not kept
+        :return tuple: the response and whether it is replayed
+        """
+        response = self.get(pk, key)
+        if response is not None:
+            metrics.inc('moves.idempotency.replayed')
+            return response, True
+        response = await self.flights.do((pk, key), function)
+        self.store(pk, key, response)
+        return response, False
+
+
+idempotency = IdempotencyStore()
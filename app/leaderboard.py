@@ -0,0 +1,266 @@
+"""
+Materialized leaderboard of the users ordered by victories. It lives
+in memory, is rebuilt from mongo when the worker starts and is kept up
+to date incrementally by the game engine.
+"""
+import random
+from typing import List
+from app.models import User
+
+
+class _Node:
+    """
+    Skip list node. span[i] is the amount of nodes between this one
+    and forward[i], which allows computing ranks while searching.
+    """
+    __slots__ = ('key', 'forward', 'span')
+
+    def __init__(self, key, level: int):
+        self.key = key
+        self.forward = [None] * level
+        self.span = [0] * level
+
+
+class SkipList:
+    """
+    Indexable skip list of unique, comparable keys. Insertion, removal
+    and rank lookups are O(log n) on average.
+    """
+    MAX_LEVEL = 32
+    PROBABILITY = 0.25
+
+    def __init__(self, seed=None):
+        """
+        :param seed: seed of the level generator
+        """
+        self.head = _Node(None, self.MAX_LEVEL)
+        self.level = 1
+        self.size = 0
+        self.random = random.Random(seed)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self):
+        node = self.head.forward[0]
+        while node is not None:
+            yield node.key
+            node = node.forward[0]
+
+    def random_level(self) -> int:
+        """
+        Pick the level of a new node
+        :return int:
+        """
+        level = 1
+        while level < self.MAX_LEVEL and self.random.random() < self.PROBABILITY:
+            level += 1
+        return level
+
+    def insert(self, key):
+        """
+        Insert a key, it must not be already present
+        :param key:
+        :return:
+        """
+        update = [None] * self.MAX_LEVEL
+        rank = [0] * self.MAX_LEVEL
+        node = self.head
+        for i in range(self.level - 1, -1, -1):
+            rank[i] = 0 if i == self.level - 1 else rank[i + 1]
+            while node.forward[i] is not None and node.forward[i].key < key:
+                rank[i] += node.span[i]
+                node = node.forward[i]
+            update[i] = node
+
+        level = self.random_level()
+        if level > self.level:
+            for i in range(self.level, level):
+                rank[i] = 0
+                update[i] = self.head
+                self.head.span[i] = self.size
+            self.level = level
+
+        new = _Node(key, level)
+        for i in range(level):
+            new.forward[i] = update[i].forward[i]
+            update[i].forward[i] = new
+            new.span[i] = update[i].span[i] - (rank[0] - rank[i])
+            update[i].span[i] = (rank[0] - rank[i]) + 1
+        for i in range(level, self.level):
+            update[i].span[i] += 1
+        self.size += 1
+
+    def remove(self, key):
+        """
+        Remove a key
+        :param key:
+        :return:
+        :raises KeyError: when the key is not present
+        """
+        update = [None] * self.MAX_LEVEL
+        node = self.head
+        for i in range(self.level - 1, -1, -1):
+            while node.forward[i] is not None and node.forward[i].key < key:
+                node = node.forward[i]
+            update[i] = node
+        node = node.forward[0]
+        if node is None or node.key != key:
+            raise KeyError(key)
+        for i in range(self.level):
+            if update[i].forward[i] is node:
+                update[i].span[i] += node.span[i] - 1
+                update[i].forward[i] = node.forward[i]
+            else:
+                update[i].span[i] -= 1
+        while self.level > 1 and self.head.forward[self.level - 1] is None:
+            self.level -= 1
+        self.size -= 1
+
+    def count_less(self, key) -> int:
+        """
+        Amount of keys strictly lower than the given one
+        :param key:
+        :return int:
+        """
+        rank = 0
+        node = self.head
+        for i in range(self.level - 1, -1, -1):
+            while node.forward[i] is not None and node.forward[i].key < key:
+                rank += node.span[i]
+                node = node.forward[i]
+        return rank
+
+    def first(self, amount: int) -> list:
+        """
+        The lowest keys of the list
+        :param int amount:
+        :return list:
+        """
+        keys = []
+        for key in self:
+            if len(keys) >= amount:
+                break
+            keys.append(key)
+        return keys
+
+
+class Leaderboard:
+    """
+    Users ordered by victories. Ties share the same rank, which is the
+    amount of users with more victories plus one.
+    """
+
+    def __init__(self):
+        self.ranking = SkipList()
+        self.scores = {}
+        self.names = {}
+
+    def __len__(self) -> int:
+        return len(self.scores)
+
+    def update(self, user_id: str, victories: int, username: str = None):
+        """
+        Set the victories of a user
+        :param str user_id:
+        :param int victories:
+        :param str username:
+        :return:
+        """
+        previous = self.scores.get(user_id)
+        if previous is not None:
+            if previous == victories:
+                if username:
+                    self.names[user_id] = username
+                return
+            self.ranking.remove((-previous, user_id))
+        self.ranking.insert((-victories, user_id))
+        self.scores[user_id] = victories
+        if username:
+            self.names[user_id] = username
+
+    def discard(self, user_id: str):
+        """
+        Remove a user from the leaderboard
+        :param str user_id:
+        :return:
+        """
+        victories = self.scores.pop(user_id, None)
+        if victories is not None:
+            self.ranking.remove((-victories, user_id))
+        self.names.pop(user_id, None)
+
+    def rank(self, user_id: str) -> int:
+        """
+        Rank of a user, None when it is unknown
+        :param str user_id:
+        :return int:
+        """
+        victories = self.scores.get(user_id)
+        if victories is None:
+            return None
+        return self.ranking.count_less((-victories, '')) + 1
+
+    def entry(self, user_id: str) -> dict:
+        """
+        Leaderboard entry of a user
+        :param str user_id:
+        :return dict:
+        """
+        return {
+            'id': user_id,
+            'username': self.names.get(user_id),
+            'victories': self.scores[user_id],
+            'rank': self.rank(user_id),
+        }
+
+    def top(self, amount: int) -> List[dict]:
+        """
+        Best users of the leaderboard
+        :param int amount:
+        :return list:
+        """
+        entries = []
+        rank = 0
+        previous = None
+        for position, (score, user_id) in enumerate(self.ranking.first(amount), 1):
+            if score != previous:
+                rank = position
+                previous = score
+            entries.append({
+                'id': user_id,
+                'username': self.names.get(user_id),
+                'victories': -score,
+                'rank': rank,
+            })
+        return entries
+
+    def replace(self, other: 'Leaderboard'):
+        """
+        Take the state of another leaderboard, used to swap a rebuilt one
+        :param Leaderboard other:
+        :return:
+        """
+        self.ranking = other.ranking
+        self.scores = other.scores
+        self.names = other.names
+
+    async def rebuild(self):
+        """
+        Build the leaderboard again from the users collection. The new
+        structure is built aside and swapped at the end, so readers never
+        see a partial ranking.
+        :return:
+        """
+        fresh = Leaderboard()
+        cursor = User.collection.find({}, {'username': 1, 'victories': 1})
+        async for document in cursor:
+            fresh.update(
+                str(document['_id']),
+                document.get('victories', 0),
+                document.get('username'),
+            )
+        self.replace(fresh)
+
+
+leaderboard = Leaderboard()
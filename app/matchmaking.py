@@ -0,0 +1,258 @@
+"""
+Matchmaking of multiplayer games. Players join the queue of a board
+(mode and size) and are paired in arrival order: joining an empty queue
+leaves a ticket waiting, joining a queue with a ticket creates the game
+of both players right away. Queues live in the memory of the worker, the
+database is only written when a game is created.
+
+Waiting players long-poll their ticket, which is woken up by the match.
+Tickets nobody polled for the timeout are dropped, both from the queue
+and once matched, so clients that went away do not get paired.
+
+With several workers every queue is owned by the worker of the hash of
+its board (see queue_owner) and the ids of the tickets hash to the worker
+that issued them, as the ids of the games of the actors (see
+app.actors.owner). The other workers forward the requests there.
+"""
+import time
+import uuid
+import zlib
+import asyncio
+import logging
+from collections import OrderedDict
+
+from app.metrics import metrics
+from app.models import Game
+
+
+logger = logging.getLogger(__name__)
+
+
+def queue_owner(mode: str, size: int, workers: int) -> int:
+    """
+    Position of the worker owning the queue of a board
+    :param str mode:
+    :param int size:
+    :param int workers: amount of workers of the pool
+    :return int:
+    """
+    return zlib.crc32(('%s:%s' % (mode, size)).encode()) % max(workers, 1)
+
+
+def ticket_id(worker: int = 0, workers: int = 1) -> str:
+    """
+    Random ticket id whose hash is the worker issuing it
+    :param int worker: position of the worker
+    :param int workers: amount of workers of the pool
+    :return str: 32 hexadecimal digits
+    """
+    workers = max(workers, 1)
+    value = (uuid.uuid4().int >> 8) // workers * workers + worker
+    return '%032x' % value
+
+
+class Ticket:
+    """
+    A player waiting for an opponent
+    """
+    STATUS_WAITING = 'waiting'
+    STATUS_MATCHED = 'matched'
+
+    def __init__(self, player: str, size: int, mode: str, worker: int = 0, workers: int = 1):
+        self.id = ticket_id(worker, workers)
+        self.player = player
+        self.size = size
+        self.mode = mode
+        self.game = None
+        self.joined = self.seen = time.monotonic()
+        self.event = asyncio.Event()
+        # Amount of clients polling the ticket, it never expires meanwhile
+        self.polling = 0
+
+    @property
+    def status(self) -> str:
+        return self.STATUS_WAITING if self.game is None else self.STATUS_MATCHED
+
+    def dump(self) -> dict:
+        return {
+            'id': self.id,
+            'player': self.player,
+            'size': self.size,
+            'mode': self.mode,
+            'status': self.status,
+            'game': self.game,
+        }
+
+
+class Matchmaking:
+    """
+    Queues of the tickets of a worker, per board
+    """
+
+    def __init__(self, timeout: float = 60):
+        """
+        :param float timeout: seconds a ticket is kept without being polled
+        """
+        self.timeout = timeout
+        # (mode, size) -> ticket id -> ticket, oldest first
+        self.queues = {}
+        # ticket id -> ticket, waiting or matched
+        self.tickets = {}
+        # player -> waiting ticket
+        self.players = {}
+
+    def configure(self, timeout: float):
+        self.timeout = timeout
+
+    def waiting(self) -> int:
+        return len(self.players)
+
+    def stale(self, ticket: Ticket, now: float) -> bool:
+        return not ticket.polling and ticket.seen + self.timeout < now
+
+    def remove(self, ticket: Ticket):
+        """
+        Forget a ticket, waiting or matched
+        :param Ticket ticket:
+        :return:
+        """
+        self.tickets.pop(ticket.id, None)
+        if self.players.get(ticket.player) is ticket:
+            del self.players[ticket.player]
+        queue = self.queues.get((ticket.mode, ticket.size))
+        if queue is not None:
+            queue.pop(ticket.id, None)
+            if not queue:
+                del self.queues[(ticket.mode, ticket.size)]
+        metrics.set('matchmaking.waiting', self.waiting())
+
+    def opponent(self, mode: str, size: int, now: float):
+        """
+        Take the oldest ticket of a queue that is still alive
+        :return Ticket: None when nobody is waiting
+        """
+        queue = self.queues.get((mode, size))
+        while queue:
+            _, ticket = queue.popitem(last=False)
+            del self.players[ticket.player]
+            if not self.stale(ticket, now):
+                return ticket
+            self.tickets.pop(ticket.id, None)
+            metrics.inc('matchmaking.expired')
+        return None
+
+    async def create_game(self, players: list, size: int, mode: str) -> Game:
+        game = Game(players=players, size=size, mode=mode)
+        await game.commit()
+        return game
+
+    async def join(
+            self,
+            player: str,
+            size: int = 3,
+            mode: str = Game.MODE_CLASSIC,
+            worker: int = 0,
+            workers: int = 1,
+    ) -> Ticket:
+        """
+        Queue a player, or match them with the oldest player waiting
+        for the same board. A player already waiting gets their ticket
+        back.
+        :param str player: user id
+        :param int size: size of the board
+        :param str mode: classic or gomoku
+        :param int worker: position of the worker, see ticket_id
+        :param int workers: amount of workers of the pool
+        :return Ticket:
+        """
+        ticket = self.players.get(player)
+        if ticket is not None:
+            ticket.seen = time.monotonic()
+            return ticket
+        # Refuses the boards a game could not be created with
+        Game(players=[player, player], size=size, mode=mode).pre_insert()
+        now = time.monotonic()
+        ticket = Ticket(player, size, mode, worker, workers)
+        opponent = self.opponent(mode, size, now)
+        if opponent is None:
+            self.tickets[ticket.id] = ticket
+            self.players[player] = ticket
+            self.queues.setdefault((mode, size), OrderedDict())[ticket.id] = ticket
+            metrics.set('matchmaking.waiting', self.waiting())
+            return ticket
+        # Joining again meanwhile returns this ticket
+        self.tickets[ticket.id] = ticket
+        self.players[player] = ticket
+        try:
+            game = await self.create_game([opponent.player, player], size, mode)
+        except Exception:
+            self.remove(ticket)
+            # The opponent keeps their place
+            if opponent.player not in self.players:
+                queue = self.queues.setdefault((mode, size), OrderedDict())
+                queue[opponent.id] = opponent
+                queue.move_to_end(opponent.id, last=False)
+                self.players[opponent.player] = opponent
+                metrics.set('matchmaking.waiting', self.waiting())
+            raise
+        del self.players[player]
+        metrics.set('matchmaking.waiting', self.waiting())
+        ticket.game = opponent.game = str(game.pk)
+        opponent.event.set()
+        metrics.inc('matchmaking.matches')
+        metrics.add('matchmaking.seconds', now - opponent.joined)
+        logger.info('Matched %s and %s in game %s', opponent.player, player, ticket.game)
+        return ticket
+
+    def get(self, pk: str):
+        """
+        :param str pk: ticket id
+        :return Ticket: None when unknown or expired
+        """
+        ticket = self.tickets.get(pk)
+        if ticket is not None and self.stale(ticket, time.monotonic()):
+            self.remove(ticket)
+            metrics.inc('matchmaking.expired')
+            return None
+        return ticket
+
+    async def wait(self, ticket: Ticket, timeout: float) -> Ticket:
+        """
+        Wait until the ticket is matched or the timeout expires
+        :param Ticket ticket:
+        :param float timeout:
+        :return Ticket:
+        """
+        ticket.polling += 1
+        try:
+            await asyncio.wait_for(ticket.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            ticket.polling -= 1
+            ticket.seen = time.monotonic()
+        return ticket
+
+    def leave(self, ticket: Ticket):
+        """
+        Leave the queue, matched tickets are only forgotten
+        :param Ticket ticket:
+        :return:
+        """
+        self.remove(ticket)
+
+    def expire(self) -> int:
+        """
+        Drop the tickets nobody polled for the timeout
+        :return int: amount of tickets dropped
+        """
+        now = time.monotonic()
+        stale = [ticket for ticket in self.tickets.values() if self.stale(ticket, now)]
+        for ticket in stale:
+            self.remove(ticket)
+        if stale:
+            metrics.inc('matchmaking.expired', len(stale))
+        return len(stale)
+
+
+matchmaking = Matchmaking()
@@ -0,0 +1,152 @@
+"""
+Lightweight in-process metrics. Every worker keeps its own registry
+and periodically dumps a snapshot on a shared directory, so any worker
+is able to report the aggregated numbers of the whole deployment.
+"""
+import os
+import json
+import glob
+import time
+import threading
+from typing import Dict
+
+
+class Metrics:
+    """
+    Registry of counters and gauges for the current process.
+    Counters only go up, gauges can go in both directions. Updates are
+    locked, the pool listener of the database reports from the threads
+    of the driver.
+    """
+
+    def __init__(self):
+        """
+        Initializes the empty registry
+        """
+        self.counters: Dict[str, float] = {}
+        self.gauges: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1):
+        """
+        Increment a counter
+        :param str name: metric name
+        :param value: amount to add
+        :return:
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name: str, value: float):
+        """
+        Set a gauge to a given value
+        :param str name: metric name
+        :param value: current value
+        :return:
+        """
+        with self.lock:
+            self.gauges[name] = value
+
+    def add(self, name: str, value: float = 1):
+        """
+        Move a gauge up or down by the given amount
+        :param str name: metric name
+        :param value: amount to add, negative values are allowed
+        :return:
+        """
+        with self.lock:
+            self.gauges[name] = self.gauges.get(name, 0) + value
+
+    def get(self, name: str, default: float = 0) -> float:
+        """
+        Read the current value of a counter or gauge
+        :param str name: metric name
+        :param default: value returned when the metric does not exist
+        :return:
+        """
+        if name in self.gauges:
+            return self.gauges[name]
+        return self.counters.get(name, default)
+
+    def snapshot(self) -> dict:
+        """
+        Serializable copy of the current state of the registry
+        :return dict:
+        """
+        with self.lock:
+            return {
+                'pid': os.getpid(),
+                'timestamp': time.time(),
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+            }
+
+    def dump(self, directory: str):
+        """
+        Write the snapshot of this worker into the shared directory.
+        The file is replaced atomically so readers never get a partial
+        snapshot.
+        :param str directory: shared metrics directory
+        :return:
+        """
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, 'worker-%s.json' % os.getpid())
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as file:
+            json.dump(self.snapshot(), file)
+        os.replace(tmp, path)
+
+
+def discard(directory: str, pid: int):
+    """
+    Remove the snapshot of a worker that is not running anymore
+    :param str directory: shared metrics directory
+    :param int pid: process id of the worker
+    :return:
+    """
+    try:
+        os.remove(os.path.join(directory, 'worker-%s.json' % pid))
+    except FileNotFoundError:
+        pass
+
+
+def aggregate(snapshots) -> dict:
+    """
+    Sum the counters and gauges of a list of worker snapshots
+    :param snapshots: iterable of snapshots as produced by Metrics.snapshot
+    :return dict:
+    """
+    total = {'counters': {}, 'gauges': {}}
+    for snapshot in snapshots:
+        for kind in ('counters', 'gauges'):
+            for name, value in snapshot.get(kind, {}).items():
+                total[kind][name] = total[kind].get(name, 0) + value
+    return total
+
+
+def collect(directory: str = None) -> dict:
+    """
+    Build the metrics report for the whole deployment. The live registry
+    of the current worker is used instead of its (possibly outdated)
+    snapshot on disk.
+    :param str directory: shared metrics directory, None for single process
+    :return dict:
+    """
+    workers = {str(os.getpid()): metrics.snapshot()}
+    if directory:
+        for path in glob.glob(os.path.join(directory, 'worker-*.json')):
+            pid = os.path.basename(path)[len('worker-'):-len('.json')]
+            if pid in workers:
+                continue
+            try:
+                with open(path) as file:
+                    workers[pid] = json.load(file)
+            except (OSError, ValueError):
+                continue
+    return {
+        'workers': workers,
+        'total': aggregate(workers.values()),
+    }
+
+
+metrics = Metrics()
@@ -0,0 +1,117 @@
+"""
+Game tree search bot. Negamax with alpha-beta pruning, where positions
+are keyed by their canonical key (see app.tables) and the player to
+move, so the rotations and mirrors of a solved position are never
+searched again. The player to move is part of the key because games
+may be opened by either symbol.
+
+Positions with up to FULL_DEPTH free cells are solved exactly, which
+makes the bot perfect on 3x3 boards. Bigger boards are searched
+DEPTH moves ahead and unfinished lines count as a tie.
+"""
+from typing import Tuple
+
+from app.engine import AbstractBotStrategy, winning_move
+from app.tables import DIGITS, digits, position_key
+
+
+FULL_DEPTH = 9
+DEPTH = 3
+# Solved positions kept across moves, per board size
+MAX_SOLVED = 1000000
+
+solved = {}
+
+
+def opponent(symbol: int) -> int:
+    return DIGITS['O'] if symbol == DIGITS['X'] else DIGITS['X']
+
+
+def score_move(values: list, size: int, cell: int, symbol: int, empty: int, depth: int,
+               alpha: float, beta: float, cache: dict) -> int:
+    """
+    Score of playing a cell for the player to move: the amount of free
+    cells before the move when it wins, so sooner wins score higher,
+    negated when it loses and 0 for ties or when the depth runs out.
+    :param list values: flat digits of the board, restored on return
+    :param int size:
+    :param int cell: flat index of the move
+    :param int symbol: digit of the player to move
+    :param int empty: amount of free cells before the move
+    :param int depth: moves left to search, this one included
+    :param float alpha: lower bound of the search window
+    :param float beta: upper bound of the search window
+    :param dict cache: (canonical key, player to move) -> exact score of solved positions
+    :return int:
+    """
+    values[cell] = symbol
+    row, column = divmod(cell, size)
+    if winning_move(lambda i, j: values[i * size + j], size, row, column, size):
+        score = empty
+    elif empty == 1:
+        score = 0
+    else:
+        score = -search(values, size, opponent(symbol), empty - 1, depth - 1, -beta, -alpha, cache)
+    values[cell] = 0
+    return score
+
+
+def search(values: list, size: int, symbol: int, empty: int, depth: int,
+           alpha: float, beta: float, cache: dict) -> int:
+    """
+    Score of a position for the player to move, the best score of its
+    moves (see score_move)
+    :return int:
+    """
+    if depth == 0:
+        return 0
+    exact = depth >= empty
+    if exact:
+        key = (position_key(values, size), symbol)
+        if key in cache:
+            return cache[key]
+    window = alpha
+    best = -empty
+    for cell, value in enumerate(values):
+        if value:
+            continue
+        score = score_move(values, size, cell, symbol, empty, depth, alpha, beta, cache)
+        if score > best:
+            best = score
+        if best > alpha:
+            alpha = best
+        if alpha >= beta:
+            break
+    # Scores outside the window are only bounds
+    if exact and window < best < beta and len(cache) < MAX_SOLVED:
+        cache[key] = best
+    return best
+
+
+class MinimaxStrategy(AbstractBotStrategy):
+    """
+    Plays the move of highest negamax score. Equal moves are picked
+    at random so the bot does not always open the same way.
+    """
+
+    async def move(self) -> Tuple[int, int]:
+        values = digits(self.board)
+        symbol = DIGITS[self.symbol]
+        empty = values.count(0)
+        depth = empty if empty <= FULL_DEPTH else DEPTH
+        cache = solved.setdefault(self.size, {})
+        best = []
+        best_score = None
+        for cell, value in enumerate(values):
+            if value:
+                continue
+            score = score_move(
+                values, self.size, cell, symbol, empty, depth,
+                float('-inf'), float('inf'), cache,
+            )
+            if best_score is None or score > best_score:
+                best = [cell]
+                best_score = score
+            elif score == best_score:
+                best.append(cell)
+        return divmod(self.random.choice(best), self.size)
@@ -4,18 +4,210 @@ Module with the object definitions that are going to be stored
 import os
 import datetime
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
+from pymongo.write_concern import WriteConcern
 from tornado.web import HTTPError
-from umongo import Instance, \
+from marshmallow import missing
+from umongo import MotorAsyncIOInstance, \
     Document, \
     fields, \
     validate, \
     ValidationError
+from umongo.data_objects import Dict
+from umongo.document import DocumentImplementation
+from app.settings import Settings
+from app.context import current
+from app.metrics import metrics
 
 
-db = AsyncIOMotorClient(
-    os.getenv('DB_HOST', 'mongodb://localhost:27017'),
-)[os.getenv('DB_NAME', 'tictactoe')]
-instance = Instance(db)
+class PoolListener(monitoring.ConnectionPoolListener):
+    """
+    Keeps the pool gauges of the worker up to date: connections checked
+    out by the application and operations waiting for a connection.
+    """
+
+    def pool_created(self, event):
+        metrics.inc('mongo.pool.created')
+
+    def pool_cleared(self, event):
+        metrics.inc('mongo.pool.cleared')
+
+    def pool_closed(self, event):
+        metrics.inc('mongo.pool.closed')
+
+    def connection_created(self, event):
+        metrics.add('mongo.pool.connections')
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        metrics.add('mongo.pool.connections', -1)
+
+    def connection_check_out_started(self, event):
+        metrics.add('mongo.pool.wait_queue')
+
+    def connection_check_out_failed(self, event):
+        metrics.add('mongo.pool.wait_queue', -1)
+        metrics.inc('mongo.pool.check_out_failed.%s' % event.reason)
+
+    def connection_checked_out(self, event):
+        metrics.add('mongo.pool.wait_queue', -1)
+        metrics.add('mongo.pool.checked_out')
+
+    def connection_checked_in(self, event):
+        metrics.add('mongo.pool.checked_out', -1)
+
+
+class Database:
+    """
+    Thin wrapper of the motor database. Collections are built once and
+    some of them get their own options, like the write concern of the
+    move log.
+    """
+
+    def __init__(self, database, options: dict = None):
+        """
+        :param database: motor database
+        :param dict options: collection name -> get_collection keyword arguments
+        """
+        self.database = database
+        self.options = options or {}
+        self.collections = {}
+
+    def __getitem__(self, name: str):
+        if name not in self.collections:
+            self.collections[name] = self.database.get_collection(
+                name,
+                **self.options.get(name, {})
+            )
+        return self.collections[name]
+
+    def __getattr__(self, name: str):
+        return getattr(self.database, name)
+
+
+def create_client(settings: Settings) -> AsyncIOMotorClient:
+    """
+    Build the motor client with the pool configuration
+    :param Settings settings:
+    :return AsyncIOMotorClient:
+    """
+    options = {
+        'maxPoolSize': settings.db_max_pool_size,
+        'minPoolSize': settings.db_min_pool_size,
+        'serverSelectionTimeoutMS': settings.db_server_selection_timeout_ms,
+        'event_listeners': [PoolListener()],
+    }
+    if settings.db_wait_queue_timeout_ms is not None:
+        options['waitQueueTimeoutMS'] = settings.db_wait_queue_timeout_ms
+    if settings.db_compressors:
+        options['compressors'] = settings.db_compressors
+    metrics.set('mongo.pool.max_size', settings.db_max_pool_size)
+    return AsyncIOMotorClient(settings.db_host, **options)
+
+
+def collection_options(settings: Settings) -> dict:
+    """
+    Options of the collections that do not use the client defaults
+    :param Settings settings:
+    :return dict:
+    """
+    options = {}
+    if settings.db_moves_write_concern is not None or settings.db_moves_journal:
+        concern = {}
+        if settings.db_moves_write_concern is not None:
+            concern['w'] = settings.db_moves_write_concern
+        if settings.db_moves_journal:
+            concern['j'] = True
+        options['moves'] = {'write_concern': WriteConcern(**concern)}
+    return options
+
+
+class LazyInstance(MotorAsyncIOInstance):
+    """
+    ODM instance that creates its motor client on the first access to
+    the database. Importing the models or building the application does
+    no I/O, and a client never crosses a fork: a process that did not
+    create the client builds its own.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.settings = None
+        self.client = None
+        self.pid = None
+
+    def configure(self, settings: Settings):
+        """
+        Set the configuration used to build the client. The current
+        client of this process, if any, is closed.
+        :param Settings settings:
+        :return:
+        """
+        if self.client is not None and self.pid == os.getpid():
+            self.client.close()
+        self.settings = settings
+        self.client = None
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None or self.pid != os.getpid():
+            settings = self.settings or Settings()
+            self.client = create_client(settings)
+            self.pid = os.getpid()
+            self._db = Database(
+                self.client[settings.db_name],
+                collection_options(settings),
+            )
+        return self._db
+
+
+instance = LazyInstance()
+
+
+def cell_key(row: int, column: int) -> str:
+    """
+    Key of a cell on sparse boards
+    :param int row:
+    :param int column:
+    :return str:
+    """
+    return '%s,%s' % (row, column)
+
+
+class SparseBoard:
+    """
+    Read only matrix view of the occupied cells of a sparse board,
+    empty cells read as an empty string.
+    """
+
+    def __init__(self, cells: dict):
+        self.cells = cells
+
+    def __getitem__(self, row: int):
+        return SparseRow(self.cells, row)
+
+    def __iter__(self):
+        # Indexing never ends, iterating would walk rows forever
+        raise TypeError('Sparse boards cannot be iterated')
+
+
+class SparseRow:
+    """
+    Single row of a SparseBoard
+    """
+
+    def __init__(self, cells: dict, row: int):
+        self.cells = cells
+        self.row = row
+
+    def __getitem__(self, column: int) -> str:
+        return self.cells.get(cell_key(self.row, column), '')
+
+    def __iter__(self):
+        raise TypeError('Sparse rows cannot be iterated')
 
 
 @instance.register
@@ -73,6 +265,22 @@ class User(BaseDocument):
         default=0,
     )
 
+    losses = fields.IntField(
+        default=0,
+    )
+
+    ties = fields.IntField(
+        default=0,
+    )
+
+    games_played = fields.IntField(
+        default=0,
+    )
+
+    moves_played = fields.IntField(
+        default=0,
+    )
+
     created_at = fields.DateTimeField(
         default=datetime.datetime.now(),
     )
@@ -81,7 +289,7 @@ class User(BaseDocument):
         """
         ODM Metadata
         """
-        collection = db.users
+        collection_name = 'users'
 
 
 @instance.register
@@ -101,6 +309,18 @@ class Game(BaseDocument):
         STATUS_FINISHED,
     ]
 
+    MODE_CLASSIC = 'classic'
+    MODE_GOMOKU = 'gomoku'
+
+    MODES = [
+        MODE_CLASSIC,
+        MODE_GOMOKU,
+    ]
+
+    MAX_CLASSIC_SIZE = 10
+    MAX_GOMOKU_SIZE = 1000
+    DEFAULT_WIN_LENGTH = 5
+
     players = fields.ListField(
         fields.ReferenceField("User"),
     )
@@ -127,10 +347,47 @@ class Game(BaseDocument):
     winner = fields.ReferenceField("User")
 
     size = fields.IntegerField(
-        validate=[validate.Range(3, 10)],
+        validate=[validate.Range(3, MAX_GOMOKU_SIZE)],
         default=3,
     )
 
+    mode = fields.StrField(
+        validate=validate.OneOf(MODES),
+        default=MODE_CLASSIC,
+    )
+
+    # Amount of symbols in a row needed to win, gomoku games only.
+    # Classic games are won by filling a whole line.
+    win_length = fields.IntegerField(
+        validate=[validate.Range(3, MAX_GOMOKU_SIZE)],
+    )
+
+    # Occupied cells of gomoku games, "row,column" -> symbol. Big boards
+    # are mostly empty, so they are never stored as a matrix.
+    cells = fields.DictField()
+
+    # Name of the bot of single player games, see app.bots
+    bot = fields.StrField()
+
+    # Incremented by every move, clients poll it to see new moves
+    version = fields.IntField(
+        default=0,
+    )
+
+    # Set while the reply of the bot is computed in the background,
+    # the player cannot move until it is committed
+    bot_pending_since = fields.DateTimeField()
+
+    # Set while the move of a player is played, see claim_turn
+    move_pending_since = fields.DateTimeField(
+        load_only=True,
+    )
+
+    # Played on the server by app.simulations, left out of the statistics
+    simulated = fields.BoolField(
+        default=False,
+    )
+
     def pre_insert(self):
         """
         Fill the board and do multiplayer validations
@@ -147,22 +404,237 @@ class Game(BaseDocument):
             self.multiplayer = True
         else:
             self.multiplayer = False
-
+        self.validate_bot()
+
+        if self.mode == self.MODE_GOMOKU:
+            if self.win_length is None:
+                self.win_length = min(self.DEFAULT_WIN_LENGTH, self.size)
+            if self.win_length > self.size:
+                raise ValidationError(
+                    "The win length cannot be bigger than the board"
+                )
+            self.cells = {}
+            return
+
+        if self.size > self.MAX_CLASSIC_SIZE:
+            raise ValidationError(
+                "Classic boards are limited to %s" % self.MAX_CLASSIC_SIZE
+            )
         self.board = [["" for i in range(self.size)] for y in range(self.size)]
         pass
 
+    def validate_bot(self):
+        """
+        Single player games get the default bot unless they pick one
+        """
+        bots = current().bots
+        if self.multiplayer:
+            if self.bot is not None:
+                raise ValidationError("Multiplayer games have no bot")
+            return
+        if self.bot is None:
+            self.bot = bots.default
+        elif self.bot not in bots:
+            raise ValidationError("Unknown bot %s" % self.bot)
+        if self.sparse and not bots.get(self.bot).strategy.sparse:
+            raise ValidationError("Bot %s cannot play gomoku games" % self.bot)
+
+    async def claim_turn(self, stale: float = 30) -> bool:
+        """
+        Lock the game for a move. The update only matches while nobody
+        else moved, no bot reply is pending and no other move holds the
+        lock, so of several concurrent submissions only one gets the
+        turn. The commit of the game after the move releases the lock
+        (see GameEngine.validate_board), so does release_turn when the
+        move fails. Locks older than the stale seconds, left by a worker
+        that died, are taken over.
+        :param float stale: seconds after which a lock is taken over
+        :return bool: whether the turn was claimed
+        """
+        version = self.version or 0
+        now = datetime.datetime.utcnow()
+        # Mongo keeps milliseconds, the commit matches the stored value
+        now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+        claimed = await self.collection.find_one_and_update(
+            {
+                '_id': self.pk,
+                # Games created before versions existed have none
+                'version': version if version else {'$in': [0, None]},
+                'bot_pending_since': None,
+                '$or': [
+                    {'move_pending_since': None},
+                    {'move_pending_since': {'$lt': now - datetime.timedelta(seconds=stale)}},
+                ],
+            },
+            {'$set': {'move_pending_since': now}},
+            projection={'_id': 1},
+        )
+        if claimed is None:
+            return False
+        self.move_pending_since = now
+        return True
+
+    async def release_turn(self, claim: datetime.datetime = None):
+        """
+        Release the lock of claim_turn when the move was not played
+        :param datetime.datetime claim: time of the claim, the one of the
+        game by default
+        :return:
+        """
+        claim = claim or self.move_pending_since
+        if claim is None:
+            return
+        if self.move_pending_since is not None:
+            del self.move_pending_since
+        await self.collection.update_one(
+            {'_id': self.pk, 'move_pending_since': claim},
+            {'$unset': {'move_pending_since': ''}},
+        )
+
+    @property
+    def sparse(self) -> bool:
+        """
+        Whether the board is stored as a set of occupied cells
+        :return bool:
+        """
+        return self.mode == self.MODE_GOMOKU
+
+    def get_cell(self, row: int, column: int) -> str:
+        """
+        Symbol on a cell, empty string when the cell is free
+        :param int row:
+        :param int column:
+        :return str:
+        """
+        if self.sparse:
+            return self.cells.get(cell_key(row, column), '')
+        return self.board[row][column]
+
+    def set_cell(self, row: int, column: int, symbol: str):
+        """
+        Put a symbol on a cell
+        :param int row:
+        :param int column:
+        :param str symbol:
+        :return:
+        """
+        if self.sparse:
+            self.cells[cell_key(row, column)] = symbol
+        else:
+            self.board[row][column] = symbol
+
+    def board_view(self):
+        """
+        Board that can be read as a matrix, board[row][column], without
+        expanding sparse boards.
+        :return:
+        """
+        if self.sparse:
+            return SparseBoard(self.cells)
+        return self.board
+
+    def count_moves(self) -> int:
+        """
+        Amount of moves played on the board
+        :return int:
+        """
+        if self.sparse:
+            return len(self.cells)
+        return sum(1 for row in self.board for cell in row if cell != '')
+
     class Meta:
         """
         ODM Metadata
         """
-        collection = db.games
+        collection_name = 'games'
+
+
+# Cells of the moves are stored as row * CELL_BASE + column, boards are
+# never bigger than MAX_GOMOKU_SIZE
+CELL_BASE = 1024
+
+# Names of the fields of the moves before they were stored compacted,
+# see app.compact_moves
+LEGACY_MOVE_FIELDS = {
+    'game': 'g',
+    'cell': 'c',
+    'symbol': 's',
+    'player': 'p',
+    'idempotency_key': 'k',
+}
+
+
+def encode_cell(cell: dict):
+    """
+    :param dict cell: {"row": r, "column": c}
+    :return int: index of the cell, None when it is not a valid cell
+    """
+    row = cell.get('row')
+    column = cell.get('column')
+    if type(row) is not int or type(column) is not int \
+            or not 0 <= row < CELL_BASE or not 0 <= column < CELL_BASE:
+        return None
+    return row * CELL_BASE + column
+
+
+def decode_cell(value) -> dict:
+    """
+    :param value: stored cell, an index or a legacy {"row": r, "column": c}
+    :return dict:
+    """
+    if isinstance(value, dict):
+        return value
+    return {'row': value // CELL_BASE, 'column': value % CELL_BASE}
+
+
+def compact_move(document: dict) -> dict:
+    """
+    Raw move in the compact schema. Legacy documents get the short field
+    names and the cell index, and lose their created_at, which is the
+    time of their id.
+    :param dict document: raw move, compact or legacy
+    :return dict: the same document when it is already compact
+    """
+    if not any(key in document for key in LEGACY_MOVE_FIELDS) and 'created_at' not in document \
+            and not isinstance(document.get('c'), dict):
+        return document
+    result = {}
+    for key, value in document.items():
+        if key == 'created_at':
+            continue
+        key = LEGACY_MOVE_FIELDS.get(key, key)
+        if key == 'c' and isinstance(value, dict):
+            index = encode_cell(value)
+            value = value if index is None else index
+        result[key] = value
+    return result
+
+
+class CellField(fields.DictField):
+    """
+    Cell of a move, {"row": r, "column": c} in the API and a single
+    integer in mongo
+    """
+
+    def _serialize_to_mongo(self, obj):
+        if obj is None:
+            return missing
+        index = encode_cell(obj)
+        return dict(obj) if index is None else index
+
+    def _deserialize_from_mongo(self, value):
+        if isinstance(value, int):
+            return Dict(decode_cell(value))
+        return super()._deserialize_from_mongo(value)
 
 
 @instance.register
 class GameMove(BaseDocument):
     """
     This collection will track the moves of the users
-    on the given game
+    on the given game. The documents are kept small: short field names
+    (see LEGACY_MOVE_FIELDS) and the cell as an integer, the creation
+    time is the one of the id. Raw queries use the stored names.
     """
 
     SYMBOLS = [
@@ -172,28 +644,115 @@ class GameMove(BaseDocument):
 
     game = fields.ReferenceField(
         "Game",
+        attribute='g',
     )
 
-    cell = fields.DictField(
-        required=True
+    cell = CellField(
+        required=True,
+        attribute='c',
     )
 
     symbol = fields.StrField(
         validate=validate.OneOf(SYMBOLS),
         required=True,
+        attribute='s',
     )
 
     player = fields.ReferenceField(
         "User",
         required=True,
+        attribute='p',
     )
 
-    created_at = fields.DateTimeField(
-        default=datetime.datetime.now(),
+    # Idempotency-Key of the submission, see app.idempotency
+    idempotency_key = fields.StrField(
+        load_only=True,
+        attribute='k',
+    )
+
+    @classmethod
+    def build_from_mongo(cls, data, partial=False, use_cls=False):
+        """
+        Legacy documents, such as the moves of old archive segments, are
+        read as well
+        """
+        # Templates are not part of the classes umongo builds from them,
+        # super() cannot be used in their methods
+        return DocumentImplementation.build_from_mongo.__func__(
+            cls, compact_move(data), partial=partial, use_cls=use_cls,
+        )
+
+    def dump(self):
+        """
+        The creation time of the move is the one of its id
+        :return dict:
+        """
+        data = DocumentImplementation.dump(self)
+        if self.pk is not None:
+            data['created_at'] = self.pk.generation_time.isoformat()
+        return data
+
+    class Meta:
+        """
+        ODM Metadata
+        """
+        collection_name = 'moves'
+        # Raw names, umongo does not translate the indexes
+        indexes = [
+            # Moves of a game in the order they were played
+            ('g', '_id'),
+            {
+                'key': ['g', 'k'],
+                'unique': True,
+                'partialFilterExpression': {'k': {'$exists': True}},
+            },
+        ]
+
+
+@instance.register
+class GameSnapshot(BaseDocument):
+    """
+    Board of a game after a number of moves, replays start from the
+    closest snapshot instead of the first move (see app.replay). Cells
+    are encoded as the ones of the moves.
+    """
+
+    game = fields.ReferenceField(
+        "Game",
+        required=True,
+        attribute='g',
+    )
+
+    # Amount of moves played on the board
+    number = fields.IntField(
+        required=True,
+        attribute='n',
+    )
+
+    # Id of the last move played, the replay goes on after it
+    move = fields.ObjectIdField(
+        required=True,
+        attribute='m',
+    )
+
+    crosses = fields.ListField(
+        fields.IntField(),
+        attribute='x',
+    )
+
+    noughts = fields.ListField(
+        fields.IntField(),
+        attribute='o',
     )
 
     class Meta:
         """
         ODM Metadata
         """
-        collection = db.moves
+        collection_name = 'snapshots'
+        indexes = [
+            {
+                'key': ['g', 'n'],
+                'unique': True,
+            },
+        ]
@@ -0,0 +1,101 @@
+"""
+Public data of the players embedded in game responses (?expand=players).
+The users of a page of games are read with a single $in query and kept
+in a small LRU cache. Entries expire after a while, so usernames edited
+through another worker are eventually seen.
+"""
+import time
+from collections import OrderedDict
+from typing import Iterable
+
+from bson import ObjectId
+
+from app.metrics import metrics
+from app.models import User
+
+
+class PlayerCache:
+    """
+    LRU cache of user id -> public data of the user
+    """
+
+    def __init__(self, size: int = 1024, ttl: float = 60):
+        """
+        :param int size: maximum amount of users kept
+        :param float ttl: seconds an entry is served
+        """
+        self.size = size
+        self.ttl = ttl
+        # user id -> (expiry, data), least recently used first
+        self.entries = OrderedDict()
+
+    def configure(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def discard(self, pk: str):
+        """
+        Forget a user that was edited or removed
+        :param str pk:
+        :return:
+        """
+        self.entries.pop(pk, None)
+
+    def store(self, pk: str, data: dict):
+        self.entries[pk] = (time.monotonic() + self.ttl, data)
+        self.entries.move_to_end(pk)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    async def resolve(self, pks: Iterable[str]) -> dict:
+        """
+        Public data of several users, the missing ones are read with a
+        single query. Users that do not exist are left out.
+        :param pks: user ids
+        :return dict: user id -> data
+        """
+        now = time.monotonic()
+        found = {}
+        missing = set()
+        for pk in pks:
+            entry = self.entries.get(pk)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(pk)
+                found[pk] = entry[1]
+            else:
+                missing.add(pk)
+        metrics.inc('players.cache.hits', len(found))
+        if missing:
+            metrics.inc('players.cache.misses', len(missing))
+            cursor = User.collection.find(
+                {'_id': {'$in': [ObjectId(pk) for pk in missing]}},
+                {'username': 1},
+            )
+            async for document in cursor:
+                pk = str(document['_id'])
+                found[pk] = {'id': pk, 'username': document.get('username')}
+                self.store(pk, found[pk])
+        return found
+
+    async def expand(self, games: list):
+        """
+        Replace the ids of the players and winners of dumped games by
+        the data of the users, in place. Users that do not exist keep
+        their id only.
+        :param list games: dumped games
+        :return:
+        """
+        pks = set()
+        for game in games:
+            pks.update(game.get('players', []))
+            if game.get('winner'):
+                pks.add(game['winner'])
+        users = await self.resolve(pks)
+        for game in games:
+            game['players'] = [users.get(pk, {'id': pk}) for pk in game.get('players', [])]
+            if game.get('winner'):
+                game['winner'] = users.get(game['winner'], {'id': game['winner']})
+
+
+players = PlayerCache()
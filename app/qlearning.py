@@ -0,0 +1,240 @@
+"""
+Tabular reinforcement learning bot. The value of every afterstate, the
+board right after a move, is learnt offline with TD(0) through
+self-play and stored as a compact table file (see app.tables):
+
+    python -m app.qlearning --size 3 --episodes 200000 --output data/values-3.table
+
+Values are seen from the player who just moved: 1 is a win, -1 a loss
+and 0 a tie. Afterstates are keyed with the symbols of that player as X,
+so games opened by either symbol share the table. At serve time the
+table of the board size is memory-mapped on first use and a move costs
+one lookup per free cell.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from typing import Tuple
+
+from app.engine import AbstractBotStrategy, RandomStrategy, winning_move
+from app.settings import Settings
+from app.tables import DIGITS, Table, digits, position_key, write_table
+
+
+DTYPE = '<f4'
+SWAPPED = {DIGITS['']: DIGITS[''], DIGITS['X']: DIGITS['O'], DIGITS['O']: DIGITS['X']}
+
+
+class ValueTables:
+    """
+    Value tables of every board size, loaded lazily from a directory.
+    Sizes without a file are remembered as missing.
+    """
+
+    def __init__(self, directory: str = None, pattern: str = 'values-%s.table'):
+        """
+        :param str directory:
+        :param str pattern: name of the file of a size
+        """
+        self.directory = directory
+        self.pattern = pattern
+        self.loaded = {}
+
+    def configure(self, directory: str):
+        """
+        Read the tables from another directory
+        :param str directory:
+        :return:
+        """
+        self.directory = directory
+        self.loaded = {}
+
+    def path(self, size: int) -> str:
+        return os.path.join(self.directory, self.pattern % size)
+
+    def get(self, size: int):
+        """
+        Table of a board size
+        :param int size:
+        :return Table: None when it was never trained
+        """
+        if size not in self.loaded:
+            path = self.path(size)
+            self.loaded[size] = Table(path) if os.path.exists(path) else None
+        return self.loaded[size]
+
+
+value_tables = ValueTables(Settings().tables_dir)
+
+
+def afterstate_key(values: list, mover: int, size: int) -> int:
+    """
+    Key of the board right after a move, with the symbols swapped
+    when O moved so the mover always reads as X
+    :param list values: flat digits of the board
+    :param int mover: digit of the player who just moved
+    :param int size:
+    :return int:
+    """
+    if mover == DIGITS['O']:
+        values = [SWAPPED[value] for value in values]
+    return position_key(values, size)
+
+
+def best_cells(values: list, symbol: int, size: int, lookup) -> list:
+    """
+    Free cells leading to the afterstate of highest value
+    :param list values: flat digits of the board, restored on return
+    :param int symbol: digit of the player to move
+    :param int size:
+    :param lookup: callable key -> value, 0 for unknown positions
+    :return list: flat indices of the best cells
+    """
+    best = []
+    best_value = None
+    for cell, value in enumerate(values):
+        if value:
+            continue
+        values[cell] = symbol
+        score = lookup(afterstate_key(values, symbol, size))
+        values[cell] = 0
+        if best_value is None or score > best_value:
+            best = [cell]
+            best_value = score
+        elif score == best_value:
+            best.append(cell)
+    return best
+
+
+def train(
+        size: int = 3,
+        episodes: int = 100000,
+        win_length: int = None,
+        alpha: float = 0.1,
+        epsilon: float = 0.1,
+        seed: int = 0,
+        progress=None,
+) -> dict:
+    """
+    Learn the afterstate values by playing the table against itself.
+    Both players move epsilon-greedily and, once a game is over, every
+    afterstate is moved towards the negated value of the next one,
+    walking back from the final reward.
+    :param int size: size of the board
+    :param int episodes: amount of games played
+    :param int win_length: symbols in a row needed to win, size by default
+    :param float alpha: learning rate
+    :param float epsilon: probability of an exploratory random move
+    :param int seed:
+    :param progress: optional callable receiving the amount of games played
+    :return dict: position key -> value
+    """
+    win_length = win_length or size
+    rng = random.Random(seed)
+    table = {}
+
+    def lookup(key):
+        return table.get(key, 0.0)
+
+    for episode in range(episodes):
+        board = [0] * (size * size)
+
+        def get_cell(row, column):
+            return board[row * size + column]
+
+        keys = []
+        symbol = DIGITS['X']
+        while True:
+            if rng.random() < epsilon:
+                cell = rng.choice([i for i, value in enumerate(board) if not value])
+            else:
+                cell = rng.choice(best_cells(board, symbol, size, lookup))
+            board[cell] = symbol
+            keys.append(afterstate_key(board, symbol, size))
+            row, column = divmod(cell, size)
+            if winning_move(get_cell, size, row, column, win_length):
+                target = 1.0
+                break
+            if len(keys) == size * size:
+                target = 0.0
+                break
+            symbol = DIGITS['O'] if symbol == DIGITS['X'] else DIGITS['X']
+
+        for key in reversed(keys):
+            value = table.get(key, 0.0)
+            value += alpha * (target - value)
+            table[key] = value
+            target = -value
+
+        if progress and (episode + 1) % 1000 == 0:
+            progress(episode + 1)
+    return table
+
+
+class QLearningStrategy(AbstractBotStrategy):
+    """
+    Picks the move leading to the afterstate of highest learnt value.
+    Ties are broken at random. Board sizes without a trained table are
+    played at random.
+    """
+
+    async def move(self) -> Tuple[int, int]:
+        table = value_tables.get(self.size)
+        if table is None:
+            return await RandomStrategy(self.symbol, self.size, self.board, self.random).move()
+
+        def lookup(key):
+            return float(table.get(key, 0.0))
+
+        values = digits(self.board)
+        cells = best_cells(values, DIGITS[self.symbol], self.size, lookup)
+        return divmod(self.random.choice(cells), self.size)
+
+
+def main():
+    """
+    Command line entry point
+    :return:
+    """
+    parser = argparse.ArgumentParser(description='Train the value table of the qlearning bot')
+    parser.add_argument('--size', type=int, default=3)
+    parser.add_argument('--episodes', type=int, default=200000)
+    parser.add_argument('--win-length', type=int, default=None)
+    parser.add_argument('--alpha', type=float, default=0.1)
+    parser.add_argument('--epsilon', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='values-<size>.table in TABLES_DIR by default')
+    arguments = parser.parse_args()
+
+    started = time.monotonic()
+
+    def progress(played):
+        rate = played / max(time.monotonic() - started, 1e-9)
+        sys.stderr.write('\r%s games, %.0f games/s' % (played, rate))
+
+    table = train(
+        arguments.size,
+        arguments.episodes,
+        win_length=arguments.win_length,
+        alpha=arguments.alpha,
+        epsilon=arguments.epsilon,
+        seed=arguments.seed,
+        progress=progress,
+    )
+    sys.stderr.write('\n')
+    output = arguments.output or value_tables.path(arguments.size)
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    write_table(output, table, DTYPE)
+    print(json.dumps({
+        'positions': len(table),
+        'bytes': os.path.getsize(output),
+        'seconds': time.monotonic() - started,
+        'output': output,
+    }))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""
+Replays of games: the board as it was after any move, for
+GET /api/games/{game_id}?at=<move>. Every SNAPSHOT_INTERVAL moves the
+board is saved in a snapshot next to the moves, a replay starts from the
+closest snapshot and reads SNAPSHOT_INTERVAL moves at most. Games played
+before, or written in bulk by the simulations, get their snapshots the
+first time they are replayed.
+
+Finished games never change, their frames are kept in a bounded LRU
+cache of the worker. Archived games are replayed from their segment.
+"""
+from collections import OrderedDict
+
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from tornado.web import HTTPError
+
+from app.context import current
+from app.metrics import metrics
+from app.models import Game, GameMove, GameSnapshot, compact_move, decode_cell, encode_cell
+
+
+class Replays:
+    """
+    Snapshots of the boards and cache of the replayed frames
+    """
+
+    def __init__(self, interval: int = 10, cache_size: int = 1000):
+        """
+        :param int interval: moves between snapshots, 0 disables them
+        :param int cache_size: maximum amount of frames of finished games kept
+        """
+        self.interval = interval
+        self.cache_size = cache_size
+        # (game id, move number) -> dumped game, least recently used first
+        self.frames = OrderedDict()
+
+    def configure(self, interval: int, cache_size: int):
+        self.interval = interval
+        self.cache_size = cache_size
+        self.frames = OrderedDict()
+
+    def due(self, number: int) -> bool:
+        return self.interval > 0 and number > 0 and number % self.interval == 0
+
+    @staticmethod
+    def snapshot(pk, number: int, move, cells: dict) -> dict:
+        """
+        Raw snapshot of a board
+        :param pk: game id
+        :param int number: amount of moves played
+        :param move: id of the last move
+        :param dict cells: encoded cell -> symbol
+        :return dict:
+        """
+        return GameSnapshot(
+            game=pk,
+            number=number,
+            move=move,
+            crosses=sorted(cell for cell, symbol in cells.items() if symbol == 'X'),
+            noughts=sorted(cell for cell, symbol in cells.items() if symbol == 'O'),
+        ).to_mongo()
+
+    def board_snapshot(self, game: Game, move) -> dict:
+        """
+        Snapshot of the board of a game after a move, when one is due
+        :param Game game:
+        :param move: id of the move
+        :return dict: raw snapshot, None when not due
+        """
+        number = game.count_moves()
+        if not self.due(number):
+            return None
+        if game.sparse:
+            occupied = [
+                (*map(int, key.split(',')), symbol) for key, symbol in game.cells.items()
+            ]
+        else:
+            occupied = [
+                (row, column, symbol)
+                for row, line in enumerate(game.board)
+                for column, symbol in enumerate(line) if symbol
+            ]
+        cells = {
+            encode_cell({'row': row, 'column': column}): symbol
+            for row, column, symbol in occupied
+        }
+        return self.snapshot(game.pk, number, move, cells)
+
+    async def write(self, snapshots: list):
+        """
+        :param list snapshots: raw snapshots, existing ones are kept
+        :return:
+        """
+        if not snapshots:
+            return
+        try:
+            await GameSnapshot.collection.insert_many(snapshots, ordered=False)
+        except BulkWriteError as error:
+            if any(failure['code'] != 11000 for failure in error.details['writeErrors']):
+                raise
+        metrics.inc('replays.snapshots', len(snapshots))
+
+    async def take(self, game: Game, move):
+        """
+        Save the board of a game after a move, when a snapshot is due
+        :param Game game:
+        :param move: id of the move
+        :return:
+        """
+        snapshot = self.board_snapshot(game, move)
+        if snapshot is not None:
+            try:
+                await GameSnapshot.collection.insert_one(snapshot)
+            except DuplicateKeyError:
+                return
+            metrics.inc('replays.snapshots')
+
+    def cached(self, key: tuple):
+        frame = self.frames.get(key)
+        if frame is not None:
+            self.frames.move_to_end(key)
+        return frame
+
+    def store(self, key: tuple, frame: dict):
+        self.frames[key] = frame
+        self.frames.move_to_end(key)
+        while len(self.frames) > self.cache_size:
+            self.frames.popitem(last=False)
+
+    async def closest(self, pk, number: int) -> dict:
+        """
+        :param pk: game id
+        :param int number: amount of moves
+        :return dict: raw snapshot of the most moves up to the number, None without any
+        """
+        return await GameSnapshot.collection.find_one(
+            {'g': pk, 'n': {'$lte': number}},
+            sort=[('n', -1)],
+        )
+
+    async def moves(self, pk, after, limit: int) -> list:
+        """
+        :param pk: game id
+        :param after: id of the last move of the snapshot, None from the first move
+        :param int limit:
+        :return list: raw moves in the order they were played
+        """
+        query = {'g': pk}
+        if after is not None:
+            query['_id'] = {'$gt': after}
+        return await GameMove.collection.find(query, sort=[('_id', 1)]).limit(limit).to_list(None)
+
+    async def replay(self, game: Game, number: int) -> dict:
+        """
+        Cells of a game after a number of moves, from the closest
+        snapshot. The snapshots missing on the way are saved.
+        :param Game game:
+        :param int number:
+        :return dict: encoded cell -> symbol
+        """
+        cells = {}
+        start, after = 0, None
+        snapshot = await self.closest(game.pk, number)
+        if snapshot is not None:
+            start, after = snapshot['n'], snapshot['m']
+            cells.update((cell, 'X') for cell in snapshot.get('x', []))
+            cells.update((cell, 'O') for cell in snapshot.get('o', []))
+        moves = []
+        archived = False
+        if number > start:
+            moves = await self.moves(game.pk, after, number - start)
+        if len(moves) < number - start:
+            record = current().archive.get(str(game.pk))
+            if record is None:
+                raise HTTPError(404, 'Move %s was not found' % number)
+            cells, start, archived = {}, 0, True
+            moves = record['moves'][:number]
+        missing = []
+        for position, move in enumerate(moves, start + 1):
+            move = compact_move(move)
+            cells[move['c']] = move['s']
+            if self.due(position):
+                missing.append(self.snapshot(game.pk, position, move['_id'], cells))
+        metrics.inc('replays.moves', len(moves))
+        # Archived games keep no snapshots in mongo
+        if not archived:
+            await self.write(missing)
+        return cells
+
+    async def frame(self, game: Game, number: int) -> dict:
+        """
+        Game as it was after a number of moves
+        :param Game game:
+        :param int number: 0 is the empty board
+        :return dict: dumped game, along with the number as "at"
+        """
+        total = game.count_moves()
+        if not 0 <= number <= total:
+            raise HTTPError(400, 'Invalid move number')
+        finished = game.status in [Game.STATUS_FINISHED, Game.STATUS_TIE]
+        key = (str(game.pk), number)
+        if finished:
+            frame = self.cached(key)
+            if frame is not None:
+                metrics.inc('replays.cached')
+                return frame
+        if number == total:
+            frame = game.dump()
+        else:
+            replayed = Game.build_from_mongo(game.to_mongo())
+            if replayed.sparse:
+                replayed.cells = {}
+            else:
+                replayed.board = [['' for _ in range(game.size)] for _ in range(game.size)]
+            for cell, symbol in (await self.replay(game, number)).items():
+                cell = decode_cell(cell)
+                replayed.set_cell(cell['row'], cell['column'], symbol)
+            replayed.status = Game.STATUS_IN_PROGRESS
+            for name in ('winner', 'bot_pending_since'):
+                if getattr(replayed, name) is not None:
+                    delattr(replayed, name)
+            frame = replayed.dump()
+        frame['at'] = number
+        if finished:
+            self.store(key, frame)
+        return frame
+
+
+replays = Replays()
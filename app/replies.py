@@ -0,0 +1,150 @@
+"""
+Bot replies computed in the background. The move of the player is
+committed along with a pending flag and answered right away, the bot
+move is committed later and wakes up the clients polling the game.
+
+Until the reply is committed the game refuses the moves of the player,
+so the order of the moves is kept. Replies lost with their worker are
+resumed by the periodic task once they are older than BOT_REPLY_TIMEOUT.
+"""
+import asyncio
+import datetime
+import logging
+import time
+from app.context import current
+from app.engine import GameEngine
+from app.metrics import metrics
+from app.models import Game, GameMove
+
+
+logger = logging.getLogger(__name__)
+
+engine = GameEngine()
+
+
+class Replies:
+    """
+    Background replies of a worker and the clients waiting for them
+    """
+
+    def __init__(self, stale: float = 30):
+        """
+        :param float stale: seconds after which a pending reply is resumed
+        """
+        self.stale = stale
+        self.tasks = set()
+        # game id -> [event, amount of clients waiting on it]
+        self.waiters = {}
+
+    def configure(self, stale: float):
+        self.stale = stale
+
+    def schedule(self, game: Game, move: GameMove) -> asyncio.Task:
+        """
+        Compute and commit the reply to a move in the background
+        :param Game game: game waiting for the reply
+        :param GameMove move: move of the player
+        :return asyncio.Task:
+        """
+        task = asyncio.ensure_future(self.reply(game, move))
+        self.tasks.add(task)
+        metrics.set('bots.replies.pending', len(self.tasks))
+        task.add_done_callback(self.done)
+        return task
+
+    def done(self, task: asyncio.Task):
+        self.tasks.discard(task)
+        metrics.set('bots.replies.pending', len(self.tasks))
+
+    async def reply(self, game: Game, move: GameMove):
+        """
+        Play the move of the bot. Failures leave the game pending, it
+        is retried by resume.
+        :param Game game:
+        :param GameMove move:
+        :return:
+        """
+        started = time.monotonic()
+        try:
+            bot_move = await current().bots.get(game.bot).move(game, move)
+            await engine.execute_move(game, bot_move)
+        except Exception:
+            metrics.inc('bots.replies.errors')
+            logger.exception('Reply to game %s failed', game.pk)
+            return
+        metrics.inc('bots.replies.committed')
+        metrics.add('bots.replies.seconds', time.monotonic() - started)
+        self.notify(str(game.pk))
+
+    def notify(self, pk: str):
+        """
+        Wake up the clients of this worker waiting for a game
+        :param str pk:
+        :return:
+        """
+        waiting = self.waiters.pop(pk, None)
+        if waiting is not None:
+            waiting[0].set()
+
+    async def wait(self, pk: str, timeout: float):
+        """
+        Wait until a reply to the game is committed by this worker or
+        the timeout expires
+        :param str pk:
+        :param float timeout:
+        :return:
+        """
+        waiting = self.waiters.setdefault(pk, [asyncio.Event(), 0])
+        waiting[1] += 1
+        try:
+            await asyncio.wait_for(waiting[0].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            waiting[1] -= 1
+            if not waiting[1] and self.waiters.get(pk) is waiting:
+                del self.waiters[pk]
+
+    async def drain(self, timeout: float):
+        """
+        Wait for the replies in progress, used when the worker stops
+        :param float timeout:
+        :return:
+        """
+        if self.tasks:
+            await asyncio.wait(list(self.tasks), timeout=timeout)
+
+    async def resume(self) -> int:
+        """
+        Reply to the games pending for longer than the stale delay. Each
+        game is claimed by moving its pending date forward, so a single
+        worker picks it up.
+        :return int: amount of replies resumed
+        """
+        now = datetime.datetime.utcnow()
+        stale = self.stale
+        cursor = Game.collection.find(
+            {
+                'status': Game.STATUS_IN_PROGRESS,
+                'bot_pending_since': {'$lt': now - datetime.timedelta(seconds=stale)},
+            },
+            {'bot_pending_since': 1},
+        )
+        resumed = 0
+        async for document in cursor:
+            claimed = await Game.collection.find_one_and_update(
+                {'_id': document['_id'], 'bot_pending_since': document['bot_pending_since']},
+                {'$set': {'bot_pending_since': now}},
+            )
+            if claimed is None:
+                continue
+            game = await Game.find_one({'_id': document['_id']})
+            move = await GameMove.find_one({'game': game.pk}, sort=[('_id', -1)])
+            self.schedule(game, move)
+            resumed += 1
+        if resumed:
+            logger.warning('Resumed %s bot replies', resumed)
+        return resumed
+
+
+replies = Replies()
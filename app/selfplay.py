@@ -0,0 +1,294 @@
+"""
+Headless self-play: games between two bot strategies played in memory,
+without HTTP or mongo, split across a pool of processes.
+
+    python -m app.selfplay --games 1000000 --x random --o random \\
+        --size 3 --seed 42 --output games.ndjson
+
+Every game is seeded from the global seed and its own index, so the
+output only depends on the seed, whatever the amount of workers.
+"""
+import sys
+import json
+import time
+import struct
+import random
+import argparse
+import multiprocessing
+from typing import List, Tuple
+
+from app.engine import winning_move
+from app.strategies import get_strategy
+
+
+OUTCOME_TIE = 'tie'
+
+FORMAT_NDJSON = 'ndjson'
+FORMAT_BINARY = 'binary'
+
+# Binary files start with the magic, the format version, the board size
+# and the win length. Then every game is the outcome (0 tie, 1 X, 2 O),
+# the amount of moves and the moves as row * size + column.
+MAGIC = b'TTTS'
+HEADER = struct.Struct('<4sBHH')
+RECORD = struct.Struct('<BH')
+BINARY_OUTCOMES = [OUTCOME_TIE, 'X', 'O']
+
+
+class IllegalMove(Exception):
+    """
+    A strategy picked a cell that does not exist or is not empty
+    """
+
+
+def drive(coroutine):
+    """
+    Run a strategy move to completion without an event loop. Strategies
+    compute their move in memory, so the coroutine ends on its first step.
+    :param coroutine:
+    :return: the result of the coroutine
+    """
+    try:
+        coroutine.send(None)
+    except StopIteration as stop:
+        return stop.value
+    coroutine.close()
+    raise RuntimeError('Strategies cannot wait on I/O during self-play')
+
+
+def game_seed(seed: int, index: int) -> str:
+    """
+    Seed of a single game
+    :param int seed: global seed
+    :param int index: position of the game
+    :return str:
+    """
+    return '%s:%s' % (seed, index)
+
+
+def play(
+        x_strategy,
+        o_strategy,
+        size: int,
+        win_length: int,
+        timings: dict = None,
+        opening: List[int] = (),
+        rng: random.Random = None,
+) -> Tuple[str, List[int]]:
+    """
+    Play a game following the rules of GameEngine: X moves first and the
+    players alternate until one of them gets win_length symbols in a row
+    or the board is full.
+    :param x_strategy: strategy class of X
+    :param o_strategy: strategy class of O
+    :param int size: size of the board
+    :param int win_length: symbols in a row needed to win, size for classic games
+    :param dict timings: optional symbol -> list, receives the seconds spent on every move
+    :param list opening: scripted moves, as row * size + column, played before the strategies
+    :param random.Random rng: random choices of the strategies, the global ones by default
+    :return tuple: outcome (X, O or tie) and the list of moves
+    """
+    board = [['' for _ in range(size)] for _ in range(size)]
+    strategies = {'X': x_strategy, 'O': o_strategy}
+
+    def get_cell(row, column):
+        return board[row][column]
+
+    moves = []
+    symbol = 'X'
+    while True:
+        if len(moves) < len(opening):
+            row, column = divmod(opening[len(moves)], size)
+        else:
+            started = time.perf_counter()
+            row, column = drive(strategies[symbol](symbol, size, board, rng).move())
+            if timings is not None:
+                timings[symbol].append(time.perf_counter() - started)
+        if not 0 <= row < size or not 0 <= column < size or board[row][column] != '':
+            raise IllegalMove('%s played (%s, %s)' % (symbol, row, column))
+        board[row][column] = symbol
+        moves.append(row * size + column)
+        if winning_move(get_cell, size, row, column, win_length):
+            return symbol, moves
+        if len(moves) == size * size:
+            return OUTCOME_TIE, moves
+        symbol = 'O' if symbol == 'X' else 'X'
+
+
+def play_chunk(task: tuple) -> list:
+    """
+    Play a range of games, executed by the pool workers
+    :param tuple task: (x name, o name, size, win length, seed, start, end)
+    :return list: (index, outcome, moves) of every game
+    """
+    x_name, o_name, size, win_length, seed, start, end = task
+    x_strategy = get_strategy(x_name)
+    o_strategy = get_strategy(o_name)
+    results = []
+    for index in range(start, end):
+        rng = random.Random(game_seed(seed, index))
+        outcome, moves = play(x_strategy, o_strategy, size, win_length, rng=rng)
+        results.append((index, outcome, moves))
+    return results
+
+
+class NDJSONWriter:
+    """
+    One JSON document per game
+    """
+
+    def __init__(self, file, size: int, win_length: int):
+        self.file = file
+
+    def write(self, index: int, outcome: str, moves: List[int]):
+        self.file.write(json.dumps({
+            'game': index,
+            'outcome': outcome,
+            'length': len(moves),
+            'moves': moves,
+        }, separators=(',', ':')))
+        self.file.write('\n')
+
+
+class BinaryWriter:
+    """
+    Compact binary records, see MAGIC
+    """
+
+    def __init__(self, file, size: int, win_length: int):
+        if size * size > 0xFFFF:
+            raise ValueError('Boards of the binary format have 65535 cells at most')
+        self.file = file
+        file.write(HEADER.pack(MAGIC, 1, size, win_length))
+
+    def write(self, index: int, outcome: str, moves: List[int]):
+        self.file.write(RECORD.pack(BINARY_OUTCOMES.index(outcome), len(moves)))
+        self.file.write(struct.pack('<%sH' % len(moves), *moves))
+
+
+def read_binary(file):
+    """
+    Iterate the games of a binary self-play file
+    :param file: file opened in binary mode
+    :return: generator of (outcome, moves)
+    """
+    magic, version, size, win_length = HEADER.unpack(file.read(HEADER.size))
+    if magic != MAGIC or version != 1:
+        raise ValueError('Not a self-play file')
+    while True:
+        record = file.read(RECORD.size)
+        if not record:
+            return
+        outcome, length = RECORD.unpack(record)
+        moves = struct.unpack('<%sH' % length, file.read(2 * length))
+        yield BINARY_OUTCOMES[outcome], list(moves)
+
+
+def simulate(
+        games: int,
+        x_name: str,
+        o_name: str,
+        output,
+        size: int = 3,
+        win_length: int = None,
+        seed: int = 0,
+        workers: int = None,
+        chunk_size: int = 10000,
+        output_format: str = FORMAT_NDJSON,
+        progress=None,
+) -> dict:
+    """
+    Play the games on a pool of processes and stream them, in order,
+    to the output file.
+    :param int games: amount of games
+    :param str x_name: strategy of X
+    :param str o_name: strategy of O
+    :param output: file to write, text mode for ndjson and binary mode otherwise
+    :param int size: size of the board
+    :param int win_length: symbols in a row needed to win, size by default
+    :param int seed: global seed
+    :param int workers: amount of processes, one per core by default
+    :param int chunk_size: games per task sent to a worker
+    :param str output_format: ndjson or binary
+    :param progress: optional callable receiving the amount of games played
+    :return dict: report with outcomes, average length and games per second
+    """
+    get_strategy(x_name)
+    get_strategy(o_name)
+    win_length = win_length or size
+    writer_class = BinaryWriter if output_format == FORMAT_BINARY else NDJSONWriter
+    writer = writer_class(output, size, win_length)
+    tasks = [
+        (x_name, o_name, size, win_length, seed, start, min(start + chunk_size, games))
+        for start in range(0, games, chunk_size)
+    ]
+    outcomes = {'X': 0, 'O': 0, OUTCOME_TIE: 0}
+    moves_played = 0
+    started = time.monotonic()
+    with multiprocessing.Pool(workers) as pool:
+        for results in pool.imap(play_chunk, tasks):
+            for index, outcome, moves in results:
+                writer.write(index, outcome, moves)
+                outcomes[outcome] += 1
+                moves_played += len(moves)
+            if progress:
+                progress(results[-1][0] + 1)
+    elapsed = time.monotonic() - started
+    return {
+        'games': games,
+        'outcomes': outcomes,
+        'average_length': moves_played / games if games else 0,
+        'seconds': elapsed,
+        'games_per_second': games / elapsed if elapsed else 0,
+    }
+
+
+def main():
+    """
+    Command line entry point
+    :return:
+    """
+    parser = argparse.ArgumentParser(description='Bot versus bot self-play')
+    parser.add_argument('--games', type=int, required=True)
+    parser.add_argument('--x', default='random', help='strategy playing X')
+    parser.add_argument('--o', default='random', help='strategy playing O')
+    parser.add_argument('--size', type=int, default=3)
+    parser.add_argument('--win-length', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    parser.add_argument(
+        '--format',
+        choices=[FORMAT_NDJSON, FORMAT_BINARY],
+        default=FORMAT_NDJSON,
+    )
+    parser.add_argument('--output', required=True)
+    arguments = parser.parse_args()
+
+    started = time.monotonic()
+
+    def progress(played):
+        rate = played / max(time.monotonic() - started, 1e-9)
+        sys.stderr.write('\r%s games, %.0f games/s' % (played, rate))
+
+    binary = arguments.format == FORMAT_BINARY
+    with open(arguments.output, 'wb' if binary else 'w') as output:
+        report = simulate(
+            arguments.games,
+            arguments.x,
+            arguments.o,
+            output,
+            size=arguments.size,
+            win_length=arguments.win_length,
+            seed=arguments.seed,
+            workers=arguments.workers,
+            chunk_size=arguments.chunk_size,
+            output_format=arguments.format,
+            progress=progress,
+        )
+    sys.stderr.write('\n')
+    print(json.dumps(report))
+
+
+if __name__ == "__main__":
+    main()
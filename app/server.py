@@ -0,0 +1,267 @@
+"""
+Process management for the web application. It can run as a single
+process or as a pre-fork supervisor with several workers, each one
+listening on its own SO_REUSEPORT socket with its own database client.
+"""
+import os
+import time
+import signal
+import tempfile
+import asyncio
+import logging
+from tornado import ioloop
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+
+from app.context import activate
+from app.metrics import metrics, discard
+
+
+logger = logging.getLogger(__name__)
+
+
+class Worker:
+    """
+    A single serving process. It owns the HTTP server, the database
+    client and the metrics snapshot of the process.
+    """
+
+    def __init__(self, application, worker_id: int = 0, reuse_port: bool = False):
+        """
+        Prepares the worker, nothing is started until run is called
+        :param application: tornado application built by app.urls.make_app
+        :param int worker_id: position of the worker in the pool
+        :param bool reuse_port: bind with SO_REUSEPORT so the kernel spreads
+        connections between the workers
+        """
+        self.application = application
+        self.config = application.config
+        self.worker_id = worker_id
+        self.reuse_port = reuse_port
+        self.server = None
+        application.worker_id = worker_id
+
+    def run(self):
+        """
+        Bind the sockets and serve until a SIGTERM or SIGINT is received.
+        The bootstrap tasks run in the background once the worker is
+        already accepting connections, the database client is created
+        lazily by the first of them. They read the services of the
+        application from its context.
+        :return:
+        """
+        activate(self.application.context)
+        loop = ioloop.IOLoop.current()
+        sockets = bind_sockets(self.config.port, reuse_port=self.reuse_port)
+        self.server = HTTPServer(self.application, xheaders=True)
+        self.server.add_sockets(sockets)
+        if self.config.workers > 1:
+            # The other workers forward the requests of the games and the
+            # matchmaking queues owned by this one to its own port
+            self.server.add_sockets(bind_sockets(
+                self.config.actor_port + self.worker_id,
+                address='127.0.0.1',
+                reuse_port=self.reuse_port,
+            ))
+        loop.add_callback(self.start)
+
+        if self.config.metrics_dir:
+            ioloop.PeriodicCallback(
+                self.dump_metrics,
+                self.config.metrics_interval * 1000,
+            ).start()
+            self.dump_metrics()
+
+        def on_signal(signum, frame):
+            loop.add_callback_from_signal(self.shutdown)
+        signal.signal(signal.SIGTERM, on_signal)
+        signal.signal(signal.SIGINT, on_signal)
+
+        logger.info('Worker %s listening on %s', self.worker_id, self.config.port)
+        loop.start()
+
+    async def start(self):
+        """
+        Run the bootstrap tasks and then schedule the periodic ones
+        :return:
+        """
+        bootstrap = self.application.bootstrap
+        await bootstrap.run()
+        for task, setting in bootstrap.periodic:
+            ioloop.PeriodicCallback(
+                self.guard(task),
+                getattr(self.config, setting) * 1000,
+            ).start()
+
+    @staticmethod
+    def guard(task):
+        """
+        Wrap a periodic coroutine so a slow run is never overlapped by
+        the next one
+        :param task: coroutine function
+        :return: callback for a PeriodicCallback
+        """
+        running = []
+
+        async def run():
+            try:
+                await task()
+            except Exception:
+                logger.exception('Periodic task %s failed', task.__name__)
+            finally:
+                running.clear()
+
+        def callback():
+            if not running:
+                running.append(True)
+                ioloop.IOLoop.current().add_callback(run)
+        return callback
+
+    def dump_metrics(self):
+        """
+        Share the metrics of this worker with the rest of the pool
+        :return:
+        """
+        metrics.dump(self.config.metrics_dir)
+
+    async def shutdown(self):
+        """
+        Stop accepting connections and wait for the requests in flight
+        to finish before stopping the loop. Requests still running after
+        the drain timeout are dropped.
+        :return:
+        """
+        logger.info('Worker %s draining', self.worker_id)
+        self.server.stop()
+        deadline = time.monotonic() + self.config.drain_timeout
+        while metrics.get('http.in_flight') > 0 and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        try:
+            await asyncio.wait_for(
+                self.server.close_all_connections(),
+                max(deadline - time.monotonic(), 0.1),
+            )
+        except asyncio.TimeoutError:
+            pass
+        context = self.application.context
+        await context.replies.drain(max(deadline - time.monotonic(), 0.1))
+        await context.actors.drain()
+        context.bots.shutdown()
+        if self.config.metrics_dir:
+            discard(self.config.metrics_dir, os.getpid())
+        ioloop.IOLoop.current().stop()
+
+
+class Supervisor:
+    """
+    Pre-fork supervisor. Forks the workers before any database client
+    or event loop exists, restarts the ones that die, performs rolling
+    restarts on SIGHUP and forwards SIGTERM so every worker drains.
+    """
+
+    def __init__(self, application):
+        """
+        :param application: tornado application built by app.urls.make_app
+        """
+        self.application = application
+        self.config = application.config
+        self.children = {}
+        self.stopping = False
+        self.reloading = False
+        if not self.config.metrics_dir:
+            self.config.metrics_dir = tempfile.mkdtemp(prefix='tictactoe-')
+        self.metrics_dir = self.config.metrics_dir
+
+    def spawn(self, worker_id: int) -> int:
+        """
+        Fork a new worker process
+        :param int worker_id: position of the worker in the pool
+        :return int: pid of the new worker
+        """
+        pid = os.fork()
+        if pid == 0:
+            for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, signal.SIG_DFL)
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            Worker(self.application, worker_id=worker_id, reuse_port=True).run()
+            os._exit(0)
+        self.children[pid] = worker_id
+        return pid
+
+    def stop(self, signum=None, frame=None):
+        """
+        Ask all the workers to drain and exit
+        :return:
+        """
+        self.stopping = True
+        for pid in list(self.children):
+            self.kill(pid)
+
+    def reload(self, signum=None, frame=None):
+        """
+        Schedule a rolling restart of the pool
+        :return:
+        """
+        self.reloading = True
+
+    def kill(self, pid: int):
+        """
+        Send SIGTERM to a worker ignoring the ones already gone
+        :param int pid:
+        :return:
+        """
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def rolling_restart(self):
+        """
+        Replace the workers one by one. The new worker binds its socket
+        before the old one starts draining, so there is always someone
+        accepting connections.
+        :return:
+        """
+        self.reloading = False
+        for pid, worker_id in list(self.children.items()):
+            if self.stopping:
+                return
+            self.children.pop(pid)
+            self.spawn(worker_id)
+            time.sleep(1)
+            self.kill(pid)
+            os.waitpid(pid, 0)
+            if self.metrics_dir:
+                discard(self.metrics_dir, pid)
+
+    def run(self):
+        """
+        Start the pool and supervise it until it is asked to stop
+        :return:
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.reload)
+        for worker_id in range(self.config.workers):
+            self.spawn(worker_id)
+
+        while self.children:
+            if self.reloading:
+                self.rolling_restart()
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                time.sleep(0.5)
+                continue
+            worker_id = self.children.pop(pid, None)
+            if self.metrics_dir:
+                discard(self.metrics_dir, pid)
+            if worker_id is None or self.stopping:
+                continue
+            logger.warning(
+                'Worker %s (pid %s) exited with status %s, restarting',
+                worker_id, pid, status,
+            )
+            self.spawn(worker_id)
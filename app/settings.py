@@ -0,0 +1,88 @@
+"""
+Configuration of the application. Everything is driven by
+environment variables, see .env.dist for the available ones.
+"""
+import os
+
+
+def optional_int(value: str):
+    """
+    Parse an optional integer setting
+    :param str value: raw value of the environment variable
+    :return: the integer or None when it is not set
+    """
+    return int(value) if value else None
+
+
+def write_concern(value: str):
+    """
+    Parse a write concern level, which is either a number of nodes
+    or a tag like "majority"
+    :param str value: raw value of the environment variable
+    :return: the level or None when it is not set
+    """
+    if not value:
+        return None
+    return int(value) if value.isdigit() else value
+
+
+class Settings:
+    """
+    Snapshot of the configuration taken from the environment.
+    Any value can be overridden through the constructor, which
+    allows the tests to build isolated applications.
+    """
+
+    def __init__(self, **overrides):
+        """
+        Read the configuration from the environment
+        :param overrides: values that take precedence over the environment
+        """
+        self.port = int(os.getenv('PORT', '8000'))
+        self.debug = os.getenv('DEBUG_FLAG') == 'True'
+        self.workers = int(os.getenv('WORKERS', '1'))
+        self.drain_timeout = float(os.getenv('DRAIN_TIMEOUT', '30'))
+        self.metrics_dir = os.getenv('METRICS_DIR')
+        self.metrics_interval = float(os.getenv('METRICS_INTERVAL', '5'))
+        self.db_host = os.getenv('DB_HOST', 'mongodb://localhost:27017')
+        self.db_name = os.getenv('DB_NAME', 'tictactoe')
+        self.db_max_pool_size = int(os.getenv('DB_MAX_POOL_SIZE', '100'))
+        self.db_min_pool_size = int(os.getenv('DB_MIN_POOL_SIZE', '0'))
+        self.db_wait_queue_timeout_ms = optional_int(
+            os.getenv('DB_WAIT_QUEUE_TIMEOUT_MS'),
+        )
+        self.db_server_selection_timeout_ms = int(
+            os.getenv('DB_SERVER_SELECTION_TIMEOUT_MS', '30000'),
+        )
+        self.db_compressors = os.getenv('DB_COMPRESSORS') or None
+        self.db_moves_write_concern = write_concern(
+            os.getenv('DB_MOVES_WRITE_CONCERN'),
+        )
+        self.db_moves_journal = os.getenv('DB_MOVES_JOURNAL') == 'True'
+        self.bootstrap_retry = float(os.getenv('BOOTSTRAP_RETRY', '2'))
+        self.leaderboard_refresh = float(os.getenv('LEADERBOARD_REFRESH', '60'))
+        self.tables_dir = os.getenv('TABLES_DIR', 'data')
+        self.bots_file = os.getenv('BOTS_FILE') or None
+        self.default_bot = os.getenv('DEFAULT_BOT', 'easy')
+        self.bot_reply_timeout = float(os.getenv('BOT_REPLY_TIMEOUT', '30'))
+        self.move_claim_timeout = float(os.getenv('MOVE_CLAIM_TIMEOUT', '30'))
+        self.player_cache_size = int(os.getenv('PLAYER_CACHE_SIZE', '1024'))
+        self.player_cache_ttl = float(os.getenv('PLAYER_CACHE_TTL', '60'))
+        self.archive_dir = os.getenv('ARCHIVE_DIR') or None
+        self.archive_age = float(os.getenv('ARCHIVE_AGE', '2592000'))
+        self.archive_interval = float(os.getenv('ARCHIVE_INTERVAL', '3600'))
+        self.archive_batch_size = int(os.getenv('ARCHIVE_BATCH_SIZE', '1000'))
+        self.analytics_refresh = float(os.getenv('ANALYTICS_REFRESH', '60'))
+        self.matchmaking_timeout = float(os.getenv('MATCHMAKING_TIMEOUT', '60'))
+        self.game_actors = os.getenv('GAME_ACTORS') == 'True'
+        self.actor_idle = float(os.getenv('ACTOR_IDLE', '60'))
+        self.actor_flush = float(os.getenv('ACTOR_FLUSH', '1'))
+        self.actor_port = int(os.getenv('ACTOR_PORT', '9000'))
+        self.idempotency_size = int(os.getenv('IDEMPOTENCY_SIZE', '10000'))
+        self.idempotency_ttl = float(os.getenv('IDEMPOTENCY_TTL', '86400'))
+        self.snapshot_interval = int(os.getenv('SNAPSHOT_INTERVAL', '10'))
+        self.replay_cache_size = int(os.getenv('REPLAY_CACHE_SIZE', '1000'))
+        for key, value in overrides.items():
+            if not hasattr(self, key):
+                raise AttributeError('Unknown setting %s' % key)
+            setattr(self, key, value)
@@ -0,0 +1,192 @@
+"""
+Whole games played on the server, bot against bot, for QA, demos and
+seeding analytics. A batch of games is played in memory with the rules
+of app.selfplay and persisted at once: one insert_many for the games and
+one for all of their moves, instead of the writes of every move.
+
+Simulated games are flagged, they count neither for the statistics nor
+for the leaderboard of the bots.
+"""
+import asyncio
+import datetime
+import random
+import time
+from typing import List
+
+from bson import ObjectId
+
+from app.context import current
+from app.metrics import metrics
+from app.models import Game, GameMove
+from app.selfplay import OUTCOME_TIE, IllegalMove, game_seed, play
+
+
+MAX_GAMES = 10000
+# Boards are played as a dense matrix, gomoku games included
+MAX_SIZE = 19
+
+
+class SimulationError(ValueError):
+    """
+    The parameters of a simulation are not valid
+    """
+
+
+def play_games(
+        x_strategy,
+        o_strategy,
+        size: int,
+        win_length: int,
+        games: int,
+        opening: List[int],
+        seed=None,
+) -> list:
+    """
+    Play a batch of games, executed aside from the event loop
+    :param x_strategy: strategy class of X
+    :param o_strategy: strategy class of O
+    :param int size:
+    :param int win_length:
+    :param int games: amount of games
+    :param list opening: scripted moves of every game
+    :param seed: seeds every game from its index when given
+    :return list: (outcome, moves) of every game
+    """
+    results = []
+    for index in range(games):
+        # Never the global generator, shared with the threads of the executor
+        rng = random.Random(game_seed(seed, index) if seed is not None else None)
+        results.append(play(x_strategy, o_strategy, size, win_length, opening=opening, rng=rng))
+    return results
+
+
+def build_documents(results: list, players: list, template: Game) -> tuple:
+    """
+    Raw documents of the games of a simulation and of their moves. The
+    ids of the games are set here, so the moves can reference them
+    before anything is inserted.
+    :param list results: (outcome, moves) of every game, see play_games
+    :param list players: user ids of X and O
+    :param Game template: game holding the parameters of the simulation
+    :return tuple: game documents, move documents and outcome counts
+    """
+    size = template.size
+    game_documents = []
+    move_documents = []
+    outcomes = {'X': 0, 'O': 0, OUTCOME_TIE: 0}
+    now = datetime.datetime.now()
+    parameters = {'players': players, 'size': size, 'mode': template.mode}
+    if template.win_length is not None:
+        parameters['win_length'] = template.win_length
+    for outcome, moves in results:
+        game = Game(simulated=True, created_at=now, **parameters)
+        game.pre_insert()
+        pk = ObjectId()
+        for index, cell in enumerate(moves):
+            row, column = divmod(cell, size)
+            symbol = 'XO'[index % 2]
+            game.set_cell(row, column, symbol)
+            move_documents.append(GameMove(
+                game=pk,
+                cell={'row': row, 'column': column},
+                symbol=symbol,
+                player=players[index % 2],
+            ).to_mongo())
+        game.version = len(moves)
+        if outcome == OUTCOME_TIE:
+            game.status = Game.STATUS_TIE
+        else:
+            game.status = Game.STATUS_FINISHED
+            game.winner = players['XO'.index(outcome)]
+        document = game.to_mongo()
+        document['_id'] = pk
+        game_documents.append(document)
+        outcomes[outcome] += 1
+    return game_documents, move_documents, outcomes
+
+
+async def simulate(
+        x_bot: str = None,
+        o_bot: str = None,
+        size: int = 3,
+        mode: str = Game.MODE_CLASSIC,
+        win_length: int = None,
+        games: int = 1,
+        opening: List[dict] = (),
+        seed=None,
+) -> dict:
+    """
+    Play and store a batch of games between two bots
+    :param str x_bot: bot playing X, the default bot when None
+    :param str o_bot: bot playing O, the default bot when None
+    :param int size: size of the board
+    :param str mode: classic or gomoku
+    :param int win_length: symbols in a row needed to win, gomoku games only
+    :param int games: amount of games
+    :param list opening: scripted moves, {"row": r, "column": c}, played before the bots
+    :param seed: makes the games reproducible
+    :return dict: ids of the games and their outcomes
+    """
+    bots = current().bots
+    for name in (x_bot, o_bot):
+        if name is not None and name not in bots:
+            raise SimulationError('Unknown bot %s' % name)
+    if not isinstance(games, int) or not 1 <= games <= MAX_GAMES:
+        raise SimulationError('Between 1 and %s games per simulation' % MAX_GAMES)
+    if not isinstance(size, int) or size > MAX_SIZE:
+        raise SimulationError('Simulated boards are limited to %s' % MAX_SIZE)
+    try:
+        scripted = [(move['row'], move['column']) for move in opening]
+    except (KeyError, TypeError):
+        raise SimulationError('Scripted moves need a row and a column')
+    for row, column in scripted:
+        if any(
+                not isinstance(value, int) or isinstance(value, bool) or not 0 <= value < size
+                for value in (row, column)
+        ):
+            raise SimulationError('Scripted move (%s, %s) is not on the board' % (row, column))
+    cells = [row * size + column for row, column in scripted]
+    if len(set(cells)) < len(cells):
+        raise SimulationError('Scripted moves play a cell twice')
+    x_bot, o_bot = bots.get(x_bot), bots.get(o_bot)
+    players = [await x_bot.user_id(), await o_bot.user_id()]
+
+    # Validates the parameters as any other game
+    parameters = {'players': players, 'size': size, 'mode': mode}
+    if win_length is not None:
+        parameters['win_length'] = win_length
+    template = Game(**parameters)
+    template.pre_insert()
+    win_length = template.win_length or size
+
+    started = time.monotonic()
+    try:
+        results = await asyncio.get_event_loop().run_in_executor(
+            None,
+            play_games,
+            x_bot.strategy,
+            o_bot.strategy,
+            size,
+            win_length,
+            games,
+            cells,
+            seed,
+        )
+    except IllegalMove as error:
+        raise SimulationError(str(error))
+    if len(results[0][1]) < len(cells):
+        raise SimulationError('The game ends before the last scripted move')
+
+    game_documents, move_documents, outcomes = build_documents(
+        results, players, template,
+    )
+    await Game.collection.insert_many(game_documents, ordered=False)
+    await GameMove.collection.insert_many(move_documents, ordered=False)
+    metrics.inc('simulations.games', games)
+    metrics.inc('simulations.moves', len(move_documents))
+    return {
+        'games': [str(document['_id']) for document in game_documents],
+        'outcomes': outcomes,
+        'moves': len(move_documents),
+        'seconds': time.monotonic() - started,
+    }
@@ -0,0 +1,46 @@
+"""
+Coalescing of concurrent reads. While a read of a key is in flight,
+other requests for the same key wait for it instead of starting their
+own, and all of them get its result. Nothing is kept once the read is
+done, so a request never gets a result older than the database read
+that was in progress when it arrived.
+"""
+import asyncio
+
+from app.metrics import metrics
+
+
+class SingleFlight:
+    """
+    In-flight calls of the worker, per key
+    """
+
+    def __init__(self, name: str):
+        """
+        :param str name: prefix of the metrics, <name>.calls and <name>.coalesced
+        """
+        self.name = name
+        # key -> future of the call in flight
+        self.calls = {}
+
+    def done(self, key, future: asyncio.Future):
+        if self.calls.get(key) is future:
+            del self.calls[key]
+
+    async def do(self, key, function):
+        """
+        Result of the call in flight for the key, or of a new call
+        :param key: hashable key of the call
+        :param function: coroutine function without arguments
+        :return: the result of the call, or its exception raised
+        """
+        future = self.calls.get(key)
+        if future is None:
+            metrics.inc('%s.calls' % self.name)
+            future = asyncio.ensure_future(function())
+            self.calls[key] = future
+            future.add_done_callback(lambda finished: self.done(key, finished))
+        else:
+            metrics.inc('%s.coalesced' % self.name)
+        # A caller going away does not cancel the call of the others
+        return await asyncio.shield(future)
@@ -0,0 +1,211 @@
+"""
+Per-user statistics. The counters live in the user document and are
+incremented atomically when a game ends. The backfill job computes them
+for the games that finished before the counters existed:
+
+    python -m app.stats backfill
+"""
+import asyncio
+import argparse
+import logging
+from collections import defaultdict, Counter
+from bson import ObjectId
+from pymongo import UpdateOne, ReturnDocument
+from app.context import current
+from app.models import User, Game, GameMove
+
+
+logger = logging.getLogger(__name__)
+
+COUNTERS = [
+    'victories',
+    'losses',
+    'ties',
+    'games_played',
+    'moves_played',
+]
+
+
+def increments(game: Game, last_player: str, bot_player: str = None) -> dict:
+    """
+    Counters to add to every player once a game is over. Players move
+    alternately, so the one who made the last move played half of the
+    moves rounded up.
+    :param Game game: finished or tied game
+    :param str last_player: id of the user who made the last move
+    :param str bot_player: id of the bot user of single player games,
+        which are not listed in the players of the game
+    :return dict: user id -> counters to increment
+    """
+    players = [str(player.pk) for player in game.players]
+    for player in (bot_player, last_player):
+        if player is not None and player not in players:
+            players.append(player)
+    moves = game.count_moves()
+    result = {}
+    for player in players:
+        counters = {
+            'games_played': 1,
+            'moves_played': (moves + 1) // 2 if player == last_player else moves // 2,
+        }
+        if game.status == Game.STATUS_TIE:
+            counters['ties'] = 1
+        elif player == last_player:
+            counters['victories'] = 1
+        else:
+            counters['losses'] = 1
+        result[player] = counters
+    return result
+
+
+async def record_game(game: Game, last_player: str) -> dict:
+    """
+    Increment the counters of the players of a game that is over
+    :param Game game: finished or tied game
+    :param str last_player: id of the user who made the last move
+    :return dict: the winner document with its updated victories, None on ties
+    """
+    bot_player = None
+    if not game.multiplayer:
+        bot_player = await current().bots.get(game.bot).user_id()
+    tasks = []
+    operations = []
+    for user_id, counters in increments(game, last_player, bot_player).items():
+        if 'victories' in counters:
+            tasks.append(User.collection.find_one_and_update(
+                {'_id': ObjectId(user_id)},
+                {'$inc': counters},
+                projection={'username': 1, 'victories': 1},
+                return_document=ReturnDocument.AFTER,
+            ))
+        else:
+            operations.append(UpdateOne(
+                {'_id': ObjectId(user_id)},
+                {'$inc': counters},
+            ))
+    if operations:
+        tasks.append(User.collection.bulk_write(operations, ordered=False))
+    results = await asyncio.gather(*tasks)
+    if game.status == Game.STATUS_FINISHED:
+        return results[0]
+    return None
+
+
+def summary(document: dict) -> dict:
+    """
+    Public statistics of a user document
+    :param dict document: raw user document
+    :return dict:
+    """
+    stats = {field: document.get(field, 0) for field in COUNTERS}
+    played = stats['games_played']
+    stats['average_moves'] = stats['moves_played'] / played if played else 0
+    stats['id'] = str(document['_id'])
+    stats['username'] = document.get('username')
+    return stats
+
+
+async def accumulate(games: list, totals: dict):
+    """
+    Add the statistics of a batch of finished games to the totals.
+    The moves of the whole batch are counted with a single aggregation.
+    :param list games: raw game documents
+    :param dict totals: user id -> Counter
+    :return:
+    """
+    moves = defaultdict(dict)
+    cursor = GameMove.collection.aggregate([
+        {'$match': {'g': {'$in': [game['_id'] for game in games]}}},
+        {'$group': {
+            '_id': {'game': '$g', 'player': '$p'},
+            'moves': {'$sum': 1},
+        }},
+    ])
+    async for row in cursor:
+        moves[row['_id']['game']][row['_id']['player']] = row['moves']
+
+    for game in games:
+        count_game(game, moves.get(game['_id'], {}), totals)
+
+
+def count_game(game: dict, played: dict, totals: dict):
+    """
+    Add the statistics of a finished game to the totals
+    :param dict game: raw game document
+    :param dict played: user id -> amount of moves in the game
+    :param dict totals: user id -> Counter
+    :return:
+    """
+    players = set(played) | set(game.get('players', []))
+    for player in players:
+        counters = totals[player]
+        counters['games_played'] += 1
+        counters['moves_played'] += played.get(player, 0)
+        if game['status'] == Game.STATUS_TIE:
+            counters['ties'] += 1
+        elif player != game.get('winner'):
+            counters['losses'] += 1
+
+
+async def backfill(batch_size: int = 500) -> int:
+    """
+    Compute the counters of every user from the history of finished
+    games, archived ones included, and store them. The counters are
+    overwritten, so it must run before the incremental updates are
+    deployed or while no games end.
+    Victories are left untouched, they have always been maintained.
+    :param int batch_size: amount of games aggregated at once
+    :return int: amount of users updated
+    """
+    totals = defaultdict(Counter)
+    cursor = Game.collection.find(
+        {
+            'status': {'$in': [Game.STATUS_FINISHED, Game.STATUS_TIE]},
+            'simulated': {'$ne': True},
+        },
+        {'status': 1, 'winner': 1, 'players': 1},
+    ).batch_size(batch_size)
+    batch = []
+    async for game in cursor:
+        batch.append(game)
+        if len(batch) >= batch_size:
+            await accumulate(batch, totals)
+            batch = []
+    if batch:
+        await accumulate(batch, totals)
+    for record in current().archive.records():
+        if not record['game'].get('simulated'):
+            count_game(record['game'], Counter(move['p'] for move in record['moves']), totals)
+
+    operations = [
+        UpdateOne({'_id': user_id}, {'$set': {
+            field: counters.get(field, 0)
+            for field in COUNTERS if field != 'victories'
+        }})
+        for user_id, counters in totals.items()
+    ]
+    for start in range(0, len(operations), batch_size):
+        await User.collection.bulk_write(
+            operations[start:start + batch_size],
+            ordered=False,
+        )
+    logger.info('Statistics of %s users backfilled', len(operations))
+    return len(operations)
+
+
+def main():
+    """
+    Command line entry point
+    :return:
+    """
+    parser = argparse.ArgumentParser(description='User statistics jobs')
+    parser.add_argument('command', choices=['backfill'])
+    parser.add_argument('--batch-size', type=int, default=500)
+    arguments = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    updated = asyncio.run(backfill(arguments.batch_size))
+    print('%s users updated' % updated)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+"""
+Registry of the bot strategies available by name, used by the tools
+that need to pick a strategy from the command line or a configuration.
+"""
+from app.engine import RandomStrategy
+from app.qlearning import QLearningStrategy
+from app.minimax import MinimaxStrategy
+from app.tablebase import TablebaseStrategy
+
+
+STRATEGIES = {
+    'random': RandomStrategy,
+    'qlearning': QLearningStrategy,
+    'minimax': MinimaxStrategy,
+    'tablebase': TablebaseStrategy,
+}
+
+
+def get_strategy(name: str):
+    """
+    Strategy class registered under a name
+    :param str name:
+    :return: AbstractBotStrategy subclass
+    :raises ValueError: when the name is unknown
+    """
+    try:
+        return STRATEGIES[name]
+    except KeyError:
+        raise ValueError(
+            'Unknown strategy %s, available: %s' % (name, ', '.join(sorted(STRATEGIES)))
+        )
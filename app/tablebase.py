@@ -0,0 +1,294 @@
+"""
+Endgame tablebase: the perfect-play result of every position of a
+classic board, solved offline by retrograde analysis and stored as a
+table file (see app.tables):
+
+    python -m app.tablebase --size 4 --output data/tablebase-4.table
+
+Positions are read from the player to move, whose symbols are the X
+digits, so games opened by either symbol share the table; the canonical
+key is shared by rotations and mirrors. Every position of the game is
+enumerated layer by layer, one more symbol on the board at a time, then
+the layers are solved backwards from the fullest one: the result of a
+position only depends on the positions one move later. Both passes are
+vectorized with numpy and split across a pool of processes.
+
+Every entry packs the result for the player to move (win, loss or tie),
+the distance, moves left until the end of the game with perfect play,
+and the best cell of the canonical position. The tablebase strategy
+plays a move with a single lookup.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import functools
+import multiprocessing
+from typing import Tuple
+
+import numpy as np
+
+from app.engine import AbstractBotStrategy
+from app.minimax import MinimaxStrategy
+from app.qlearning import SWAPPED, ValueTables
+from app.settings import Settings
+from app.tables import DIGITS, canonical, digits, symmetries, write_table
+
+
+DTYPE = '<u2'
+# Tables are written once and never grow, fuller tables are smaller files
+LOAD_FACTOR = 0.75
+
+RESULT_TIE = 0
+RESULT_WIN = 1
+RESULT_LOSS = 2
+RESULTS = {RESULT_TIE: 'tie', RESULT_WIN: 'win', RESULT_LOSS: 'loss'}
+
+# Bits of the packed entries: result << 10 | distance << 5 | cell
+CELL_BITS = 5
+DISTANCE_BITS = 5
+MAX_SIZE = 5
+
+MOVER = DIGITS['X']
+
+
+tablebases = ValueTables(Settings().tables_dir, 'tablebase-%s.table')
+
+
+def pack(result, distance, cell):
+    """
+    :param result: RESULT_* for the player to move
+    :param distance: moves left until the end of the game
+    :param cell: flat index of the best cell of the canonical position
+    :return: packed entry, works on numpy arrays as well
+    """
+    return (result << (CELL_BITS + DISTANCE_BITS)) | (distance << CELL_BITS) | cell
+
+
+def unpack(entry: int) -> Tuple[int, int, int]:
+    """
+    :param int entry: packed entry
+    :return tuple: (result, distance, cell)
+    """
+    entry = int(entry)
+    return (
+        entry >> (CELL_BITS + DISTANCE_BITS),
+        (entry >> CELL_BITS) & ((1 << DISTANCE_BITS) - 1),
+        entry & ((1 << CELL_BITS) - 1),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def lines(size: int) -> np.ndarray:
+    """
+    Flat cells of the rows, columns and diagonals of a classic board
+    :param int size:
+    :return np.ndarray: one line per row
+    """
+    cells = np.arange(size * size).reshape(size, size)
+    return np.array(
+        list(cells) + list(cells.T) + [cells.diagonal(), np.fliplr(cells).diagonal()]
+    )
+
+
+def decode(codes: np.ndarray, size: int) -> np.ndarray:
+    """
+    Digits of positions, inverse of app.tables.encode
+    :param np.ndarray codes: base 3 codes
+    :param int size:
+    :return np.ndarray: one row of flat digits per code
+    """
+    powers = 3 ** np.arange(size * size - 1, -1, -1, dtype=np.int64)
+    return ((codes[:, None] // powers) % 3).astype(np.int8)
+
+
+def canonical_codes(boards: np.ndarray, size: int) -> np.ndarray:
+    """
+    Canonical codes of positions, app.tables.canonical of every row
+    :param np.ndarray boards: flat digits
+    :param int size:
+    :return np.ndarray:
+    """
+    powers = 3 ** np.arange(size * size - 1, -1, -1, dtype=np.int64)
+    return np.min([
+        boards[:, list(permutation)] @ powers for permutation in symmetries(size)
+    ], axis=0)
+
+
+def children(codes: np.ndarray, size: int) -> tuple:
+    """
+    Every move of every position
+    :param np.ndarray codes: canonical codes of positions without a line
+    :param int size:
+    :return tuple: parent row and cell of the moves, whether they complete a
+    line, whether they fill the board and the canonical codes of the
+    positions after them, seen from the next player
+    """
+    boards = decode(codes, size)
+    parents, cells = np.nonzero(boards == 0)
+    after = boards[parents]
+    after[np.arange(len(parents)), cells] = MOVER
+    wins = (after[:, lines(size)] == MOVER).all(axis=2).any(axis=1)
+    full = (after != 0).all(axis=1)
+    # The other player moves next
+    after = np.where(after > 0, 3 - after, 0).astype(np.int8)
+    return parents, cells, wins, full, canonical_codes(after, size)
+
+
+def expand(codes: np.ndarray, size: int) -> np.ndarray:
+    """
+    Positions one move later that are still being played
+    :param np.ndarray codes: canonical codes
+    :param int size:
+    :return np.ndarray: sorted canonical codes
+    """
+    _, _, wins, full, following = children(codes, size)
+    return np.unique(following[~wins & ~full])
+
+
+def solve(codes: np.ndarray, size: int, following: np.ndarray, entries: np.ndarray) -> np.ndarray:
+    """
+    Packed entries of positions, from the entries one move later
+    :param np.ndarray codes: canonical codes
+    :param int size:
+    :param np.ndarray following: sorted canonical codes of the next layer
+    :param np.ndarray entries: packed entries of the next layer
+    :return np.ndarray: packed entries, in the order of the codes
+    """
+    parents, cells, wins, full, after = children(codes, size)
+    result = np.full(len(parents), RESULT_TIE, dtype=np.int64)
+    distance = np.ones(len(parents), dtype=np.int64)
+    played = ~wins & ~full
+    if played.any():
+        found = entries[np.searchsorted(following, after[played])].astype(np.int64)
+        # Results of the next player are the opposite ones
+        next_result = found >> (CELL_BITS + DISTANCE_BITS)
+        result[played] = np.choose(next_result, [RESULT_TIE, RESULT_LOSS, RESULT_WIN])
+        distance[played] += (found >> CELL_BITS) & ((1 << DISTANCE_BITS) - 1)
+    result[wins] = RESULT_WIN
+    distance[wins] = 1
+    # Sooner wins and later losses first
+    horizon = size * size + 1
+    score = np.where(
+        result == RESULT_WIN, horizon - distance,
+        np.where(result == RESULT_LOSS, distance - horizon, 0),
+    )
+    starts = np.flatnonzero(np.r_[True, parents[1:] != parents[:-1]])
+    best = np.maximum.reduceat(score, starts)
+    chosen = np.flatnonzero(score == best[parents])
+    _, first = np.unique(parents[chosen], return_index=True)
+    chosen = chosen[first]
+    return pack(result[chosen], distance[chosen], cells[chosen]).astype(DTYPE)
+
+
+def chunks(codes: np.ndarray, workers: int) -> list:
+    return [chunk for chunk in np.array_split(codes, workers * 4) if len(chunk)]
+
+
+def generate(size: int = 4, workers: int = None, progress=None) -> dict:
+    """
+    Solve every position of a classic board
+    :param int size: size of the board, win length included
+    :param int workers: amount of processes, one per core by default
+    :param progress: optional callable receiving the pass and the amount of symbols
+    :return dict: canonical key -> packed entry
+    """
+    if not 1 < size <= MAX_SIZE:
+        raise ValueError('Tablebases are limited to boards of 2 to %s' % MAX_SIZE)
+    workers = workers or os.cpu_count() or 1
+    layers = [np.zeros(1, dtype=np.int64)]
+    with multiprocessing.Pool(workers) as pool:
+        while len(layers[-1]):
+            if progress:
+                progress('expand', len(layers) - 1)
+            parts = pool.map(functools.partial(expand, size=size), chunks(layers[-1], workers))
+            layers.append(np.unique(np.concatenate(parts)) if parts else np.zeros(0, dtype=np.int64))
+        layers.pop()
+        solved = {}
+        following = np.zeros(0, dtype=np.int64)
+        entries = np.zeros(0, dtype=DTYPE)
+        for depth in range(len(layers) - 1, -1, -1):
+            if progress:
+                progress('solve', depth)
+            parts = pool.map(
+                functools.partial(solve, size=size, following=following, entries=entries),
+                chunks(layers[depth], workers),
+            )
+            following, entries = layers[depth], np.concatenate(parts)
+            solved.update(zip(following.tolist(), entries.tolist()))
+    return solved
+
+
+def probe(board, symbol: str, size: int):
+    """
+    Perfect-play entry of the position of a player to move
+    :param board: list of rows of '', 'X' or 'O'
+    :param str symbol: symbol of the player to move
+    :param int size:
+    :return tuple: (result, distance, (row, column)), None without a tablebase
+    for the size or when the position is not in it
+    """
+    table = tablebases.get(size)
+    if table is None:
+        return None
+    values = digits(board)
+    if symbol == 'O':
+        values = [SWAPPED[value] for value in values]
+    code, symmetry = canonical(values, size)
+    entry = table.get(code)
+    if entry is None:
+        return None
+    result, distance, cell = unpack(entry)
+    # transformed[cell] = board[permutation[cell]]
+    return result, distance, divmod(symmetries(size)[symmetry][cell], size)
+
+
+class TablebaseStrategy(AbstractBotStrategy):
+    """
+    Plays the best cell of the tablebase of the board size. Sizes
+    without a tablebase, and positions missing from it, are searched
+    with minimax.
+    """
+
+    async def move(self) -> Tuple[int, int]:
+        found = probe(self.board, self.symbol, self.size)
+        if found is None:
+            return await MinimaxStrategy(self.symbol, self.size, self.board, self.random).move()
+        return found[2]
+
+
+def main():
+    """
+    Command line entry point
+    :return:
+    """
+    parser = argparse.ArgumentParser(description='Solve every position of a classic board')
+    parser.add_argument('--size', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--output', default=None, help='tablebase-<size>.table in TABLES_DIR by default')
+    arguments = parser.parse_args()
+
+    started = time.monotonic()
+
+    def progress(step, symbols):
+        sys.stderr.write('\r%s %s symbols, %.0fs' % (step, symbols, time.monotonic() - started))
+
+    solved = generate(arguments.size, arguments.workers, progress)
+    sys.stderr.write('\n')
+    output = arguments.output or tablebases.path(arguments.size)
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    write_table(output, solved, DTYPE, LOAD_FACTOR)
+    result, distance, _ = unpack(solved[0])
+    print(json.dumps({
+        'positions': len(solved),
+        'result': RESULTS[result],
+        'distance': distance,
+        'bytes': os.path.getsize(output),
+        'seconds': time.monotonic() - started,
+        'output': output,
+    }))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+Compact position tables used by the offline trained strategies.
+
+Positions are identified by a canonical key: the board is read as a
+base 3 number (0 empty, 1 X, 2 O) under each of its 8 symmetries and
+the lowest one is kept, so rotated or mirrored positions share their
+entry. Boards too big to fit in 64 bits are hashed.
+
+Tables are stored as an open addressing hash table: a header, an array
+of uint64 keys and an array of values. Files are memory-mapped, so
+loading is instant and a lookup is a hash plus a few array reads.
+"""
+import struct
+import hashlib
+import functools
+from typing import List, Tuple
+import numpy as np
+
+
+DIGITS = {'': 0, 'X': 1, 'O': 2}
+
+MASK = (1 << 64) - 1
+EMPTY_KEY = MASK
+GOLDEN = 0x9E3779B97F4A7C15
+
+MAGIC = b'TTTB'
+HEADER = struct.Struct('<4sB11sQQ')
+LOAD_FACTOR = 0.5
+
+
+@functools.lru_cache(maxsize=None)
+def symmetries(size: int) -> Tuple[Tuple[int, ...], ...]:
+    """
+    The 8 symmetries of a square board as permutations of the flat
+    cell indices: transformed[i] = board[permutation[i]]
+    :param int size:
+    :return tuple: 8 permutations
+    """
+    cells = np.arange(size * size).reshape(size, size)
+    transforms = []
+    for flipped in (cells, np.fliplr(cells)):
+        for turns in range(4):
+            transforms.append(tuple(int(i) for i in np.rot90(flipped, turns).ravel()))
+    return tuple(transforms)
+
+
+def digits(board) -> List[int]:
+    """
+    Flat base 3 digits of a board
+    :param board: list of rows of '', 'X' or 'O'
+    :return list:
+    """
+    return [DIGITS[cell] for row in board for cell in row]
+
+
+def encode(values: List[int]) -> int:
+    """
+    Base 3 number of a list of digits, first cell is the most significant
+    :param list values:
+    :return int:
+    """
+    code = 0
+    for value in values:
+        code = code * 3 + value
+    return code
+
+
+def canonical(values: List[int], size: int) -> Tuple[int, int]:
+    """
+    Canonical code of a position and the symmetry that produces it
+    :param list values: flat digits of the board
+    :param int size:
+    :return tuple: (code, index of the symmetry in symmetries(size))
+    """
+    best = None
+    best_symmetry = 0
+    for index, permutation in enumerate(symmetries(size)):
+        code = 0
+        for cell in permutation:
+            code = code * 3 + values[cell]
+        if best is None or code < best:
+            best = code
+            best_symmetry = index
+    return best, best_symmetry
+
+
+def position_key(values: List[int], size: int) -> int:
+    """
+    64 bit key of a position, equal for all its symmetries
+    :param list values: flat digits of the board
+    :param int size:
+    :return int:
+    """
+    code, _ = canonical(values, size)
+    if code < EMPTY_KEY:
+        return code
+    digest = hashlib.blake2b(
+        code.to_bytes((code.bit_length() + 7) // 8, 'little'),
+        digest_size=8,
+    ).digest()
+    return int.from_bytes(digest, 'little') % EMPTY_KEY
+
+
+def slot(key: int, bits: int) -> int:
+    """
+    Home slot of a key in a table of 2 ** bits slots
+    :param int key:
+    :param int bits:
+    :return int:
+    """
+    return ((key * GOLDEN) & MASK) >> (64 - bits)
+
+
+def write_table(path: str, entries: dict, dtype, load_factor: float = LOAD_FACTOR):
+    """
+    Store a dict of key -> value as a table file
+    :param str path:
+    :param dict entries: uint64 keys, EMPTY_KEY is reserved
+    :param dtype: numpy dtype of the values
+    :param float load_factor: highest share of used slots, lower is faster
+    :return:
+    """
+    dtype = np.dtype(dtype)
+    bits = max(4, int(np.ceil(np.log2(max(len(entries), 1) / load_factor))))
+    capacity = 1 << bits
+    keys = np.full(capacity, EMPTY_KEY, dtype='<u8')
+    values = np.zeros(capacity, dtype=dtype.newbyteorder('<'))
+    mask = capacity - 1
+    for key, value in entries.items():
+        index = slot(key, bits)
+        while keys[index] != EMPTY_KEY:
+            index = (index + 1) & mask
+        keys[index] = key
+        values[index] = value
+    with open(path, 'wb') as file:
+        file.write(HEADER.pack(
+            MAGIC,
+            1,
+            values.dtype.str.encode().ljust(11, b'\0'),
+            capacity,
+            len(entries),
+        ))
+        file.write(keys.tobytes())
+        file.write(values.tobytes())
+
+
+class Table:
+    """
+    Read only, memory-mapped table file
+    """
+
+    def __init__(self, path: str):
+        """
+        Map the file, nothing is read until the first lookups
+        :param str path:
+        """
+        with open(path, 'rb') as file:
+            magic, version, dtype, capacity, count = HEADER.unpack(
+                file.read(HEADER.size)
+            )
+        if magic != MAGIC or version != 1:
+            raise ValueError('%s is not a table file' % path)
+        self.path = path
+        self.capacity = capacity
+        self.count = count
+        self.bits = capacity.bit_length() - 1
+        self.keys = np.memmap(
+            path, dtype='<u8', mode='r', offset=HEADER.size, shape=(capacity,),
+        )
+        self.values = np.memmap(
+            path,
+            dtype=np.dtype(dtype.rstrip(b'\0').decode()),
+            mode='r',
+            offset=HEADER.size + 8 * capacity,
+            shape=(capacity,),
+        )
+
+    def __len__(self) -> int:
+        return self.count
+
+    def get(self, key: int, default=None):
+        """
+        Value stored for a key
+        :param int key:
+        :param default: returned when the key is not in the table
+        :return:
+        """
+        mask = self.capacity - 1
+        index = slot(key, self.bits)
+        while True:
+            stored = int(self.keys[index])
+            if stored == key:
+                return self.values[index]
+            if stored == EMPTY_KEY:
+                return default
+            index = (index + 1) & mask
@@ -1,14 +1,50 @@
 import asyncio
+import datetime
 import json
 import os
+import io
+import random
+import sys
+import tempfile
+import threading
+import time
 from typing import Tuple
+from unittest import mock
+
+import numpy as np
 
 from motor import MotorClient
 from tornado.ioloop import IOLoop
 from tornado.testing import AsyncHTTPTestCase
-from app.urls import application
-from app.models import User, Game
-from main import ensure_ai_user
+from tornado.web import HTTPError
+from app.urls import application, make_app
+from app.models import User, Game, GameMove, PoolListener, collection_options, compact_move, decode_cell, \
+    encode_cell, instance
+from app.metrics import Metrics, aggregate, metrics
+from app.settings import Settings
+from app.bootstrap import Bootstrap, ensure_bot_users
+from app.leaderboard import SkipList, Leaderboard, leaderboard
+from app.stats import increments, summary
+from app.engine import winning_move, GameEngine
+from app import analytics, batch, compact_moves, export, handlers, selfplay, simulations, tables, tournament
+from app.qlearning import ValueTables, QLearningStrategy, train, value_tables
+from app.minimax import MinimaxStrategy
+from app.tablebase import RESULT_LOSS, RESULT_TIE, RESULT_WIN, TablebaseStrategy, generate, probe, \
+    tablebases
+from app.bots import Bot, BotRegistry, bots, POOL_THREAD, POOL_PROCESS
+from app.engine import RandomStrategy
+from app.replies import Replies
+from app.matchmaking import Matchmaking, queue_owner, ticket_id
+from app.actors import Actors, GameActor, actors, owner
+from app.singleflight import SingleFlight
+from app.idempotency import IdempotencyStore, idempotency
+from app.replay import Replays
+from app.players import PlayerCache
+from app.archive import Archive, Segment, archive, write_segment
+from bson import ObjectId
+from app.strategies import STRATEGIES
+from umongo import ValidationError
+from umongo.exceptions import UpdateError
 
 
 class BaseTest(AsyncHTTPTestCase):
@@ -30,6 +66,1674 @@ class TestRootApplication(BaseTest):
         self.assertEqual(response.code, 200)
 
 
+class TestMetrics(BaseTest):
+
+    def test_metrics_endpoint(self):
+        self.fetch('/')
+        response = self.fetch('/metrics')
+        self.assertEqual(response.code, 200)
+        body = json.loads(response.body.decode())
+        self.assertIn('workers', body)
+        self.assertGreaterEqual(body['total']['counters']['http.requests'], 1)
+
+    def test_aggregate_workers(self):
+        one, two = Metrics(), Metrics()
+        one.inc('http.requests', 3)
+        two.inc('http.requests', 2)
+        two.add('http.in_flight')
+        total = aggregate([one.snapshot(), two.snapshot()])
+        self.assertEqual(total['counters']['http.requests'], 5)
+        self.assertEqual(total['gauges']['http.in_flight'], 1)
+
+    def test_updates_from_threads(self):
+        registry = Metrics()
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+
+        def update():
+            for _ in range(20000):
+                registry.add('mongo.pool.checked_out')
+                registry.add('mongo.pool.checked_out', -1)
+                registry.inc('mongo.pool.created')
+
+        try:
+            threads = [threading.Thread(target=update) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(registry.get('mongo.pool.checked_out'), 0)
+        self.assertEqual(registry.get('mongo.pool.created'), 80000)
+
+
+class TestAppFactory(BaseTest):
+    def get_app(self):
+        return make_app(Settings(port=0), tasks=[])
+
+    def test_apps_keep_their_services(self):
+        one = make_app(Settings(workers=2), tasks=[])
+        client = instance.client = mock.Mock()
+        instance.pid = os.getpid()
+        two = make_app(Settings(workers=3, default_bot='perfect'), tasks=[])
+        self.addCleanup(make_app, tasks=[])
+        self.assertIsNot(one.bootstrap, two.bootstrap)
+        self.assertEqual(one.config.workers, 2)
+        self.assertEqual(two.config.workers, 3)
+        for name in ('bots', 'replies', 'players', 'archive', 'matchmaking', 'actors',
+                     'idempotency', 'replays'):
+            self.assertIsNot(getattr(one.context, name), getattr(two.context, name))
+        self.assertEqual(one.context.bots.default, Settings().default_bot)
+        self.assertEqual(two.context.bots.default, 'perfect')
+        self.assertIsNot(one.context.bots, bots)
+        self.assertNotEqual(bots.default, 'perfect')
+        # A player queued in one application is unknown to the other
+        ticket = self.io_loop.run_sync(
+            lambda: one.context.matchmaking.join('5c9d2a62e3872b287363cf25')
+        )
+        self.assertIs(one.context.matchmaking.get(ticket.id), ticket)
+        self.assertIsNone(two.context.matchmaking.get(ticket.id))
+        # The models are still bound to the last application built
+        client.close.assert_called_once_with()
+        self.assertIs(instance.settings, two.config)
+        self.assertIsNone(instance.client)
+
+    def test_handlers_read_their_application(self):
+        self._app.context.bots.default = 'perfect'
+        response = self.fetch('/api/bots')
+        self.assertEqual(json.loads(response.body)['default'], 'perfect')
+        self.assertNotEqual(bots.default, 'perfect')
+
+    def test_liveness(self):
+        response = self.fetch('/health/live')
+        self.assertEqual(response.code, 200)
+
+    def test_not_ready_before_bootstrap(self):
+        response = self.fetch('/health/ready')
+        self.assertEqual(response.code, 503)
+
+    def test_bootstrap_retries_failed_tasks(self):
+        calls = []
+
+        async def flaky():
+            calls.append(1)
+            if len(calls) < 2:
+                raise RuntimeError('mongo is not there yet')
+
+        async def other():
+            calls.append(2)
+
+        bootstrap = Bootstrap([flaky, other], retry=0)
+        self.io_loop.run_sync(bootstrap.run)
+        self.assertTrue(bootstrap.ready)
+        self.assertEqual(sorted(calls), [1, 1, 2])
+        self.assertEqual(bootstrap.errors, {})
+
+
+class TestPoolSettings(BaseTest):
+
+    def test_moves_write_concern(self):
+        options = collection_options(Settings(db_moves_write_concern='majority'))
+        self.assertEqual(options['moves']['write_concern'].document, {'w': 'majority'})
+        self.assertEqual(collection_options(Settings(db_moves_write_concern=None)), {})
+
+    def test_pool_gauges(self):
+        listener = PoolListener()
+        checked_out = metrics.get('mongo.pool.checked_out')
+        waiting = metrics.get('mongo.pool.wait_queue')
+        listener.connection_check_out_started(None)
+        listener.connection_check_out_started(None)
+        self.assertEqual(metrics.get('mongo.pool.wait_queue'), waiting + 2)
+        listener.connection_checked_out(None)
+        self.assertEqual(metrics.get('mongo.pool.wait_queue'), waiting + 1)
+        self.assertEqual(metrics.get('mongo.pool.checked_out'), checked_out + 1)
+        listener.connection_checked_in(None)
+        listener.connection_checked_out(None)
+        listener.connection_checked_in(None)
+        self.assertEqual(metrics.get('mongo.pool.wait_queue'), waiting)
+        self.assertEqual(metrics.get('mongo.pool.checked_out'), checked_out)
+
+
+class TestLeaderboard(BaseTest):
+
+    def test_skip_list_ranks(self):
+        skip_list = SkipList(seed=7)
+        reference = []
+        generator = random.Random(7)
+        for i in range(2000):
+            key = generator.randint(0, 500)
+            if key in reference:
+                skip_list.remove(key)
+                reference.remove(key)
+            else:
+                skip_list.insert(key)
+                reference.append(key)
+                reference.sort()
+            probe = generator.randint(0, 500)
+            self.assertEqual(
+                skip_list.count_less(probe),
+                len([value for value in reference if value < probe]),
+            )
+        self.assertEqual(list(skip_list), reference)
+        self.assertEqual(len(skip_list), len(reference))
+
+    def test_ranks_with_ties(self):
+        board = Leaderboard()
+        board.update('a', 3, 'alice')
+        board.update('b', 5, 'bob')
+        board.update('c', 3, 'carol')
+        board.update('d', 0, 'dave')
+        self.assertEqual(board.rank('b'), 1)
+        self.assertEqual(board.rank('a'), 2)
+        self.assertEqual(board.rank('c'), 2)
+        self.assertEqual(board.rank('d'), 4)
+        self.assertEqual([entry['rank'] for entry in board.top(3)], [1, 2, 2])
+        board.update('d', 6)
+        self.assertEqual(board.rank('d'), 1)
+        self.assertEqual(board.top(1)[0]['username'], 'dave')
+        board.discard('b')
+        self.assertIsNone(board.rank('b'))
+        self.assertEqual(len(board), 3)
+
+    def test_leaderboard_endpoint(self):
+        leaderboard.update('5c9d2b09e3872b287363cf28', 1000, 'champion')
+        response = self.fetch(
+            '/api/leaderboard?limit=1&user=5c9d2b09e3872b287363cf28',
+        )
+        self.assertEqual(response.code, 200)
+        body = json.loads(response.body.decode())
+        self.assertEqual(body['data'][0]['username'], 'champion')
+        self.assertEqual(body['user']['rank'], 1)
+        leaderboard.discard('5c9d2b09e3872b287363cf28')
+
+    def test_leaderboard_invalid_user(self):
+        response = self.fetch('/api/leaderboard?user=123')
+        self.assertEqual(response.code, 400)
+
+
+class TestUserStats(BaseTest):
+    players = ['5c9d2a62e3872b287363cf25', '5c9d2a72e3872b287363cf26']
+
+    def test_increments_victory(self):
+        game = Game(players=self.players, status=Game.STATUS_FINISHED)
+        game.board = [['X', 'X', 'X'], ['O', 'O', ''], ['', '', '']]
+        result = increments(game, self.players[0])
+        self.assertEqual(result[self.players[0]], {
+            'games_played': 1, 'moves_played': 3, 'victories': 1,
+        })
+        self.assertEqual(result[self.players[1]], {
+            'games_played': 1, 'moves_played': 2, 'losses': 1,
+        })
+
+    def test_increments_tie_against_bot(self):
+        bot = '5c9d2b09e3872b287363cf28'
+        game = Game(players=self.players[:1], status=Game.STATUS_TIE)
+        game.board = [['X', 'O', 'X'], ['X', 'O', 'O'], ['O', 'X', 'X']]
+        result = increments(game, bot)
+        self.assertEqual(result[bot]['moves_played'], 5)
+        self.assertEqual(result[self.players[0]]['moves_played'], 4)
+        self.assertEqual(result[self.players[0]]['ties'], 1)
+
+    def test_increments_bot_defeated(self):
+        bot = '5c9d2b09e3872b287363cf28'
+        game = Game(players=self.players[:1], status=Game.STATUS_FINISHED)
+        game.board = [['X', 'X', 'X'], ['O', 'O', ''], ['', '', '']]
+        result = increments(game, self.players[0], bot)
+        self.assertEqual(result[bot], {
+            'games_played': 1, 'moves_played': 2, 'losses': 1,
+        })
+        self.assertEqual(result[self.players[0]]['victories'], 1)
+
+    def test_missing_winner_document(self):
+        game = Game(players=self.players, status=Game.STATUS_IN_PROGRESS)
+        game.pre_insert()
+        game.board = [['X', 'X', ''], ['O', 'O', ''], ['', '', '']]
+        move = GameMove(player=self.players[0], symbol='X', cell={'row': 0, 'column': 2})
+        user = User(username='goneuser', email='gone@user.te')
+
+        async def commit(*args, **kwargs):
+            pass
+
+        async def record(*args, **kwargs):
+            return None
+
+        with mock.patch.object(GameMove, 'commit', commit), \
+                mock.patch.object(Game, 'commit', commit), \
+                mock.patch('app.engine.record_game', record), \
+                mock.patch('app.engine.leaderboard') as board:
+            game.set_cell(0, 2, 'X')
+            self.io_loop.run_sync(lambda: GameEngine().validate_board(game, move, user))
+        self.assertEqual(game.status, Game.STATUS_FINISHED)
+        board.update.assert_not_called()
+
+    def test_summary(self):
+        stats = summary({
+            '_id': self.players[0], 'username': 'usertest',
+            'games_played': 4, 'moves_played': 14, 'victories': 1,
+        })
+        self.assertEqual(stats['average_moves'], 3.5)
+        self.assertEqual(stats['losses'], 0)
+
+
+class TestTurnClaim(BaseTest):
+    players = ['5c9d2a62e3872b287363cf25', '5c9d2a72e3872b287363cf26']
+
+    def claimed_game(self) -> Tuple:
+        game = Game(players=self.players, status=Game.STATUS_IN_PROGRESS)
+        game.pre_insert()
+        game.move_pending_since = datetime.datetime(2020, 1, 1)
+        move = GameMove(player=self.players[0], symbol='X', cell={'row': 0, 'column': 0})
+        game.set_cell(0, 0, 'X')
+        return game, move, User(username='playerone', email='player@one.te')
+
+    def test_commit_conditional_on_claim(self):
+        game, move, user = self.claimed_game()
+        conditions = []
+
+        async def commit(document, **kwargs):
+            conditions.append(kwargs.get('conditions'))
+
+        with mock.patch.object(GameMove, 'commit', commit), mock.patch.object(Game, 'commit', commit):
+            self.io_loop.run_sync(lambda: GameEngine().validate_board(game, move, user, keep_claim=True))
+            self.assertEqual(conditions[0], {'move_pending_since': datetime.datetime(2020, 1, 1)})
+            # Kept for the reply of the bot
+            self.assertIsNotNone(game.move_pending_since)
+            self.io_loop.run_sync(lambda: GameEngine().validate_board(game, move, user))
+        self.assertIsNone(game.move_pending_since)
+
+    def test_turn_taken_over(self):
+        game, move, user = self.claimed_game()
+        moves = []
+
+        async def taken(*args, **kwargs):
+            raise UpdateError('taken over')
+
+        async def commit(*args, **kwargs):
+            moves.append(args)
+
+        with mock.patch.object(GameMove, 'commit', commit), mock.patch.object(Game, 'commit', taken):
+            with self.assertRaises(HTTPError) as context:
+                self.io_loop.run_sync(lambda: GameEngine().validate_board(game, move, user))
+        self.assertEqual(context.exception.status_code, 409)
+        self.assertEqual(moves, [])
+
+
+class TestExpandPlayers(BaseTest):
+
+    def test_least_recently_used_evicted(self):
+        cache = PlayerCache(size=2)
+        cache.store('one', {'id': 'one'})
+        cache.store('two', {'id': 'two'})
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(cache.resolve(['one']))
+        cache.store('three', {'id': 'three'})
+        self.assertEqual(list(cache.entries), ['one', 'three'])
+
+    def test_expand_from_cache(self):
+        cache = PlayerCache()
+        cache.store('one', {'id': 'one', 'username': 'playerone'})
+        cache.store('two', {'id': 'two', 'username': 'playertwo'})
+        games = [
+            {'players': ['one', 'two'], 'winner': 'two'},
+            {'players': ['two']},
+        ]
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(cache.expand(games))
+        self.assertEqual(games[0]['players'][0]['username'], 'playerone')
+        self.assertEqual(games[0]['winner'], {'id': 'two', 'username': 'playertwo'})
+        self.assertNotIn('winner', games[1])
+
+    def test_unknown_expansion(self):
+        response = self.fetch('/api/games/5c9d2a62e3872b287363cf25?expand=moves')
+        self.assertEqual(response.code, 400)
+
+
+class TestArchive(BaseTest):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def record(self, moves: int) -> dict:
+        pk = ObjectId()
+        return {
+            'game': {'_id': pk, 'status': Game.STATUS_TIE, 'players': [ObjectId()]},
+            'moves': [{'_id': ObjectId(), 'g': pk, 's': 'XO'[i % 2]} for i in range(moves)],
+        }
+
+    def test_segment_lookup(self):
+        records = [self.record(i) for i in range(50)]
+        path = write_segment(self.directory.name, records)
+        segment = Segment(path)
+        self.assertEqual(len(segment), 50)
+        for record in records:
+            self.assertEqual(segment.get(str(record['game']['_id'])), record)
+        self.assertIsNone(segment.get(str(ObjectId())))
+        self.assertEqual(list(segment), records)
+
+    def test_archive_reads_new_segments(self):
+        cold = Archive(self.directory.name)
+        first = self.record(3)
+        write_segment(self.directory.name, [first])
+        self.assertEqual(cold.get(str(first['game']['_id'])), first)
+        second = self.record(5)
+        write_segment(self.directory.name, [second])
+        self.assertEqual(cold.get(str(second['game']['_id']).upper()), second)
+        self.assertEqual(len(list(cold.records())), 2)
+        self.assertIsNone(Archive().get(str(first['game']['_id'])))
+
+    def test_ordered_records(self):
+        records = [self.record(1) for _ in range(9)]
+        write_segment(self.directory.name, records[::2])
+        # Stored twice by workers archiving at the same time
+        write_segment(self.directory.name, records[1::2] + records[:1])
+        cold = Archive(self.directory.name)
+        ids = [record['game']['_id'] for record in records]
+        self.assertEqual([record['game']['_id'] for record in cold.ordered()], ids)
+        self.assertEqual(
+            [record['game']['_id'] for record in cold.ordered(str(ids[2]), str(ids[6]))],
+            ids[2:6],
+        )
+
+
+class TestExport(BaseTest):
+    players = [ObjectId(), ObjectId()]
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def batch(self, games: int) -> list:
+        template = Game(players=self.players, size=3)
+        template.pre_insert()
+        results = simulations.play_games(RandomStrategy, RandomStrategy, 3, 3, games, [], seed=games)
+        documents, moves, _ = simulations.build_documents(results, self.players, template)
+        return [
+            (game, [move for move in moves if move['g'] == game['_id']])
+            for game in documents
+        ]
+
+    def test_query(self):
+        after = str(ObjectId())
+        query = export.make_query(
+            since=datetime.datetime(2026, 1, 1),
+            statuses=[Game.STATUS_TIE],
+            after=after,
+        )
+        self.assertEqual(query['_id']['$gte'].generation_time.year, 2026)
+        self.assertEqual(str(query['_id']['$gt']), after)
+        self.assertEqual(query['status'], {'$in': [Game.STATUS_TIE]})
+        with self.assertRaises(ValueError):
+            export.make_query(statuses=['lost'])
+
+    def test_archived_games_merged(self):
+        games = self.batch(8)
+        games.sort(key=lambda item: item[0]['_id'])
+        write_segment(self.directory.name, [
+            {'game': game, 'moves': moves} for game, moves in games[1::2] + games[:1]
+        ])
+
+        async def stored(query, batch_size):
+            for game, moves in games[::2]:
+                yield game, moves
+
+        async def exported(query):
+            return [batch async for batch in export.batches(query, 3)]
+
+        with mock.patch('app.export.stored', stored), \
+                mock.patch.object(application.context, 'archive', Archive(self.directory.name)):
+            batches = self.io_loop.run_sync(lambda: exported({}))
+            self.assertEqual([len(batch) for batch in batches], [3, 3, 2])
+            merged = [game for batch in batches for game, _ in batch]
+            self.assertEqual(merged, [game for game, _ in games])
+            self.assertEqual([moves for batch in batches for _, moves in batch], [moves for _, moves in games])
+            # Resumed after the fourth game, the archive follows the query
+            query = export.make_query(after=str(games[3][0]['_id']), statuses=[Game.STATUS_TIE])
+            resumed = self.io_loop.run_sync(lambda: exported(query))
+        cold = {game['_id'] for game, _ in games[1::2]}
+        archived = [game['_id'] for batch in resumed for game, _ in batch if game['_id'] in cold]
+        self.assertEqual(archived, [
+            game['_id'] for game, _ in games[5::2] if game['status'] == Game.STATUS_TIE
+        ])
+
+    def test_ndjson_resumed_after_crash(self):
+        path = os.path.join(self.directory.name, 'games.ndjson')
+        batch = self.batch(3)
+        writer = export.NDJSONWriter(path)
+        writer.write(batch)
+        writer.close()
+        with open(path, 'a') as file:
+            file.write('{"id": "cut')
+        writer = export.NDJSONWriter(path)
+        writer.write(batch[:1])
+        writer.close()
+        with open(path) as file:
+            lines = [json.loads(line) for line in file]
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(lines[0]['id'], str(batch[0][0]['_id']))
+        self.assertEqual(len(lines[0]['moves']), len(batch[0][1]))
+
+    def test_columns_resumed_after_crash(self):
+        batch = self.batch(4)
+        writer = export.ColumnsWriter(self.directory.name)
+        writer.write(batch[:2])
+        writer.write(batch[2:])
+        # A crash in the middle of the last batch
+        os.truncate(writer.path('games', 'status'), 3 * 11)
+        writer = export.ColumnsWriter(self.directory.name)
+        self.assertEqual(writer.moves_written, sum(len(moves) for _, moves in batch[:3]))
+        writer.write(batch[3:])
+
+        def read(table, column):
+            dtype = dict(export.GAME_COLUMNS if table == 'games' else export.MOVE_COLUMNS)[column]
+            return np.fromfile(writer.path(table, column), dtype=dtype)
+
+        ids = read('games', 'id')
+        self.assertEqual(len(ids), 4)
+        self.assertEqual(ids[3].decode(), str(batch[3][0]['_id']))
+        start, count = read('games', 'moves_start')[3], read('games', 'moves_count')[3]
+        games = read('moves', 'game')[start:start + count]
+        self.assertEqual(set(games), {ids[3]})
+        self.assertEqual(len(games), len(batch[3][1]))
+
+    def test_columns_drop_games_without_their_moves(self):
+        batch = self.batch(4)
+        writer = export.ColumnsWriter(self.directory.name)
+        writer.write(batch)
+        kept = sum(len(moves) for _, moves in batch[:3])
+        # Games written, moves of the last one cut by a crash
+        os.truncate(writer.path('moves', 'player'), (kept + 1) * 24)
+        writer = export.ColumnsWriter(self.directory.name)
+        self.assertEqual(writer.moves_written, kept)
+        self.assertEqual(writer.rows('games', export.GAME_COLUMNS), 3)
+        self.assertEqual(writer.rows('moves', export.MOVE_COLUMNS), kept)
+
+
+class TestOpenings(BaseTest):
+
+    def test_increments(self):
+        rows = [
+            {'_id': {'mode': 'classic', 'size': 3, 'row': 1, 'column': 1}, 'games': 4, 'wins': 3, 'ties': 0},
+            {'_id': {'mode': 'gomoku', 'size': 15, 'row': 7, 'column': 7}, 'games': 2, 'wins': 1, 'ties': 1},
+        ]
+        self.assertEqual(analytics.increments(rows), {
+            'boards.classic:3.1,1.games': 4,
+            'boards.classic:3.1,1.wins': 3,
+            'boards.gomoku:15.7,7.games': 2,
+            'boards.gomoku:15.7,7.wins': 1,
+            'boards.gomoku:15.7,7.ties': 1,
+        })
+
+    def test_archived_rows(self):
+        def record(cells, status, **game):
+            moves = [{'c': encode_cell({'row': row, 'column': column}), 's': 'XO'[index % 2]}
+                     for index, (row, column) in enumerate(cells)]
+            return {'game': dict(game, status=status), 'moves': moves}
+
+        rows = analytics.archived_rows([
+            record([(1, 1), (0, 0), (2, 2)], Game.STATUS_FINISHED),
+            record([(1, 1), (0, 0)], Game.STATUS_FINISHED),
+            record([(1, 1)], Game.STATUS_TIE, size=3, mode='classic'),
+            record([(0, 0)], Game.STATUS_FINISHED, size=4),
+            record([(0, 0)], Game.STATUS_FINISHED, simulated=True),
+            record([(0, 0)], Game.STATUS_IN_PROGRESS),
+        ])
+        self.assertEqual(rows, [
+            {'_id': {'mode': 'classic', 'size': 3, 'row': 1, 'column': 1}, 'games': 3, 'wins': 1, 'ties': 1},
+            {'_id': {'mode': 'classic', 'size': 4, 'row': 0, 'column': 0}, 'games': 1, 'wins': 1, 'ties': 0},
+        ])
+        # Added to the rows of the aggregation for the same cells
+        update = analytics.increments(rows + rows[:1])
+        self.assertEqual(update['boards.classic:3.1,1.games'], 6)
+
+    def test_report(self):
+        snapshot = analytics.Openings()
+        watermark = ObjectId()
+        snapshot.load({'watermark': watermark, 'boards': {
+            'classic:3': {
+                '0,0': {'games': 1, 'ties': 1},
+                '1,1': {'games': 3, 'wins': 2},
+            },
+            'classic:4': {'0,0': {'games': 1}},
+        }})
+        report = snapshot.report(3)
+        self.assertEqual(report['watermark'], str(watermark))
+        self.assertEqual(len(report['boards']), 1)
+        board = report['boards'][0]
+        self.assertEqual(board['games'], 4)
+        center, corner = board['openings']
+        self.assertEqual((center['row'], center['column'], center['frequency']), (1, 1, 0.75))
+        self.assertAlmostEqual(center['win_rate'], 2 / 3)
+        self.assertAlmostEqual(center['loss_rate'], 1 / 3)
+        self.assertEqual((corner['tie_rate'], corner['win_rate']), (1, 0))
+        self.assertEqual(len(snapshot.report()['boards']), 2)
+
+    def test_invalid_size(self):
+        response = self.fetch('/api/analytics/openings?size=big')
+        self.assertEqual(response.code, 400)
+
+
+class TestGomoku(BaseTest):
+    players = ['5c9d2a62e3872b287363cf25']
+
+    def create_game(self, **data) -> Game:
+        game = Game(players=self.players, mode=Game.MODE_GOMOKU, **data)
+        game.pre_insert()
+        return game
+
+    def test_sparse_board(self):
+        game = self.create_game(size=100)
+        self.assertEqual(game.win_length, 5)
+        self.assertNotIn('board', game.dump())
+        game.set_cell(99, 42, 'X')
+        self.assertEqual(game.get_cell(99, 42), 'X')
+        self.assertEqual(game.get_cell(0, 0), '')
+        self.assertEqual(game.board_view()[99][42], 'X')
+        self.assertEqual(game.count_moves(), 1)
+        self.assertEqual(game.dump()['cells'], {'99,42': 'X'})
+
+    def test_win_length_bigger_than_board(self):
+        with self.assertRaises(ValidationError):
+            self.create_game(size=4, win_length=5)
+
+    def test_classic_size_limit(self):
+        game = Game(players=self.players, size=11)
+        with self.assertRaises(ValidationError):
+            game.pre_insert()
+
+    def test_winning_move(self):
+        game = self.create_game(size=50, win_length=4)
+        for i in range(3):
+            game.set_cell(10 + i, 20 - i, 'O')
+        self.assertFalse(winning_move(game.get_cell, 50, 12, 18, 4))
+        game.set_cell(13, 17, 'O')
+        self.assertTrue(winning_move(game.get_cell, 50, 13, 17, 4))
+        self.assertTrue(winning_move(game.get_cell, 50, 11, 19, 4))
+
+    def test_winning_move_edges(self):
+        game = self.create_game(size=5, win_length=5)
+        for j in range(4):
+            game.set_cell(4, j, 'X')
+        game.set_cell(4, 4, 'O')
+        self.assertFalse(winning_move(game.get_cell, 5, 4, 3, 5))
+        game.set_cell(4, 4, 'X')
+        self.assertTrue(winning_move(game.get_cell, 5, 4, 4, 5))
+
+
+class TestBatchJudge(BaseTest):
+
+    def random_position(self, generator: random.Random, size: int) -> Game:
+        game = Game(players=['5c9d2a62e3872b287363cf25'], size=size)
+        game.pre_insert()
+        cells = [(i, j) for i in range(size) for j in range(size)]
+        generator.shuffle(cells)
+        engine = GameEngine()
+        for turn, (i, j) in enumerate(cells[:generator.randint(0, len(cells))]):
+            game.set_cell(i, j, 'XO'[turn % 2])
+            status = self.io_loop.run_sync(lambda: engine.evaluate(game))
+            if status != Game.STATUS_IN_PROGRESS:
+                break
+        return game
+
+    def test_line_indices(self):
+        lines = batch.line_indices(3)
+        self.assertEqual(lines.shape, (8, 3))
+        self.assertEqual(lines[-2].tolist(), [0, 4, 8])
+        self.assertEqual(lines[-1].tolist(), [2, 4, 6])
+        self.assertIs(batch.line_indices(3), lines)
+
+    def test_matches_engine(self):
+        generator = random.Random(3)
+        engine = GameEngine()
+        for size in range(3, 7):
+            games = [self.random_position(generator, size) for _ in range(150)]
+            boards = np.stack([batch.encode(game.board) for game in games])
+            outcomes = batch.judge(boards, chunk_size=64)
+            for game, outcome in zip(games, outcomes):
+                status = self.io_loop.run_sync(lambda: engine.evaluate(game))
+                expected = {
+                    Game.STATUS_IN_PROGRESS: [batch.OUTCOME_ONGOING],
+                    Game.STATUS_TIE: [batch.OUTCOME_TIE],
+                    Game.STATUS_FINISHED: [batch.OUTCOME_X, batch.OUTCOME_O],
+                }[status]
+                self.assertIn(outcome, expected)
+                if status == Game.STATUS_FINISHED:
+                    last = 'X' if game.count_moves() % 2 else 'O'
+                    self.assertEqual(batch.OUTCOMES[int(outcome)], last)
+
+    def test_invalid_shape(self):
+        with self.assertRaises(ValueError):
+            batch.judge(np.zeros((2, 3, 4), dtype=np.int8))
+
+
+class TestSelfPlay(BaseTest):
+
+    def run_simulation(self, workers: int, output_format=selfplay.FORMAT_NDJSON):
+        output = io.BytesIO() if output_format == selfplay.FORMAT_BINARY else io.StringIO()
+        report = selfplay.simulate(
+            200, 'random', 'random', output,
+            seed=42, workers=workers, chunk_size=30, output_format=output_format,
+        )
+        return report, output.getvalue()
+
+    def test_deterministic_output(self):
+        report_one, output_one = self.run_simulation(1)
+        report_two, output_two = self.run_simulation(2)
+        self.assertEqual(output_one, output_two)
+        self.assertEqual(report_one['outcomes'], report_two['outcomes'])
+        self.assertEqual(sum(report_one['outcomes'].values()), 200)
+        lines = output_one.splitlines()
+        self.assertEqual(len(lines), 200)
+        self.assertEqual(json.loads(lines[-1])['game'], 199)
+
+    def test_binary_output(self):
+        _, output = self.run_simulation(2, selfplay.FORMAT_BINARY)
+        _, text = self.run_simulation(1)
+        games = list(selfplay.read_binary(io.BytesIO(output)))
+        self.assertEqual(len(games), 200)
+        for (outcome, moves), line in zip(games, text.splitlines()):
+            document = json.loads(line)
+            self.assertEqual(outcome, document['outcome'])
+            self.assertEqual(moves, document['moves'])
+
+    def test_play_follows_rules(self):
+        random.seed(5)
+        outcome, moves = selfplay.play(
+            selfplay.get_strategy('random'),
+            selfplay.get_strategy('random'),
+            5, 4,
+        )
+        self.assertEqual(len(set(moves)), len(moves))
+        self.assertIn(outcome, ['X', 'O', 'tie'])
+        if outcome != 'tie':
+            self.assertEqual(outcome, 'XO'[(len(moves) - 1) % 2])
+
+    def test_unknown_strategy(self):
+        with self.assertRaises(ValueError):
+            selfplay.simulate(1, 'random', 'missing', io.StringIO())
+
+    def test_scripted_opening(self):
+        random.seed(3)
+        strategy = selfplay.get_strategy('random')
+        outcome, moves = selfplay.play(strategy, strategy, 3, 3, opening=[4, 0])
+        self.assertEqual(moves[:2], [4, 0])
+        with self.assertRaises(selfplay.IllegalMove):
+            selfplay.play(strategy, strategy, 3, 3, opening=[4, 4])
+
+
+class TestSimulations(BaseTest):
+    players = ['5c9d2a62e3872b287363cf25', '5c9d2a72e3872b287363cf26']
+
+    def test_build_documents(self):
+        template = Game(players=self.players, size=3)
+        template.pre_insert()
+        results = simulations.play_games(
+            MinimaxStrategy, RandomStrategy, 3, 3, 20, [4], seed=1,
+        )
+        games, moves, outcomes = simulations.build_documents(results, self.players, template)
+        self.assertEqual(len(games), 20)
+        self.assertEqual(outcomes['O'], 0)
+        self.assertEqual(len(moves), sum(len(played) for _, played in results))
+        for game, (outcome, played) in zip(games, results):
+            self.assertTrue(game['simulated'])
+            self.assertEqual(game['version'], len(played))
+            self.assertEqual(game['board'][1][1], 'X')
+            game_moves = [move for move in moves if move['g'] == game['_id']]
+            self.assertEqual(len(game_moves), len(played))
+            self.assertEqual(game_moves[1]['s'], 'O')
+            self.assertEqual(str(game_moves[1]['p']), self.players[1])
+            if outcome == 'X':
+                self.assertEqual(game['status'], Game.STATUS_FINISHED)
+                self.assertEqual(str(game['winner']), self.players[0])
+
+    def test_sparse_documents(self):
+        template = Game(players=self.players, size=7, mode=Game.MODE_GOMOKU, win_length=4)
+        template.pre_insert()
+        results = simulations.play_games(RandomStrategy, RandomStrategy, 7, 4, 3, [], seed=1)
+        games, _, _ = simulations.build_documents(results, self.players, template)
+        self.assertNotIn('board', games[0])
+        self.assertEqual(len(games[0]['cells']), len(results[0][1]))
+
+    def test_invalid_parameters(self):
+        loop = asyncio.get_event_loop()
+        for parameters in [{'x_bot': 'missing'}, {'games': 0}, {'size': 20}]:
+            with self.assertRaises(simulations.SimulationError):
+                loop.run_until_complete(simulations.simulate(**parameters))
+
+    def test_invalid_openings(self):
+        loop = asyncio.get_event_loop()
+        for opening in [
+            [{'row': 0}],
+            [{'row': 0, 'column': 3}],
+            [{'row': -1, 'column': 0}],
+            [{'row': True, 'column': 0}],
+            [{'row': '1', 'column': 0}],
+            [{'row': 1, 'column': 1}, {'row': 0, 'column': 0}, {'row': 1, 'column': 1}],
+        ]:
+            with self.assertRaises(simulations.SimulationError):
+                loop.run_until_complete(simulations.simulate(opening=opening))
+
+    def test_seeded_games_keep_the_global_generator(self):
+        expected = simulations.play_games(RandomStrategy, RandomStrategy, 4, 4, 50, [], seed=9)
+        state = random.getstate()
+
+        async def batches():
+            executor = asyncio.get_event_loop().run_in_executor
+            return await asyncio.gather(*[
+                executor(None, simulations.play_games, RandomStrategy, RandomStrategy, 4, 4, 50, [], 9)
+                for _ in range(4)
+            ])
+
+        for results in self.io_loop.run_sync(batches):
+            self.assertEqual(results, expected)
+        self.assertEqual(random.getstate(), state)
+
+
+class TestQLearning(BaseTest):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.addCleanup(value_tables.configure, value_tables.directory)
+        value_tables.configure(self.directory.name)
+
+    def test_symmetric_positions_share_key(self):
+        board = [['X', '', ''], ['', 'O', ''], ['', '', '']]
+        rotated = [['', '', 'X'], ['', 'O', ''], ['', '', '']]
+        mirrored = [['', '', ''], ['', 'O', ''], ['X', '', '']]
+        key = tables.position_key(tables.digits(board), 3)
+        self.assertEqual(tables.position_key(tables.digits(rotated), 3), key)
+        self.assertEqual(tables.position_key(tables.digits(mirrored), 3), key)
+        edge = [['', 'X', ''], ['', 'O', ''], ['', '', '']]
+        self.assertNotEqual(tables.position_key(tables.digits(edge), 3), key)
+        big = [[''] * 8 for _ in range(8)]
+        big[0][0] = 'X'
+        self.assertLess(tables.position_key(tables.digits(big), 8), tables.EMPTY_KEY)
+
+    def test_table_roundtrip(self):
+        path = os.path.join(self.directory.name, 'test.table')
+        entries = {key * 7919: key / 1000 for key in range(1000)}
+        tables.write_table(path, entries, '<f4')
+        table = tables.Table(path)
+        self.assertEqual(len(table), 1000)
+        for key, value in entries.items():
+            self.assertAlmostEqual(float(table.get(key)), value, places=5)
+        self.assertIsNone(table.get(3))
+        self.assertEqual(table.get(3, 0.0), 0.0)
+
+    def test_strategy_picks_best_afterstate(self):
+        board = [['X', 'X', ''], ['O', 'O', ''], ['', '', '']]
+        winning = [['X', 'X', 'X'], ['O', 'O', ''], ['', '', '']]
+        key = tables.position_key(tables.digits(winning), 3)
+        tables.write_table(value_tables.path(3), {key: 1.0}, '<f4')
+        cell = self.io_loop.run_sync(QLearningStrategy('X', 3, board).move)
+        self.assertEqual(cell, (0, 2))
+
+    def test_strategy_after_opening_with_o(self):
+        # The table is keyed with the mover as X, whoever opened the game
+        winning = [['X', 'X', 'X'], ['O', 'O', ''], ['', '', '']]
+        key = tables.position_key(tables.digits(winning), 3)
+        tables.write_table(value_tables.path(3), {key: 1.0}, '<f4')
+        board = [['O', 'O', ''], ['X', 'X', ''], ['', '', '']]
+        cell = self.io_loop.run_sync(QLearningStrategy('O', 3, board).move)
+        self.assertEqual(cell, (0, 2))
+
+    def test_strategy_without_table(self):
+        value_tables.configure(os.path.join(self.directory.name, 'missing'))
+        board = [['X', 'O', 'X'], ['O', 'X', 'O'], ['O', 'X', '']]
+        cell = self.io_loop.run_sync(QLearningStrategy('O', 3, board).move)
+        self.assertEqual(cell, (2, 2))
+        self.assertIsNone(ValueTables(self.directory.name).get(4))
+
+    def test_train(self):
+        values = train(3, 300, seed=1)
+        self.assertTrue(values)
+        self.assertTrue(all(-1 <= value <= 1 for value in values.values()))
+        self.assertEqual(values, train(3, 300, seed=1))
+
+
+class TestTablebase(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.solved = generate(3, workers=2)
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.addCleanup(tablebases.configure, tablebases.directory)
+        tablebases.configure(self.directory.name)
+        tables.write_table(tablebases.path(3), self.solved, '<u2')
+
+    def test_perfect_play(self):
+        self.assertEqual(probe([[''] * 3] * 3, 'X', 3)[:2], (RESULT_TIE, 9))
+        board = [['X', 'X', ''], ['O', 'O', ''], ['', '', '']]
+        self.assertEqual(probe(board, 'X', 3), (RESULT_WIN, 1, (0, 2)))
+        self.assertEqual(probe(board, 'O', 3), (RESULT_WIN, 1, (1, 2)))
+        self.assertEqual(probe([['X', '', ''], ['', 'O', ''], ['', '', 'X']], 'O', 3)[:2], (RESULT_TIE, 6))
+        # Two lines are threatened, blocking one loses on the next move
+        fork = [['X', 'O', ''], ['O', '', ''], ['X', '', 'X']]
+        self.assertEqual(probe(fork, 'O', 3)[:2], (RESULT_LOSS, 2))
+
+    def test_symmetric_positions(self):
+        board = [['X', 'X', ''], ['O', '', 'O'], ['', '', '']]
+        rotated = [list(row) for row in zip(*board[::-1])]
+        mirrored = [row[::-1] for row in board]
+        self.assertEqual(probe(board, 'X', 3), (RESULT_WIN, 1, (0, 2)))
+        self.assertEqual(probe(rotated, 'X', 3), (RESULT_WIN, 1, (2, 2)))
+        self.assertEqual(probe(mirrored, 'X', 3), (RESULT_WIN, 1, (0, 0)))
+
+    def test_strategy_never_loses(self):
+        random.seed(0)
+        for game in range(20):
+            board = [[''] * 3 for _ in range(3)]
+            players = {'X': TablebaseStrategy, 'O': RandomStrategy}
+            if game % 2:
+                players = {'X': RandomStrategy, 'O': TablebaseStrategy}
+            symbol = 'X'
+            for _ in range(9):
+                row, column = self.io_loop.run_sync(players[symbol](symbol, 3, board).move)
+                board[row][column] = symbol
+                if winning_move(lambda i, j: board[i][j], 3, row, column, 3):
+                    self.assertIs(players[symbol], TablebaseStrategy)
+                    break
+                symbol = 'O' if symbol == 'X' else 'X'
+
+    def test_missing_size_searched(self):
+        board = [['X', 'X', 'X', ''], ['O', 'O', 'O', ''], [''] * 4, [''] * 4]
+        self.assertIsNone(probe(board, 'X', 4))
+        self.assertEqual(self.io_loop.run_sync(TablebaseStrategy('X', 4, board).move), (0, 3))
+
+
+class TestTournament(BaseTest):
+
+    def test_ratings(self):
+        names = ['strong', 'weak', 'even']
+        elo = tournament.ratings(names, [
+            ('strong', 'weak', 80, 10, 10),
+            ('weak', 'even', 10, 10, 80),
+            ('even', 'strong', 5, 60, 35),
+        ])
+        self.assertGreater(elo[0], elo[2])
+        self.assertGreater(elo[2], elo[1])
+        self.assertAlmostEqual(elo.mean(), tournament.BASE_RATING)
+        balanced = tournament.ratings(['a', 'b'], [('a', 'b', 10, 10, 5)])
+        self.assertAlmostEqual(balanced[0], balanced[1])
+        shutout = tournament.ratings(['a', 'b'], [('a', 'b', 50, 0, 0)])
+        self.assertTrue(np.isfinite(shutout).all())
+
+    def test_run(self):
+        report = tournament.run(['random', 'qlearning'], [3], 20, workers=2, chunk_size=7, samples=20)
+        section = report['sizes'][3]
+        self.assertEqual(len(section['pairings']), 2)
+        for pairing in section['pairings']:
+            self.assertEqual(pairing['x_wins'] + pairing['o_wins'] + pairing['ties'], 20)
+        for row in section['ratings'].values():
+            self.assertEqual(row['games'], 40)
+            self.assertLessEqual(row['low'], row['high'])
+            self.assertGreaterEqual(row['latency']['moves'], 40)
+            self.assertLessEqual(row['latency']['p50_us'], row['latency']['p99_us'])
+        self.assertIn('3x3', tournament.format_report(report))
+
+    def test_single_strategy(self):
+        with self.assertRaises(ValueError):
+            tournament.run(['random'], [3], 10)
+
+
+class SlowStrategy(RandomStrategy):
+
+    async def move(self):
+        time.sleep(0.5)
+        return await super().move()
+
+
+class StuckStrategy(RandomStrategy):
+    """
+    The first move waits until released
+    """
+    release = threading.Event()
+    calls = []
+
+    async def move(self):
+        self.calls.append(1)
+        if len(self.calls) == 1:
+            self.release.wait(5)
+        return await super().move()
+
+
+class TestBots(BaseTest):
+
+    def test_minimax_takes_win_and_blocks(self):
+        board = [['X', 'X', ''], ['O', 'O', ''], ['', '', '']]
+        self.assertEqual(self.io_loop.run_sync(MinimaxStrategy('X', 3, board).move), (0, 2))
+        board = [['X', 'X', ''], ['', 'O', ''], ['', '', '']]
+        self.assertEqual(self.io_loop.run_sync(MinimaxStrategy('O', 3, board).move), (0, 2))
+
+    def test_minimax_never_loses(self):
+        random.seed(4)
+        for _ in range(30):
+            outcome, _ = selfplay.play(MinimaxStrategy, RandomStrategy, 3, 3)
+            self.assertIn(outcome, ['X', 'tie'])
+            outcome, _ = selfplay.play(RandomStrategy, MinimaxStrategy, 3, 3)
+            self.assertIn(outcome, ['O', 'tie'])
+
+    def test_minimax_after_opening_with_o(self):
+        # Fill the shared cache with games opened by X first
+        random.seed(8)
+        for _ in range(20):
+            selfplay.play(MinimaxStrategy, RandomStrategy, 3, 3)
+        exact = {}
+
+        def value(board, symbol):
+            # Score for the player to move, without cache sharing nor symmetries
+            key = (tuple(board), symbol)
+            if key not in exact:
+                other = 'O' if symbol == 'X' else 'X'
+                empty = board.count('')
+                best = -empty
+                for cell in range(9):
+                    if board[cell]:
+                        continue
+                    board[cell] = symbol
+                    row, column = divmod(cell, 3)
+                    if winning_move(lambda i, j: board[i * 3 + j], 3, row, column, 3):
+                        score = empty
+                    elif empty == 1:
+                        score = 0
+                    else:
+                        score = -value(board, other)
+                    board[cell] = ''
+                    best = max(best, score)
+                exact[key] = best
+            return exact[key]
+
+        def move_score(board, cell, symbol):
+            board[cell] = symbol
+            row, column = divmod(cell, 3)
+            empty = board.count('') + 1
+            if winning_move(lambda i, j: board[i * 3 + j], 3, row, column, 3):
+                score = empty
+            elif empty == 1:
+                score = 0
+            else:
+                score = -value(board, 'X' if symbol == 'O' else 'O')
+            board[cell] = ''
+            return score
+
+        # Positions of games opened by O, with O to move
+        checked = 0
+        generator = random.Random(3)
+        for _ in range(150):
+            board = [''] * 9
+            for turn in range(generator.randrange(0, 4)):
+                free = [cell for cell in range(9) if not board[cell]]
+                board[generator.choice(free)] = 'O'
+                free = [cell for cell in range(9) if not board[cell]]
+                board[generator.choice(free)] = 'X'
+            if any(
+                winning_move(lambda i, j: board[i * 3 + j], 3, cell // 3, cell % 3, 3)
+                for cell in range(9) if board[cell]
+            ):
+                continue
+            rows = [board[row * 3:row * 3 + 3] for row in range(3)]
+            row, column = self.io_loop.run_sync(MinimaxStrategy('O', 3, rows).move)
+            self.assertEqual(move_score(board, row * 3 + column, 'O'), value(board, 'O'))
+            checked += 1
+        self.assertGreater(checked, 100)
+
+    def test_sparse_boards(self):
+        board = Game(players=['5c9d2a62e3872b287363cf25'], mode=Game.MODE_GOMOKU, size=50)
+        board.pre_insert()
+        with self.assertRaises(TypeError):
+            tables.digits(board.board_view())
+        for name in ['perfect', 'medium']:
+            with self.assertRaises(ValidationError):
+                Game(
+                    players=['5c9d2a62e3872b287363cf25'],
+                    mode=Game.MODE_GOMOKU,
+                    size=50,
+                    bot=name,
+                ).pre_insert()
+
+    def test_registry(self):
+        registry = BotRegistry()
+        registry.configure(Settings(bots_file=None, default_bot='easy'))
+        self.assertEqual([bot.name for bot in registry], ['easy', 'medium', 'perfect'])
+        self.assertEqual(registry.get().botname, 'tictactoeai')
+        self.assertEqual(registry.get('perfect').strategy, MinimaxStrategy)
+        self.assertEqual(registry.get('removed').name, 'easy')
+        with self.assertRaises(ValueError):
+            registry.configure(Settings(default_bot='missing'))
+
+    def test_registry_file(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as file:
+            json.dump([{'name': 'solo', 'username': 'solobot', 'strategy': 'minimax'}], file)
+            file.flush()
+            registry = BotRegistry()
+            registry.configure(Settings(bots_file=file.name, default_bot='solo'))
+        self.assertEqual(registry.get().email, 'solobot@robot.de')
+        with self.assertRaises(ValueError):
+            Bot('broken', 'brokenbot', pool='cluster')
+
+    def test_game_bot(self):
+        game = Game(players=['5c9d2a62e3872b287363cf25'])
+        game.pre_insert()
+        self.assertEqual(game.bot, bots.default)
+        game = Game(players=['5c9d2a62e3872b287363cf25'], bot='perfect')
+        game.pre_insert()
+        self.assertEqual(game.bot, 'perfect')
+        with self.assertRaises(ValidationError):
+            Game(players=['5c9d2a62e3872b287363cf25'], bot='missing').pre_insert()
+        with self.assertRaises(ValidationError):
+            Game(
+                players=['5c9d2a62e3872b287363cf25', '5c9d2a62e3872b287363cf26'],
+                bot='perfect',
+            ).pre_insert()
+
+    def test_process_pool(self):
+        bot = Bot('perfect', 'tictactoeai-perfect', strategy='minimax', pool=POOL_PROCESS)
+        self.addCleanup(bot.shutdown)
+        game = Game(players=['5c9d2a62e3872b287363cf25'])
+        game.pre_insert()
+        game.board = [['X', 'X', ''], ['O', 'O', ''], ['', '', '']]
+        cell = self.io_loop.run_sync(lambda: bot.choose('O', game))
+        self.assertEqual(tuple(cell), (1, 2))
+
+    def test_budget(self):
+        STRATEGIES['slow'] = SlowStrategy
+        self.addCleanup(STRATEGIES.pop, 'slow')
+        bot = Bot('slow', 'slowbot', strategy='slow', budget=0.05, pool=POOL_THREAD)
+        self.addCleanup(bot.shutdown)
+        game = Game(players=['5c9d2a62e3872b287363cf25'])
+        game.pre_insert()
+        timeouts = metrics.get('bots.slow.timeouts')
+        row, column = self.io_loop.run_sync(lambda: bot.choose('O', game))
+        self.assertEqual(game.board[row][column], '')
+        self.assertEqual(metrics.get('bots.slow.timeouts'), timeouts + 1)
+
+    def test_pool_replaced_after_timeout(self):
+        STRATEGIES['stuck'] = StuckStrategy
+        self.addCleanup(STRATEGIES.pop, 'stuck')
+        self.addCleanup(StuckStrategy.release.set)
+        bot = Bot('stuck', 'stuckbot', strategy='stuck', budget=0.1, pool=POOL_THREAD)
+        self.addCleanup(bot.shutdown)
+        game = Game(players=['5c9d2a62e3872b287363cf25'])
+        game.pre_insert()
+        timeouts = metrics.get('bots.stuck.timeouts')
+        self.io_loop.run_sync(lambda: bot.choose('O', game))
+        # The next move does not wait for the stuck one
+        self.io_loop.run_sync(lambda: bot.choose('O', game))
+        self.assertEqual(len(StuckStrategy.calls), 2)
+        self.assertEqual(metrics.get('bots.stuck.timeouts'), timeouts + 1)
+
+    def test_process_pool_stopped_after_timeout(self):
+        STRATEGIES['slow'] = SlowStrategy
+        self.addCleanup(STRATEGIES.pop, 'slow')
+        bot = Bot('slow', 'slowbot', strategy='slow', budget=0.05, pool=POOL_PROCESS)
+        self.addCleanup(bot.shutdown)
+        game = Game(players=['5c9d2a62e3872b287363cf25'])
+        game.pre_insert()
+        processes = []
+        retire = bot.retire_executor
+
+        def retire_executor():
+            processes.extend(bot.executor._processes.values())
+            retire()
+
+        bot.retire_executor = retire_executor
+        self.io_loop.run_sync(lambda: bot.choose('O', game))
+        self.assertIsNone(bot.executor)
+        self.assertTrue(processes)
+        for process in processes:
+            process.join(1)
+            self.assertFalse(process.is_alive())
+
+    def test_list_bots(self):
+        response = self.fetch('/api/bots')
+        self.assertEqual(response.code, 200)
+        body = json.loads(response.body)
+        self.assertEqual(body['default'], 'easy')
+        self.assertIn('perfect', [bot['name'] for bot in body['data']])
+
+
+class TestReplies(BaseTest):
+
+    def test_wait_notify(self):
+        registry = Replies()
+
+        async def scenario():
+            first = asyncio.ensure_future(registry.wait('game', 5))
+            second = asyncio.ensure_future(registry.wait('game', 5))
+            await asyncio.sleep(0)
+            self.assertEqual(registry.waiters['game'][1], 2)
+            registry.notify('game')
+            await asyncio.wait_for(asyncio.gather(first, second), 1)
+            self.assertNotIn('game', registry.waiters)
+            await registry.wait('other', 0.01)
+            self.assertNotIn('other', registry.waiters)
+
+        self.io_loop.run_sync(scenario)
+
+    def test_drain(self):
+        registry = Replies()
+
+        async def scenario():
+            task = asyncio.ensure_future(asyncio.sleep(0.05))
+            registry.tasks.add(task)
+            task.add_done_callback(registry.done)
+            await registry.drain(1)
+            self.assertTrue(task.done())
+            self.assertFalse(registry.tasks)
+
+        self.io_loop.run_sync(scenario)
+
+
+class FakeMatchmaking(Matchmaking):
+    players_ids = ['5c9d2a62e3872b287363cf2%s' % i for i in range(5)]
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.games = []
+        self.fail = False
+
+    async def create_game(self, players: list, size: int, mode: str):
+        await asyncio.sleep(0)
+        if self.fail:
+            raise RuntimeError('Database down')
+        self.games.append(players)
+        return mock.Mock(pk=ObjectId())
+
+
+class TestMatchmaking(BaseTest):
+
+    def test_ticket_ids_hash_to_their_worker(self):
+        for worker in range(3):
+            pk = ticket_id(worker, 3)
+            self.assertEqual(len(pk), 32)
+            self.assertEqual(owner(pk, 3), worker)
+        self.assertEqual(queue_owner('classic', 3, 1), 0)
+
+    def test_pairing(self):
+        queue = FakeMatchmaking()
+        one, two, three, four = queue.players_ids[:4]
+
+        async def scenario():
+            first = await queue.join(one)
+            self.assertIs(await queue.join(one), first)
+            other_board = await queue.join(two, size=4)
+            waiting = asyncio.ensure_future(queue.wait(first, 5))
+            await asyncio.sleep(0)
+            second = await queue.join(three)
+            await asyncio.wait_for(waiting, 1)
+            self.assertEqual(first.status, first.STATUS_MATCHED)
+            self.assertEqual(first.game, second.game)
+            self.assertEqual(queue.games, [[one, three]])
+            self.assertEqual(other_board.status, other_board.STATUS_WAITING)
+            self.assertEqual(queue.waiting(), 1)
+            # Matched players may join again
+            self.assertIsNot(await queue.join(one), first)
+            await queue.join(four, size=4)
+            self.assertEqual(queue.games[-1], [two, four])
+
+        self.io_loop.run_sync(scenario)
+
+    def test_invalid_board(self):
+        queue = FakeMatchmaking()
+        with self.assertRaises(ValidationError):
+            self.io_loop.run_sync(lambda: queue.join(queue.players_ids[0], size=20))
+        self.assertFalse(queue.tickets)
+
+    def test_stale_tickets(self):
+        queue = FakeMatchmaking(timeout=-1)
+        one, two, three = queue.players_ids[:3]
+
+        async def scenario():
+            first = await queue.join(one)
+            second = await queue.join(two)
+            self.assertEqual(second.status, second.STATUS_WAITING)
+            self.assertIsNone(queue.get(first.id))
+            self.assertEqual(queue.expire(), 1)
+            self.assertFalse(queue.tickets)
+            queue.timeout = 60
+            third = await queue.join(three)
+            self.assertEqual(queue.expire(), 0)
+            self.assertIs(queue.get(third.id), third)
+
+        self.io_loop.run_sync(scenario)
+
+    def test_failed_game_keeps_opponent(self):
+        queue = FakeMatchmaking()
+        one, two, three = queue.players_ids[:3]
+
+        async def scenario():
+            first = await queue.join(one)
+            queue.fail = True
+            with self.assertRaises(RuntimeError):
+                await queue.join(two)
+            self.assertEqual(list(queue.players), [one])
+            queue.fail = False
+            await queue.join(three)
+            self.assertEqual(queue.games, [[one, three]])
+            self.assertIsNotNone(first.game)
+
+        self.io_loop.run_sync(scenario)
+
+    def test_unknown_ticket(self):
+        response = self.fetch('/api/matchmaking/%s' % ('0' * 32))
+        self.assertEqual(response.code, 404)
+
+
+class FakeActor(GameActor):
+    players = ['5c9d2a62e3872b287363cf25', '5c9d2a62e3872b287363cf26']
+
+    async def load(self, previous: asyncio.Task = None):
+        game = Game(players=self.players)
+        game.pre_insert()
+        document = game.to_mongo()
+        document['_id'] = ObjectId(self.pk)
+        self.game = Game.build_from_mongo(document)
+        self.registry.loads.append(self.pk)
+
+    async def write(self, moves: list, document: dict):
+        self.registry.writes.append((self.pk, len(moves), document['version']))
+
+
+class FakePlayers(PlayerCache):
+    """
+    Only the players of FakeActor exist
+    """
+
+    async def resolve(self, pks) -> dict:
+        return {pk: {'id': pk} for pk in pks if pk in FakeActor.players}
+
+
+class TestActors(BaseTest):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(application.context, 'players', FakePlayers())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def registry(self) -> Actors:
+        registry = Actors(True, idle=0.05, flush_delay=0.01)
+        registry.actor_class = FakeActor
+        registry.loads = []
+        registry.writes = []
+        return registry
+
+    def move(self, player: int, row: int, column: int) -> dict:
+        return {
+            'player': FakeActor.players[player],
+            'symbol': 'XO'[player],
+            'cell': {'row': row, 'column': column},
+        }
+
+    def test_owner(self):
+        pk = '5c9d2a62e3872b287363cf25'
+        self.assertEqual(owner(pk, 1), 0)
+        self.assertEqual(owner(pk, 4), int(pk, 16) % 4)
+        self.assertEqual({owner(str(ObjectId()), 3) for _ in range(100)}, {0, 1, 2})
+
+    def test_moves_applied_in_order(self):
+        registry = self.registry()
+        pk = str(ObjectId())
+
+        async def scenario():
+            results = await asyncio.gather(
+                registry.submit(pk, self.move(0, 0, 0)),
+                registry.submit(pk, self.move(0, 2, 2)),
+                registry.submit(pk, self.move(1, 1, 1)),
+                return_exceptions=True,
+            )
+            self.assertEqual(results[0]['version'], 1)
+            self.assertEqual(results[1].status_code, 412)
+            self.assertEqual(results[2]['version'], 2)
+            self.assertEqual(registry.game(pk).board[1][1], 'O')
+            self.assertEqual(registry.writes, [])
+            await asyncio.sleep(0.02)
+            # Both moves in a single write
+            self.assertEqual(registry.writes, [(pk, 2, 2)])
+
+        self.io_loop.run_sync(scenario)
+
+    def test_unknown_player(self):
+        registry = self.registry()
+        pk = str(ObjectId())
+        move = dict(self.move(0, 0, 0), player=str(ObjectId()))
+
+        async def scenario():
+            with self.assertRaises(HTTPError) as context:
+                await registry.submit(pk, move)
+            self.assertEqual(context.exception.status_code, 404)
+            self.assertEqual(registry.game(pk).version, 0)
+
+        self.io_loop.run_sync(scenario)
+
+    def test_idle_actor_evicted(self):
+        registry = self.registry()
+        pk = str(ObjectId())
+
+        async def scenario():
+            await registry.submit(pk, self.move(0, 0, 0))
+            task = registry.actors[pk].task
+            await asyncio.wait_for(task, 1)
+            self.assertNotIn(pk, registry.actors)
+            self.assertEqual(registry.writes, [(pk, 1, 1)])
+            self.assertIsNone(registry.game(pk))
+            await registry.submit(pk, self.move(0, 0, 0))
+            self.assertEqual(registry.loads, [pk, pk])
+
+        self.io_loop.run_sync(scenario)
+
+
+class TestForward(BaseTest):
+    def get_app(self):
+        return make_app(Settings(game_actors=True, workers=2), tasks=[])
+
+    def tearDown(self):
+        super().tearDown()
+        make_app(tasks=[])
+
+    def owned_by(self, worker: int) -> str:
+        return next(
+            pk for pk in (str(ObjectId()) for _ in range(100)) if owner(pk, 2) == worker
+        )
+
+    def forwarded(self, path: str, headers: dict = None, replayed: bool = False, **kwargs) -> tuple:
+        requests = []
+
+        async def fetch(url, **kwargs):
+            requests.append((url, kwargs))
+            response_headers = {'Content-Type': 'application/json'}
+            if replayed:
+                response_headers['Idempotent-Replayed'] = 'true'
+            return mock.Mock(code=200, headers=response_headers, body=b'{"forwarded": true}')
+
+        with mock.patch('app.handlers.AsyncHTTPClient') as client:
+            client.return_value.fetch = fetch
+            response = self.fetch(path, headers=headers, **kwargs)
+        self.assertEqual(json.loads(response.body), {'forwarded': True})
+        return requests, response
+
+    def test_owner_header_not_trusted(self):
+        pk = self.owned_by(1)
+        requests, _ = self.forwarded('/api/games/%s' % pk, {'X-Game-Owner': '0'})
+        self.assertEqual(len(requests), 1)
+        url, kwargs = requests[0]
+        self.assertEqual(url, 'http://127.0.0.1:9001/api/games/%s' % pk)
+        self.assertNotIn('X-Game-Owner', kwargs['headers'])
+
+    def test_retried_key_forwarded(self):
+        pk = self.owned_by(1)
+        move = {'player': str(ObjectId()), 'symbol': 'X', 'cell': {'row': 0, 'column': 0}}
+        requests, response = self.forwarded(
+            '/api/games/%s' % pk, {'Idempotency-Key': 'retry-1'}, replayed=True,
+            method='POST', body=json.dumps(move),
+        )
+        self.assertEqual(requests[0][1]['headers'], {'Idempotency-Key': 'retry-1'})
+        self.assertEqual(response.headers['Idempotent-Replayed'], 'true')
+
+    def test_matchmaking_forwarded(self):
+        size = next(size for size in range(3, 20) if queue_owner('classic', size, 2) == 1)
+        requests, _ = self.forwarded(
+            '/api/matchmaking', method='POST',
+            body=json.dumps({'player': str(ObjectId()), 'size': size}),
+        )
+        self.assertEqual(requests[0][0], 'http://127.0.0.1:9001/api/matchmaking')
+        ticket = ticket_id(1, 2)
+        requests, _ = self.forwarded('/api/matchmaking/%s?wait=0' % ticket)
+        self.assertEqual(requests[0][0], 'http://127.0.0.1:9001/api/matchmaking/%s?wait=0' % ticket)
+        # Tickets of this worker are served here
+        response = self.fetch('/api/matchmaking/%s' % ticket_id(0, 2))
+        self.assertEqual(response.code, 404)
+
+
+class FakeReplays(Replays):
+    """
+    Snapshots and moves of a single game in memory
+    """
+
+    def __init__(self, moves: list, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.snapshots = []
+        self.log = moves
+        self.reads = []
+
+    async def closest(self, pk, number: int):
+        found = [snapshot for snapshot in self.snapshots if snapshot['n'] <= number]
+        return max(found, key=lambda snapshot: snapshot['n'], default=None)
+
+    async def moves(self, pk, after, limit: int) -> list:
+        self.reads.append(limit)
+        ids = [move['_id'] for move in self.log]
+        start = ids.index(after) + 1 if after is not None else 0
+        return self.log[start:start + limit]
+
+    async def write(self, snapshots: list):
+        known = {snapshot['n'] for snapshot in self.snapshots}
+        self.snapshots.extend(snapshot for snapshot in snapshots if snapshot['n'] not in known)
+
+
+class TestReplays(BaseTest):
+    cells = [(row, column) for row in range(4) for column in range(4)]
+
+    def game(self, moves: int, status: str = Game.STATUS_IN_PROGRESS) -> tuple:
+        game = Game(players=FakeActor.players, size=4, status=status)
+        game.pre_insert()
+        document = game.to_mongo()
+        document['_id'] = ObjectId()
+        game = Game.build_from_mongo(document)
+        log = []
+        for index, (row, column) in enumerate(self.cells[:moves]):
+            game.set_cell(row, column, 'XO'[index % 2])
+            log.append({
+                '_id': ObjectId(),
+                'g': game.pk,
+                'c': encode_cell({'row': row, 'column': column}),
+                's': 'XO'[index % 2],
+            })
+        return game, log
+
+    def test_replay_from_snapshots(self):
+        game, log = self.game(12)
+        replays = FakeReplays(log, interval=5)
+
+        async def scenario():
+            frame = await replays.frame(game, 7)
+            self.assertEqual(frame['at'], 7)
+            self.assertEqual(frame['status'], Game.STATUS_IN_PROGRESS)
+            self.assertEqual(frame['board'][1], ['X', 'O', 'X', ''])
+            self.assertEqual(sum(cell != '' for row in frame['board'] for cell in row), 7)
+            self.assertEqual([snapshot['n'] for snapshot in replays.snapshots], [5])
+            # Only the moves after the snapshot are read
+            await replays.frame(game, 9)
+            empty = await replays.frame(game, 0)
+            self.assertEqual(replays.reads, [7, 4])
+            self.assertEqual(empty['board'], [[''] * 4] * 4)
+            self.assertEqual((await replays.frame(game, 12))['board'], game.dump()['board'])
+            for number in (-1, 13):
+                with self.assertRaises(HTTPError):
+                    await replays.frame(game, number)
+
+        self.io_loop.run_sync(scenario)
+
+    def test_finished_games_cached(self):
+        game, log = self.game(10, Game.STATUS_TIE)
+        replays = FakeReplays(log, interval=5, cache_size=1)
+
+        async def scenario():
+            first = await replays.frame(game, 3)
+            self.assertIs(await replays.frame(game, 3), first)
+            await replays.frame(game, 4)
+            self.assertEqual(list(replays.frames), [(str(game.pk), 4)])
+            self.assertEqual(replays.reads, [3, 4])
+
+        self.io_loop.run_sync(scenario)
+
+    def test_board_snapshot(self):
+        game, _ = self.game(10)
+        replays = Replays(interval=5)
+        snapshot = replays.board_snapshot(game, ObjectId())
+        self.assertEqual(snapshot['n'], 10)
+        self.assertEqual(snapshot['x'], [0, 2, 1024, 1026, 2048])
+        self.assertEqual(len(snapshot['o']), 5)
+        game.set_cell(3, 3, 'X')
+        self.assertIsNone(replays.board_snapshot(game, ObjectId()))
+
+
+class TestCompactMoves(BaseTest):
+
+    def legacy(self, pk: ObjectId) -> dict:
+        return {
+            '_id': ObjectId(),
+            'game': pk,
+            'cell': {'row': 2, 'column': 1},
+            'symbol': 'X',
+            'player': ObjectId(),
+            'created_at': datetime.datetime.now(),
+        }
+
+    def test_cells(self):
+        self.assertEqual(encode_cell({'row': 2, 'column': 1}), 2049)
+        self.assertEqual(decode_cell(2049), {'row': 2, 'column': 1})
+        self.assertEqual(decode_cell({'row': 0, 'column': 3}), {'row': 0, 'column': 3})
+        self.assertIsNone(encode_cell({'row': 'a', 'column': 1}))
+
+    def test_legacy_documents(self):
+        document = self.legacy(ObjectId())
+        compact = compact_move(document)
+        self.assertEqual(compact, {
+            '_id': document['_id'],
+            'g': document['game'],
+            'c': 2049,
+            's': 'X',
+            'p': document['player'],
+        })
+        self.assertEqual(compact_move(compact), compact)
+        move = GameMove.build_from_mongo(document)
+        self.assertEqual(move.cell, {'row': 2, 'column': 1})
+        self.assertEqual(move.to_mongo(), compact)
+
+    def test_api_shape(self):
+        pk = ObjectId()
+        document = GameMove(game=pk, cell={'row': 1, 'column': 0}, symbol='O', player=ObjectId()).to_mongo()
+        self.assertEqual(set(document), {'g', 'c', 's', 'p'})
+        self.assertEqual(document['c'], 1024)
+        document['_id'] = ObjectId()
+        dumped = GameMove.build_from_mongo(document).dump()
+        self.assertEqual(dumped['cell'], {'row': 1, 'column': 0})
+        self.assertEqual(dumped['game'], str(pk))
+        self.assertEqual(dumped['created_at'], document['_id'].generation_time.isoformat())
+
+    def test_legacy_segments(self):
+        with tempfile.TemporaryDirectory() as directory:
+            pk = ObjectId()
+            move = self.legacy(pk)
+            path = write_segment(directory, [{'game': {'_id': pk}, 'moves': [move]}])
+            self.assertEqual(Segment(path).get(str(pk))['moves'], [compact_move(move)])
+
+    def test_measure(self):
+        sizes = compact_moves.measure(1000)
+        self.assertLess(sizes['compact_bytes'], sizes['legacy_bytes'])
+        self.assertEqual(
+            compact_moves.per_million({'count': 10, 'size': 100, 'storage_size': 50, 'index_size': 20},
+                                      {'count': 10, 'size': 60, 'storage_size': 40, 'index_size': 20}),
+            {'size': 4000000, 'storage_size': 1000000, 'index_size': 0},
+        )
+
+
+class TestSingleFlight(BaseTest):
+
+    def test_concurrent_calls_shared(self):
+        flight = SingleFlight('test.reads')
+        calls = []
+
+        async def read():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return len(calls)
+
+        async def scenario():
+            coalesced = metrics.get('test.reads.coalesced')
+            results = await asyncio.gather(*(flight.do('game', read) for _ in range(5)))
+            self.assertEqual(results, [1] * 5)
+            self.assertEqual(metrics.get('test.reads.coalesced') - coalesced, 4)
+            self.assertFalse(flight.calls)
+            # Finished calls are not reused
+            self.assertEqual(await flight.do('game', read), 2)
+
+        self.io_loop.run_sync(scenario)
+
+    def test_errors_and_cancellation(self):
+        flight = SingleFlight('test.reads')
+
+        async def missing():
+            await asyncio.sleep(0.01)
+            raise KeyError('game')
+
+        async def scenario():
+            first = asyncio.ensure_future(flight.do('game', missing))
+            second = asyncio.ensure_future(flight.do('game', missing))
+            await asyncio.sleep(0)
+            first.cancel()
+            with self.assertRaises(KeyError):
+                await second
+            self.assertFalse(flight.calls)
+
+        self.io_loop.run_sync(scenario)
+
+
+class TestIdempotency(BaseTest):
+
+    def test_store_bounded(self):
+        store = IdempotencyStore(size=2)
+        store.store('game', 'one', (200, {}))
+        store.store('game', 'two', (200, {}))
+        self.assertEqual(store.get('game', 'one'), (200, {}))
+        store.store('game', 'three', (412, {}))
+        self.assertIsNone(store.get('game', 'two'))
+        self.assertEqual(list(store.entries), [('game', 'one'), ('game', 'three')])
+
+    def test_expired_responses(self):
+        store = IdempotencyStore(ttl=-1)
+        store.store('game', 'one', (200, {}))
+        self.assertIsNone(store.get('game', 'one'))
+        self.assertFalse(store.entries)
+
+    def test_retries_share_submission(self):
+        store = IdempotencyStore()
+        calls = []
+
+        async def submit():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return 200, {'version': len(calls)}
+
+        async def scenario():
+            results = await asyncio.gather(*(store.respond('game', 'key', submit) for _ in range(3)))
+            self.assertEqual([result[0] for result in results], [(200, {'version': 1})] * 3)
+            self.assertEqual(await store.respond('game', 'key', submit), ((200, {'version': 1}), True))
+            self.assertEqual(len(calls), 1)
+
+        self.io_loop.run_sync(scenario)
+
+    def test_invalid_key(self):
+        response = self.fetch(
+            '/api/games/5c9d2a62e3872b287363cf25',
+            method="POST",
+            body=json.dumps({}),
+            headers={'Idempotency-Key': 'k' * 256},
+        )
+        self.assertEqual(response.code, 400)
+
+
 class TestUserHandler(BaseTest):
     def get_app(self):
         db = MotorClient(
@@ -92,6 +1796,22 @@ class TestUserHandler(BaseTest):
         )
         self.assertEqual(response.code, 200)
 
+    def test_get_user_stats(self):
+        user_id = self.create_user()
+        response = self.fetch(
+            '/api/users/%s/stats' % user_id,
+            method="GET",
+        )
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body.decode())['games_played'], 0)
+
+    def test_get_user_stats_not_found(self):
+        response = self.fetch(
+            '/api/users/%s/stats' % '5c9d2b09e3872b287363cf28',
+            method="GET",
+        )
+        self.assertEqual(response.code, 404)
+
     def test_get_user_invalid_mongo_id(self):
         response = self.fetch(
             '/api/users/%s' % '123456',
@@ -234,6 +1954,22 @@ class TestGameHandler(BaseTest):
         )
         self.assertEqual(response.code, 200)
 
+    def test_game_success_gomoku(self):
+        player_one_id = self.create_player_one()
+        data = {
+            "players": [player_one_id],
+            "mode": "gomoku",
+            "size": 100,
+            "win_length": 5,
+        }
+        response = self.fetch(
+            '/api/games',
+            method="POST",
+            body=json.dumps(data, ensure_ascii=False),
+        )
+        self.assertEqual(response.code, 200)
+        self.assertNotIn('board', json.loads(response.body.decode()))
+
     def test_get_game(self):
         game_id = self.create_game()
         response = self.fetch(
@@ -294,10 +2030,13 @@ class TestPlay(BaseTest):
         loop.run_until_complete(game.commit())
         return game.pk.__str__(), player_one_id, player_two_id
 
-    def create_single_player_game(self) -> Tuple:
-        ensure_ai_user()
+    def create_single_player_game(self, bot: str = None) -> Tuple:
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(ensure_bot_users())
         player_one_id = self.create_player_one()
         data = {"players": [player_one_id]}
+        if bot:
+            data['bot'] = bot
         game = Game(**data)
         loop = asyncio.get_event_loop()
         loop.run_until_complete(game.commit())
@@ -457,6 +2196,70 @@ class TestPlay(BaseTest):
         )
         self.assertEqual(response.code, 200)
 
+    def test_concurrent_moves_of_a_player(self):
+        game_id, player_one, player_two = self.create_game()
+        evaluate = GameEngine.evaluate
+
+        async def slow_evaluate(engine, *args, **kwargs):
+            # Keeps the first move between its claim and its commit
+            await asyncio.sleep(0.2)
+            return await evaluate(engine, *args, **kwargs)
+
+        def submit(row, column, delay):
+            async def fetch():
+                await asyncio.sleep(delay)
+                return await self.http_client.fetch(
+                    self.get_url('/api/games/%s' % game_id),
+                    method="POST",
+                    body=json.dumps({
+                        "player": player_one,
+                        "symbol": "X",
+                        "cell": {"row": row, "column": column},
+                    }),
+                    raise_error=False,
+                )
+            return fetch()
+
+        with mock.patch.object(GameEngine, 'evaluate', slow_evaluate):
+            responses = self.io_loop.run_sync(
+                lambda: asyncio.gather(submit(0, 0, 0), submit(1, 1, 0.05)),
+            )
+        self.assertEqual(sorted(response.code for response in responses), [200, 409])
+        game = json.loads(self.fetch('/api/games/%s' % game_id).body)
+        self.assertEqual(game['version'], 1)
+        self.assertEqual(sum(cell == 'X' for row in game['board'] for cell in row), 1)
+
+        # A refused move releases the turn without a new version
+        response = self.fetch(
+            '/api/games/%s' % game_id,
+            method="POST",
+            body=json.dumps({"player": player_two, "symbol": "O", "cell": {"row": 3, "column": 3}}),
+        )
+        self.assertEqual(response.code, 412)
+        response = self.fetch(
+            '/api/games/%s' % game_id,
+            method="POST",
+            body=json.dumps({"player": player_two, "symbol": "O", "cell": {"row": 2, "column": 2}}),
+        )
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body)['version'], 2)
+
+    def test_replay_at_move(self):
+        game_id, player_one, player_two = self.create_game()
+        for player, symbol, row in [(player_one, 'X', 0), (player_two, 'O', 1)]:
+            self.fetch(
+                '/api/games/%s' % game_id,
+                method="POST",
+                body=json.dumps({"player": player, "symbol": symbol, "cell": {"row": row, "column": 0}}),
+            )
+        response = self.fetch('/api/games/%s?at=1' % game_id)
+        self.assertEqual(response.code, 200)
+        data = json.loads(response.body.decode())
+        self.assertEqual(data['at'], 1)
+        self.assertEqual([row[0] for row in data['board']], ['X', '', ''])
+        self.assertEqual(self.fetch('/api/games/%s?at=3' % game_id).code, 400)
+        self.assertEqual(self.fetch('/api/games/%s?at=last' % game_id).code, 400)
+
     def test_single_player(self):
         game_id, player_one = self.create_single_player_game()
         data = {
@@ -474,3 +2277,325 @@ class TestPlay(BaseTest):
         )
         print(response.body.decode())
         self.assertEqual(response.code, 200)
+
+    def test_single_player_chosen_bot(self):
+        game_id, player_one = self.create_single_player_game('perfect')
+        data = {
+            "player": player_one,
+            "symbol": "X",
+            "cell": {
+                "row": 0,
+                "column": 0
+            }
+        }
+        response = self.fetch(
+            '/api/games/%s' % game_id,
+            method="POST",
+            body=json.dumps(data, ensure_ascii=False),
+        )
+        self.assertEqual(response.code, 200)
+        game = json.loads(response.body)
+        self.assertEqual(game['bot'], 'perfect')
+        # Perfect play answers a corner opening in the center
+        self.assertEqual(game['board'][1][1], 'O')
+
+    def test_simulation(self):
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(ensure_bot_users())
+        data = {"x": "perfect", "o": "easy", "games": 5, "moves": [{"row": 0, "column": 0}]}
+        response = self.fetch(
+            '/api/games/simulations',
+            method="POST",
+            body=json.dumps(data, ensure_ascii=False),
+        )
+        self.assertEqual(response.code, 200)
+        report = json.loads(response.body)
+        self.assertEqual(len(report['games']), 5)
+        self.assertEqual(report['outcomes']['O'], 0)
+        response = self.fetch('/api/games/%s' % report['games'][0])
+        game = json.loads(response.body)
+        self.assertTrue(game['simulated'])
+        self.assertIn(game['status'], [Game.STATUS_FINISHED, Game.STATUS_TIE])
+        self.assertEqual(game['board'][0][0], 'X')
+        response = self.fetch('/api/games/%s/moves' % report['games'][0])
+        self.assertEqual(len(json.loads(response.body)['data']), game['version'])
+
+    def test_simulation_illegal_opening(self):
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(ensure_bot_users())
+        data = {"moves": [{"row": 0, "column": 0}, {"row": 0, "column": 0}]}
+        response = self.fetch(
+            '/api/games/simulations',
+            method="POST",
+            body=json.dumps(data, ensure_ascii=False),
+        )
+        self.assertEqual(response.code, 400)
+
+    def test_expand_players(self):
+        game_id, player_one, player_two = self.create_game()
+        response = self.fetch('/api/games/%s?expand=players' % game_id)
+        self.assertEqual(response.code, 200)
+        game = json.loads(response.body)
+        self.assertEqual(game['players'], [
+            {'id': player_one, 'username': 'playerone'},
+            {'id': player_two, 'username': 'playertwo'},
+        ])
+        response = self.fetch('/api/games?expand=players')
+        games = json.loads(response.body)['data']
+        self.assertEqual(games[0]['players'][1]['username'], 'playertwo')
+        self.fetch(
+            '/api/users/%s' % player_two,
+            method="PUT",
+            body=json.dumps({'username': 'renamedplayer'}),
+        )
+        response = self.fetch('/api/games/%s?expand=players' % game_id)
+        game = json.loads(response.body)
+        self.assertEqual(game['players'][1]['username'], 'renamedplayer')
+
+    def test_archived_game(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.addCleanup(archive.configure, archive.directory, archive.age, archive.batch_size)
+        # A negative age archives the games created this very second
+        archive.configure(directory.name, -1, 2)
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(ensure_bot_users())
+        response = self.fetch(
+            '/api/games/simulations',
+            method="POST",
+            body=json.dumps({"games": 3}),
+        )
+        game_id = json.loads(response.body)['games'][0]
+        game = json.loads(self.fetch('/api/games/%s' % game_id).body)
+        moves = json.loads(self.fetch('/api/games/%s/moves' % game_id).body)['data']
+
+        self.assertEqual(loop.run_until_complete(archive.archive_games()), 3)
+        self.assertIsNone(loop.run_until_complete(Game.find_one({'_id': ObjectId(game_id)})))
+        response = self.fetch('/api/games/%s' % game_id)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body), game)
+        response = self.fetch('/api/games/%s/moves' % game_id)
+        self.assertEqual(json.loads(response.body)['data'], moves)
+        response = self.fetch('/api/games/moves?ids=%s' % game_id)
+        self.assertEqual(json.loads(response.body)['data'][0]['moves'], moves)
+
+    def test_export(self):
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(ensure_bot_users())
+        response = self.fetch(
+            '/api/games/simulations',
+            method="POST",
+            body=json.dumps({"games": 5}),
+        )
+        games = json.loads(response.body)['games']
+        response = self.fetch('/api/export/games?batch_size=2&status=finished,tie')
+        self.assertEqual(response.code, 200)
+        lines = [json.loads(line) for line in response.body.decode().splitlines()]
+        self.assertEqual([line['id'] for line in lines], sorted(games))
+        self.assertEqual(len(lines[0]['moves']), lines[0]['version'])
+        response = self.fetch('/api/export/games?after=%s' % lines[2]['id'])
+        self.assertEqual(len(response.body.decode().splitlines()), 2)
+        response = self.fetch('/api/export/games?status=lost')
+        self.assertEqual(response.code, 400)
+
+    def test_batch_moves(self):
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(ensure_bot_users())
+        data = {"x": "easy", "o": "easy", "games": 3}
+        response = self.fetch(
+            '/api/games/simulations',
+            method="POST",
+            body=json.dumps(data, ensure_ascii=False),
+        )
+        games = json.loads(response.body)['games']
+        empty = '5c9d2a62e3872b287363cf25'
+        response = self.fetch('/api/games/moves?ids=%s' % ','.join(games + [empty]))
+        self.assertEqual(response.code, 200)
+        body = json.loads(response.body)
+        self.assertEqual(body['remaining'], [])
+        groups = {group['game']: group['moves'] for group in body['data']}
+        self.assertEqual(set(groups), set(games + [empty]))
+        self.assertEqual(groups[empty], [])
+        for pk in games:
+            moves = json.loads(self.fetch('/api/games/%s/moves' % pk).body)['data']
+            self.assertEqual(groups[pk], moves)
+
+        with mock.patch.object(handlers.BatchMovesRetriever, 'MAX_BYTES', 10):
+            response = self.fetch('/api/games/moves?ids=%s' % ','.join(games))
+        body = json.loads(response.body)
+        self.assertEqual(len(body['data']), 1)
+        self.assertEqual(len(body['remaining']), 2)
+
+    def test_openings(self):
+        game_id, player_one, player_two = self.create_game()
+        cells = [(1, 1), (0, 0), (1, 0), (0, 1), (1, 2)]
+        for index, (row, column) in enumerate(cells):
+            data = {
+                "player": [player_one, player_two][index % 2],
+                "symbol": "XO"[index % 2],
+                "cell": {"row": row, "column": column},
+            }
+            self.fetch(
+                '/api/games/%s' % game_id,
+                method="POST",
+                body=json.dumps(data, ensure_ascii=False),
+            )
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(ensure_bot_users())
+        self.fetch('/api/games/simulations', method="POST", body=json.dumps({"games": 3}))
+        # Count the moves played this very second
+        with mock.patch.object(analytics, 'GRACE', -1):
+            self.assertEqual(loop.run_until_complete(analytics.openings.refresh()), 1)
+            self.assertEqual(loop.run_until_complete(analytics.openings.refresh()), 0)
+        response = self.fetch('/api/analytics/openings?size=3')
+        self.assertEqual(response.code, 200)
+        board, = json.loads(response.body)['boards']
+        self.assertEqual(board['games'], 1)
+        self.assertEqual(board['openings'], [{
+            'row': 1, 'column': 1, 'games': 1, 'frequency': 1,
+            'win_rate': 1, 'tie_rate': 0, 'loss_rate': 0,
+        }])
+
+    def test_matchmaking(self):
+        player_one = self.create_player_one()
+        player_two = self.create_player_two()
+        response = self.fetch(
+            '/api/matchmaking',
+            method="POST",
+            body=json.dumps({"player": player_one}),
+        )
+        self.assertEqual(response.code, 200)
+        ticket = json.loads(response.body)
+        self.assertEqual(ticket['status'], 'waiting')
+        response = self.fetch('/api/matchmaking/%s?wait=0' % ticket['id'])
+        self.assertEqual(json.loads(response.body)['status'], 'waiting')
+        response = self.fetch(
+            '/api/matchmaking',
+            method="POST",
+            body=json.dumps({"player": player_two}),
+        )
+        matched = json.loads(response.body)
+        self.assertEqual(matched['status'], 'matched')
+        response = self.fetch('/api/matchmaking/%s' % ticket['id'])
+        self.assertEqual(json.loads(response.body)['game'], matched['game'])
+        game = json.loads(self.fetch('/api/games/%s' % matched['game']).body)
+        self.assertTrue(game['multiplayer'])
+        self.assertEqual(game['players'], [player_one, player_two])
+        response = self.fetch(
+            '/api/matchmaking',
+            method="POST",
+            body=json.dumps({"player": "5c9d2a62e3872b287363cf25"}),
+        )
+        self.assertEqual(response.code, 404)
+
+    def test_game_actors(self):
+        self.addCleanup(actors.configure, actors.enabled, actors.idle, actors.flush_delay)
+        actors.configure(True, 0.2, 0.05)
+        game_id, player_one = self.create_single_player_game()
+        data = {"player": player_one, "symbol": "X", "cell": {"row": 1, "column": 1}}
+        response = self.fetch(
+            '/api/games/%s' % game_id,
+            method="POST",
+            body=json.dumps(data, ensure_ascii=False),
+        )
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body)['version'], 2)
+        response = self.fetch(
+            '/api/games/%s' % game_id,
+            method="POST",
+            body=json.dumps(data, ensure_ascii=False),
+        )
+        self.assertEqual(response.code, 412)
+        game = json.loads(self.fetch('/api/games/%s' % game_id).body)
+        self.assertEqual(game['version'], 2)
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(asyncio.wait_for(actors.actors[game_id].task, 5))
+        stored = loop.run_until_complete(Game.find_one({'_id': ObjectId(game_id)}))
+        self.assertEqual(stored.version, 2)
+        self.assertEqual(stored.board[1][1], 'X')
+        moves = json.loads(self.fetch('/api/games/%s/moves' % game_id).body)['data']
+        self.assertEqual(len(moves), 2)
+
+    def test_idempotent_moves(self):
+        game_id, player_one, player_two = self.create_game()
+        data = {"player": player_one, "symbol": "X", "cell": {"row": 0, "column": 0}}
+
+        def submit(key, body=data):
+            return self.fetch(
+                '/api/games/%s' % game_id,
+                method="POST",
+                body=json.dumps(body, ensure_ascii=False),
+                headers={'Idempotency-Key': key},
+            )
+
+        first = submit('first')
+        self.assertEqual(first.code, 200)
+        retry = submit('first')
+        self.assertEqual(retry.code, 200)
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(json.loads(retry.body), json.loads(first.body))
+        # Retry reaching a worker that does not know the response
+        idempotency.configure(idempotency.size, idempotency.ttl)
+        retry = submit('first')
+        self.assertEqual(retry.code, 200)
+        self.assertEqual(json.loads(retry.body)['version'], 1)
+        moves = json.loads(self.fetch('/api/games/%s/moves' % game_id).body)['data']
+        self.assertEqual(len(moves), 1)
+        self.assertNotIn('idempotency_key', moves[0])
+
+        invalid = dict(data, player=player_two, symbol="O")
+        self.assertEqual(submit('second', invalid).code, 412)
+        retry = submit('second', dict(invalid, cell={"row": 1, "column": 1}))
+        self.assertEqual(retry.code, 412)
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+
+    def test_batch_moves_limits(self):
+        response = self.fetch('/api/games/moves?ids=1234')
+        self.assertEqual(response.code, 400)
+        ids = ['%024x' % i for i in range(handlers.BatchMovesRetriever.MAX_IDS + 1)]
+        response = self.fetch('/api/games/moves?ids=%s' % ','.join(ids))
+        self.assertEqual(response.code, 400)
+
+    def test_single_player_async_reply(self):
+        STRATEGIES['slow'] = SlowStrategy
+        self.addCleanup(STRATEGIES.pop, 'slow')
+        bots.bots['slow'] = Bot('slow', 'tictactoeai-slow', strategy='slow', pool=POOL_THREAD)
+        self.addCleanup(bots.bots.pop, 'slow')
+        game_id, player_one = self.create_single_player_game('slow')
+        data = {
+            "player": player_one,
+            "symbol": "X",
+            "cell": {
+                "row": 0,
+                "column": 0
+            }
+        }
+        response = self.fetch(
+            '/api/games/%s' % game_id,
+            method="POST",
+            headers={'Prefer': 'respond-async'},
+            body=json.dumps(data, ensure_ascii=False),
+        )
+        self.assertEqual(response.code, 202)
+        game = json.loads(response.body)
+        self.assertEqual(game['version'], 1)
+        self.assertIn('bot_pending_since', game)
+
+        # Legal move of the bot user itself, refused while its reply is pending
+        data = {
+            "player": bots.get('slow').pk,
+            "symbol": "O",
+            "cell": {"row": 2, "column": 2},
+        }
+        response = self.fetch(
+            '/api/games/%s' % game_id,
+            method="POST",
+            body=json.dumps(data, ensure_ascii=False),
+        )
+        self.assertEqual(response.code, 409)
+
+        response = self.fetch('/api/games/%s?version=1&wait=5' % game_id)
+        game = json.loads(response.body)
+        self.assertEqual(game['version'], 2)
+        self.assertNotIn('bot_pending_since', game)
+        self.assertEqual(sum(cell != '' for row in game['board'] for cell in row), 2)
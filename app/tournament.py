@@ -0,0 +1,259 @@
+"""
+Round-robin tournament between the registered strategies, used to
+decide which strategy the bot plays with in production:
+
+    python -m app.tournament --strategies random qlearning --sizes 3 4 --games 500
+
+At every board size each pair of strategies plays the given amount of
+games with each side, on a pool of processes. The report gives, per
+board size, the Elo rating of every strategy with a 95% confidence
+interval, the results of every pairing and the move latency percentiles.
+"""
+import math
+import time
+import json
+import random
+import argparse
+import itertools
+import multiprocessing
+from typing import List
+
+import numpy as np
+
+from app.selfplay import OUTCOME_TIE, play, game_seed
+from app.strategies import STRATEGIES, get_strategy
+
+
+BASE_RATING = 1500
+ELO_SCALE = 400 / math.log(10)
+# Virtual tie added to every pairing, keeps the rating of a strategy
+# that never scores finite
+PRIOR_TIES = 1
+PERCENTILES = [50, 90, 99]
+CONFIDENCE = 95
+
+
+def schedule(names: List[str], sizes: List[int], games: int, chunk_size: int, seed: int) -> list:
+    """
+    Tasks of a tournament: every ordered pair of strategies at every size
+    :return list: (size, x name, o name, seed, start, end)
+    """
+    return [
+        (size, x_name, o_name, seed, start, min(start + chunk_size, games))
+        for size in sizes
+        for x_name, o_name in itertools.permutations(names, 2)
+        for start in range(0, games, chunk_size)
+    ]
+
+
+def play_chunk(task: tuple) -> tuple:
+    """
+    Play a range of games of a pairing, executed by the pool workers
+    :param tuple task: see schedule
+    :return tuple: (size, x name, o name, outcome counts, move seconds of X, move seconds of O)
+    """
+    size, x_name, o_name, seed, start, end = task
+    x_strategy = get_strategy(x_name)
+    o_strategy = get_strategy(o_name)
+    outcomes = {'X': 0, 'O': 0, OUTCOME_TIE: 0}
+    timings = {'X': [], 'O': []}
+    for index in range(start, end):
+        rng = random.Random(game_seed('%s:%s:%s:%s' % (seed, size, x_name, o_name), index))
+        outcome, _ = play(x_strategy, o_strategy, size, size, timings, rng=rng)
+        outcomes[outcome] += 1
+    return size, x_name, o_name, outcomes, timings['X'], timings['O']
+
+
+def ratings(names: List[str], pairings: list) -> np.ndarray:
+    """
+    Maximum likelihood Elo ratings (Bradley-Terry model, ties count as
+    half a win for each side), centered on BASE_RATING
+    :param list names: strategies
+    :param list pairings: (x name, o name, x wins, o wins, ties)
+    :return np.ndarray: rating of every strategy, in the order of names
+    """
+    index = {name: position for position, name in enumerate(names)}
+    wins = np.full((len(names), len(names)), PRIOR_TIES / 2)
+    np.fill_diagonal(wins, 0)
+    for x_name, o_name, x_wins, o_wins, ties in pairings:
+        wins[index[x_name], index[o_name]] += x_wins + ties / 2
+        wins[index[o_name], index[x_name]] += o_wins + ties / 2
+    games = wins + wins.T
+    scores = wins.sum(axis=1)
+    strength = np.ones(len(names))
+    for _ in range(1000):
+        updated = scores / (games / (strength[:, None] + strength[None, :])).sum(axis=1)
+        updated /= np.exp(np.log(updated).mean())
+        converged = np.allclose(updated, strength, rtol=1e-9)
+        strength = updated
+        if converged:
+            break
+    return BASE_RATING + ELO_SCALE * np.log(strength)
+
+
+def confidence_intervals(names: List[str], pairings: list, samples: int, seed: int) -> np.ndarray:
+    """
+    Bootstrap intervals of the ratings: the games of every pairing are
+    resampled with replacement, which is a multinomial draw of its counts
+    :return np.ndarray: (len(names), 2) lower and upper bounds
+    """
+    generator = np.random.default_rng(seed)
+    draws = np.empty((samples, len(names)))
+    for sample in range(samples):
+        resampled = []
+        for x_name, o_name, x_wins, o_wins, ties in pairings:
+            played = x_wins + o_wins + ties
+            if played:
+                counts = generator.multinomial(played, np.array([x_wins, o_wins, ties]) / played)
+                resampled.append((x_name, o_name, *counts))
+        draws[sample] = ratings(names, resampled)
+    margin = (100 - CONFIDENCE) / 2
+    return np.percentile(draws, [margin, 100 - margin], axis=0).T
+
+
+def latency(seconds: list) -> dict:
+    """
+    Summary of the time spent on moves, in microseconds
+    :param list seconds:
+    :return dict:
+    """
+    if not seconds:
+        return {'moves': 0}
+    micro = np.asarray(seconds) * 1e6
+    summary = {'moves': len(micro), 'mean_us': float(micro.mean())}
+    for percentile, value in zip(PERCENTILES, np.percentile(micro, PERCENTILES)):
+        summary['p%s_us' % percentile] = float(value)
+    summary['max_us'] = float(micro.max())
+    return summary
+
+
+def run(
+        names: List[str],
+        sizes: List[int],
+        games: int,
+        seed: int = 0,
+        workers: int = None,
+        chunk_size: int = 100,
+        samples: int = 200,
+) -> dict:
+    """
+    Play a whole tournament and build its report
+    :param list names: strategies, two at least
+    :param list sizes: board sizes
+    :param int games: games of every ordered pair, so each side is played that many times
+    :param int seed:
+    :param int workers: amount of processes, one per core by default
+    :param int chunk_size: games per task sent to a worker
+    :param int samples: bootstrap samples of the confidence intervals
+    :return dict:
+    """
+    if len(set(names)) < 2:
+        raise ValueError('A tournament needs two strategies at least')
+    for name in names:
+        get_strategy(name)
+    results = {
+        (size, x_name, o_name): {'X': 0, 'O': 0, OUTCOME_TIE: 0}
+        for size in sizes
+        for x_name, o_name in itertools.permutations(names, 2)
+    }
+    timings = {(size, name): [] for size in sizes for name in names}
+    started = time.monotonic()
+    with multiprocessing.Pool(workers) as pool:
+        tasks = schedule(names, sizes, games, chunk_size, seed)
+        for size, x_name, o_name, outcomes, x_times, o_times in pool.imap_unordered(play_chunk, tasks):
+            for outcome, count in outcomes.items():
+                results[size, x_name, o_name][outcome] += count
+            timings[size, x_name].extend(x_times)
+            timings[size, o_name].extend(o_times)
+
+    report = {'games': games, 'sizes': {}}
+    for size in sizes:
+        pairings = [
+            (x_name, o_name, counts['X'], counts['O'], counts[OUTCOME_TIE])
+            for (played_size, x_name, o_name), counts in results.items()
+            if played_size == size
+        ]
+        elo = ratings(names, pairings)
+        intervals = confidence_intervals(names, pairings, samples, seed)
+        table = {}
+        for position, name in enumerate(names):
+            score = played = 0
+            for x_name, o_name, x_wins, o_wins, ties in pairings:
+                if name in (x_name, o_name):
+                    played += x_wins + o_wins + ties
+                    score += (x_wins if name == x_name else o_wins) + ties / 2
+            table[name] = {
+                'elo': float(elo[position]),
+                'low': float(intervals[position][0]),
+                'high': float(intervals[position][1]),
+                'games': played,
+                'score': score / played if played else 0,
+                'latency': latency(timings[size, name]),
+            }
+        report['sizes'][size] = {
+            'ratings': table,
+            'pairings': [
+                {'x': x_name, 'o': o_name, 'x_wins': x_wins, 'o_wins': o_wins, 'ties': ties}
+                for x_name, o_name, x_wins, o_wins, ties in pairings
+            ],
+        }
+    report['seconds'] = time.monotonic() - started
+    return report
+
+
+def format_report(report: dict) -> str:
+    """
+    Human readable ranking of every board size
+    :param dict report: result of run
+    :return str:
+    """
+    lines = []
+    for size, section in report['sizes'].items():
+        lines.append('%sx%s' % (size, size))
+        lines.append('  %-12s %6s %15s %7s %10s %10s %10s' % (
+            'strategy', 'elo', '95% interval', 'score', 'p50 us', 'p90 us', 'p99 us',
+        ))
+        ranking = sorted(section['ratings'].items(), key=lambda item: -item[1]['elo'])
+        for name, row in ranking:
+            lines.append('  %-12s %6.0f %7.0f..%-6.0f %6.1f%% %10.1f %10.1f %10.1f' % (
+                name,
+                row['elo'],
+                row['low'],
+                row['high'],
+                100 * row['score'],
+                row['latency'].get('p50_us', 0),
+                row['latency'].get('p90_us', 0),
+                row['latency'].get('p99_us', 0),
+            ))
+    return '\n'.join(lines)
+
+
+def main():
+    """
+    Command line entry point
+    :return:
+    """
+    parser = argparse.ArgumentParser(description='Round-robin tournament between bot strategies')
+    parser.add_argument('--strategies', nargs='+', default=sorted(STRATEGIES))
+    parser.add_argument('--sizes', nargs='+', type=int, default=[3])
+    parser.add_argument('--games', type=int, default=1000, help='games of every pairing and side')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunk-size', type=int, default=100)
+    parser.add_argument('--samples', type=int, default=200, help='bootstrap samples')
+    parser.add_argument('--json', action='store_true', help='print the full report as JSON')
+    arguments = parser.parse_args()
+    report = run(
+        arguments.strategies,
+        arguments.sizes,
+        arguments.games,
+        seed=arguments.seed,
+        workers=arguments.workers,
+        chunk_size=arguments.chunk_size,
+        samples=arguments.samples,
+    )
+    print(json.dumps(report) if arguments.json else format_report(report))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,40 +1,133 @@
 """
 Collection of project routes and where do they point to
 """
-import os
 from tornado.web import Application, url
-from app.models import User, Game, GameMove
+from app.models import User, Game, instance
+from app.settings import Settings
+from app.bootstrap import Bootstrap
+from app.qlearning import value_tables
+from app.tablebase import tablebases
+from app.context import Context
 import app.handlers
 
 
-application = Application([
-        url(
-            r"/",
-            app.handlers.MainHandler,
-        ),
-        url(
-            r"/api/users",
-            app.handlers.AbstractGeneralHandler,
-            {'cls': User},
-        ),
-        url(
-            r"/api/users/(?P<pk>\w+)",
-            app.handlers.AbstractObjHandler,
-            {'cls': User},
-        ),
-        url(
-            r"/api/games",
-            app.handlers.AbstractGeneralHandler,
-            {'cls': Game}
-        ),
-        url(
-            r"/api/games/(?P<pk>\w+)",
-            app.handlers.GameMoveHandler,
-        ),
-        url(
-            r"/api/games/(?P<pk>\w+)/moves",
-            app.handlers.GameMovesRetriever,
-        ),
-    ],
-    debug=os.getenv('DEBUG_FLAG') == "True",
-)
+def make_app(settings: Settings = None, tasks=None, periodic=None, context: Context = None) -> Application:
+    """
+    Application factory. Building an application does no I/O: the
+    database client is created on first use and the bootstrap tasks
+    only run when the worker starts serving.
+
+    The configuration, the bootstrap and the services of app.context
+    (bots, background replies, player cache, archive, matchmaking
+    queues, game actors, idempotency store and replays) belong to the
+    application. The models and the value tables stay shared by the
+    whole process: umongo binds the documents to a single database
+    instance, and the strategies read the tables from the pool
+    processes. Building an application reconfigures them, closing the
+    previous database client, so the last application built is the one
+    reaching the database.
+    :param Settings settings: configuration, taken from the environment by default
+    :param tasks: bootstrap tasks, app.bootstrap.TASKS by default
+    :param periodic: periodic tasks, app.bootstrap.PERIODIC by default
+    :param Context context: services, new ones by default
+    :return Application:
+    """
+    settings = settings or Settings()
+    instance.configure(settings)
+    value_tables.configure(settings.tables_dir)
+    tablebases.configure(settings.tables_dir)
+    context = context or Context.create(settings)
+    application = Application([
+            url(
+                r"/",
+                app.handlers.MainHandler,
+            ),
+            url(
+                r"/health/live",
+                app.handlers.LivenessHandler,
+            ),
+            url(
+                r"/health/ready",
+                app.handlers.ReadinessHandler,
+            ),
+            url(
+                r"/metrics",
+                app.handlers.MetricsHandler,
+            ),
+            url(
+                r"/api/leaderboard",
+                app.handlers.LeaderboardHandler,
+            ),
+            url(
+                r"/api/analytics/openings",
+                app.handlers.OpeningsHandler,
+            ),
+            url(
+                r"/api/matchmaking",
+                app.handlers.MatchmakingHandler,
+            ),
+            url(
+                r"/api/matchmaking/(?P<pk>\w+)",
+                app.handlers.TicketHandler,
+            ),
+            url(
+                r"/api/bots",
+                app.handlers.BotsHandler,
+            ),
+            url(
+                r"/api/users",
+                app.handlers.AbstractGeneralHandler,
+                {'cls': User},
+            ),
+            url(
+                r"/api/users/(?P<pk>\w+)",
+                app.handlers.AbstractObjHandler,
+                {'cls': User},
+            ),
+            url(
+                r"/api/users/(?P<pk>\w+)/stats",
+                app.handlers.UserStatsHandler,
+            ),
+            url(
+                r"/api/games",
+                app.handlers.AbstractGeneralHandler,
+                {'cls': Game}
+            ),
+            url(
+                r"/api/export/games",
+                app.handlers.ExportHandler,
+            ),
+            url(
+                r"/api/games/moves",
+                app.handlers.BatchMovesRetriever,
+            ),
+            url(
+                r"/api/games/simulations",
+                app.handlers.SimulationHandler,
+            ),
+            url(
+                r"/api/games/(?P<pk>\w+)",
+                app.handlers.GameMoveHandler,
+            ),
+            url(
+                r"/api/games/(?P<pk>\w+)/moves",
+                app.handlers.GameMovesRetriever,
+            ),
+        ],
+        debug=settings.debug,
+    )
+    application.config = settings
+    application.context = context
+    # Position of the worker serving the application, see app.server
+    application.worker_id = 0
+    application.bootstrap = Bootstrap(
+        tasks,
+        retry=settings.bootstrap_retry,
+        periodic=periodic,
+    )
+    return application
+
+
+settings = Settings()
+# Served by app.server, along with the code reading the module singletons
+application = make_app(settings, context=Context.process(settings))
@@ -1,37 +1,20 @@
 """
 Launcher of the application
 """
-import os
-import asyncio
-from tornado import ioloop
 from app.urls import application
-from app.models import User, Game, GameMove
-
-
-def ensure_ai_user():
-    """
-    AI User creation
-    :return:
-    """
-    data = {'username': 'tictactoeai', 'email': 'ai@robot.de'}
-    loop = asyncio.get_event_loop()
-    ai = loop.run_until_complete(User.find_one({'username': 'tictactoeai'}))
-    if ai:
-        return
-    ai = User(**data)
-    loop.run_until_complete(ai.commit())
-    pass
+from app.server import Worker, Supervisor
 
 
 def main():
     """
-    Main launcher of the webApp
+    Main launcher of the webApp. With WORKERS greater than one the
+    application is served by a pre-fork pool of processes.
     :return:
     """
-    app = application
-    ensure_ai_user()
-    app.listen(os.getenv('PORT', "8000"))
-    ioloop.IOLoop.current().start()
+    if application.config.workers > 1:
+        Supervisor(application).run()
+    else:
+        Worker(application).run()
 
 
 if __name__ == "__main__":